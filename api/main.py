@@ -1,8 +1,9 @@
 # real_estate_ai/api/main.py (FINAL, STABLE, TARGETED SCRAPING VERSION)
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import requests
 from bs4 import BeautifulSoup
 import re
@@ -21,7 +22,10 @@ from playwright.async_api import async_playwright, TimeoutError
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 try:
-    from matching_engine.engine import MatchingEngine
+    from matching_engine.engine import (MatchingEngine, embedding_cache_stats, readiness, start_bundle_watcher,
+                                        warm_up)
+    from matching_engine.bundle import is_published_version
+    from matching_engine.structured_matcher import normalize_filters
 except ImportError as e:
     print(f"❌ Critical Import Error: {e}")
     print(
@@ -85,6 +89,42 @@ except Exception as e:
     print("Please ensure you have run 'python -m matching_engine.build_indexes' first.")
     sys.exit(1)
 
+# Set by gunicorn_api_conf.py: this module is imported once in the gunicorn
+# master and the workers are forked from it, sharing the loaded models and
+# indexes copy-on-write. Threads do not survive fork, so the warm-up runs
+# synchronously here and per-worker threads start in start_worker_threads().
+PRELOADED = os.getenv("MATCHING_PRELOAD", "0") == "1"
+
+# Load the embedding models in a background thread so the server accepts
+# traffic right away; /ready turns 200 once they are in memory. With
+# MATCHING_WARMUP=0 they load on the first request that misses the cache.
+if os.getenv("MATCHING_WARMUP", "1") == "1":
+    warm_up(background=not PRELOADED)
+
+# Optional: poll data/bundles/CURRENT and hot-swap newly built index bundles.
+# Each worker process runs its own watcher, so this also covers multi-worker setups.
+BUNDLE_WATCH_SECONDS = float(os.getenv("MATCHING_BUNDLE_WATCH_SECONDS", "0"))
+
+
+def start_worker_threads():
+    """Background threads each worker process needs (called post-fork when preloaded)."""
+    if BUNDLE_WATCH_SECONDS > 0:
+        start_bundle_watcher(BUNDLE_WATCH_SECONDS)
+
+
+if not PRELOADED:
+    start_worker_threads()
+
+# /admin endpoints require a matching X-Admin-Token header; without a token they are disabled.
+ADMIN_TOKEN = os.getenv("MATCHING_ADMIN_TOKEN")
+
+
+def _require_admin(x_admin_token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled")
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
 
 # Pydantic model for a listing (used by the matching engine internally)
 class ListingModel(BaseModel):
@@ -101,6 +141,9 @@ class ListingModel(BaseModel):
 # --- PYDANTIC MODEL FOR INCOMING REQUEST BODY ---
 class MatchRequest(BaseModel):
     sale_url: str
+    # Optional hard pre-filters on the rentals searched, e.g.
+    # {"city": "Rome", "min_rooms": 2, "max_rooms": 4, "min_price": 60, "max_price": 180}
+    filters: Optional[Dict[str, Any]] = None
 
 
 # --- Helper functions for scraping/parsing (Unchanged) ---
@@ -294,6 +337,10 @@ def _scrape_sale_listing_details(url: str) -> Dict[str, Any]:
 async def match_listings(request_body: MatchRequest):
     sale_url = request_body.sale_url
     print(f"🔄 Received request to scrape and match for sale URL: {sale_url}")
+    try:
+        normalize_filters(request_body.filters)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filters: {e}")
 
     # --- MOCK DATA BYPASS REMAINS THE SAME ---
     if "test-mock-url" in sale_url.lower() and MOCK_SALE_LISTING:
@@ -323,7 +370,7 @@ async def match_listings(request_body: MatchRequest):
     # Call the Matching Engine (using asyncio.to_thread for blocking call)
     try:
         matches = await asyncio.to_thread(
-            engine.match_sale_to_rentals, sale_listing_data, top_k=5
+            engine.match_sale_to_rentals, sale_listing_data, top_k=5, filters=request_body.filters
         )
         print(f"✅ Found {len(matches)} matches for {sale_listing_data.get('title')}.")
     except Exception as e:
@@ -337,7 +384,36 @@ async def match_listings(request_body: MatchRequest):
     return {"sale_listing": sale_listing_data, "matches": matches}
 
 
+# Hot-reload the index bundle (the one data/bundles/CURRENT points at, or `version`).
+# In-flight /match requests finish on the bundle they started with.
+@app.post("/admin/reload")
+async def reload_index_bundle(version: Optional[str] = None, x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    if version is not None and not is_published_version(version):
+        raise HTTPException(status_code=404, detail=f"Unknown index bundle version: {version}")
+    try:
+        active = await asyncio.to_thread(engine.reload, version)
+    except Exception as e:
+        print(f"❌ Index reload failed: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to reload index bundle: {e}")
+    return {"status": "ok", "bundle_version": active}
+
+
+# Embedding cache counters of this worker (memory tier size, hits, misses, evictions)
+@app.get("/admin/cache-stats")
+def cache_stats(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    return embedding_cache_stats()
+
+
 # Health check endpoint
 @app.get("/health")
 def health_check():
     return {"status": "ok", "message": "FastAPI backend is running"}
+
+
+# Readiness: 503 until the index bundle is loaded and the model warm-up is done
+@app.get("/ready")
+def ready_check():
+    status = readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
@@ -10,6 +10,11 @@ def main():
     parser.add_argument("--rooms", type=int, default=0)
     parser.add_argument("--location", type=str, default="")
     parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument("--city", type=str, nargs="+", help="Only match rentals in these cities")
+    parser.add_argument("--min_rooms", type=int)
+    parser.add_argument("--max_rooms", type=int)
+    parser.add_argument("--min_price", type=float, help="Minimum nightly rental price")
+    parser.add_argument("--max_price", type=float, help="Maximum nightly rental price")
     args = parser.parse_args()
 
     sale_listing = {
@@ -22,7 +27,8 @@ def main():
     }
 
     engine = MatchingEngine()
-    results = engine.match_sale_to_rentals(sale_listing, top_k=args.top_k)
+    filters = {k: getattr(args, k) for k in ("city", "min_rooms", "max_rooms", "min_price", "max_price")}
+    results = engine.match_sale_to_rentals(sale_listing, top_k=args.top_k, filters=filters)
 
     print("✅ Top matches:")
     for i, r in enumerate(results):
@@ -0,0 +1,42 @@
+# gunicorn_api_conf.py - pre-fork deployment of the FastAPI matching API
+#
+#   gunicorn -c gunicorn_api_conf.py api.main:app
+#
+# The app (engine, both embedding models, FAISS indexes, rental store) is
+# loaded once in the master and workers are forked from it, so they share
+# those pages copy-on-write instead of each loading its own copy.
+# Not for the Flask frontend in the Procfile (gunicorn app:app).
+import gc
+import os
+
+# api.main warms up synchronously when preloaded (no threads across fork)
+os.environ.setdefault("MATCHING_PRELOAD", "1")
+# A CUDA context does not survive fork; preloaded models stay on the CPU
+os.environ.setdefault("MATCHING_MODEL_DEVICE", "cpu")
+
+bind = os.getenv("MATCHING_BIND", "0.0.0.0:" + os.getenv("PORT", "8000"))
+workers = int(os.getenv("MATCHING_WORKERS", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+
+# Intra-op threads per worker; by default the cores are split between workers
+TORCH_THREADS = int(os.getenv("MATCHING_TORCH_THREADS", "0")) or max(1, (os.cpu_count() or 1) // workers)
+
+
+def when_ready(server):
+    # Move everything allocated during the preload out of the cyclic GC's
+    # reach, so collections in the workers do not write to (and un-share)
+    # those pages.
+    gc.freeze()
+    server.log.info(f"Preloaded matching engine; forking {workers} workers with {TORCH_THREADS} threads each")
+
+
+def post_fork(server, worker):
+    from api.main import start_worker_threads
+    from matching_engine.engine import set_worker_threads
+
+    # The master only loads models and never runs inference, so no OpenMP
+    # pool was started before the fork and it is safe to size it here.
+    set_worker_threads(TORCH_THREADS)
+    start_worker_threads()
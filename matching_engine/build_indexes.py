@@ -1,18 +1,26 @@
 # real_estate_ai/matching_engine/build_indexes.py (MODIFIED)
+import argparse
+import hashlib
 import json
 import os
+import shutil
+from urllib.parse import urlsplit
 from tqdm import tqdm
 import numpy as np
-import faiss
+from matching_engine.bundle import (FUSED_INDEX_FILE, IMAGE_INDEX_FILE, MANIFEST_FILE, STORE_SUBDIR, TEXT_INDEX_FILE,
+                                    bundle_path, current_version, finalize_bundle, new_version, prune_bundles,
+                                    publish, staging_dir)
+from matching_engine.index_factory import (FUSED_WEIGHTS, build_index, fuse_vectors, is_compact, load_index,
+                                           parse_index_spec, rebuild_params, save_index, storage_report)
+from matching_engine.rental_store import RentalStore, write_store
+from matching_engine.shards import SHARDS_SUBDIR, _link_or_copy, write_shards
+from matching_engine.structured_matcher import location_city
 from matching_engine.text_matcher import embed_text
-from matching_engine.image_matcher import embed_image_url
+from matching_engine.image_matcher import embed_images_pipelined
 import re # Import regex for parsing strings
 
 # Point DATA_IN to your scraped Booking.com data file
 DATA_IN = os.path.join("data", "booking_rentals.json") # <--- CRITICAL CHANGE
-OUT_META = os.path.join("data", "rentals_meta.json")
-FAISS_TEXT_PATH = os.path.join("data", "faiss_text.index")
-FAISS_IMAGE_PATH = os.path.join("data", "faiss_image.index")
 
 
 def _parse_price_to_float(price_str):
@@ -53,6 +61,30 @@ def _parse_rooms_from_room_type(room_type_str):
     
     return 0 # Default if no number or keyword found
 
+def _stable_rental_id(item):
+    """
+    Stable int64 id of a scraped listing: hash of the listing URL without its
+    query string (Booking links carry per-search dates and tracking params)
+    plus the room type. Unaffected by scrape order.
+    """
+    link = item.get("Link") or ""
+    parts = urlsplit(link)
+    key = f"{parts.netloc}{parts.path}|{item.get('Room Type', '')}" if link else \
+        f"{item.get('Name', '')}|{item.get('Location', '')}|{item.get('Room Type', '')}"
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:15], 16)
+
+
+def _embed_hash(rental):
+    """Hash of the fields that feed the embeddings; a change means re-embedding."""
+    key = json.dumps([rental.get("desc", ""), rental.get("images", [])], ensure_ascii=False)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def _record_hash(rental):
+    """Hash of the whole rental record; a change without an embed change only rewrites the record."""
+    return hashlib.md5(json.dumps(rental, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
 def load_rentals():
     print(f"📂 Loading rentals from {DATA_IN}")
     if not os.path.exists(DATA_IN):
@@ -63,8 +95,12 @@ def load_rentals():
     
     # Transform raw_data from Booking.com format to internal ListingModel format
     transformed_rentals = []
-    for i, item in enumerate(raw_data):
-        item_id = i + 1 # Simple sequential ID for internal use
+    seen_ids = set()
+    for item in raw_data:
+        item_id = _stable_rental_id(item)
+        if item_id in seen_ids:
+            continue  # the scrape repeats listings across result pages
+        seen_ids.add(item_id)
 
         platform = "Booking.com"
         if item.get("Link"):
@@ -98,89 +134,255 @@ def load_rentals():
             "location": item.get("Location", "Unknown"),
             "images": images
         })
-    print(f"✅ Loaded and transformed {len(transformed_rentals)} rental listings from {DATA_IN}.")
+    print(f"✅ Loaded and transformed {len(transformed_rentals)} rental listings from {DATA_IN} "
+          f"({len(raw_data) - len(transformed_rentals)} duplicates skipped).")
     return transformed_rentals
 
 
-def build_text_index(text_embs):
-    dim = text_embs.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    index.add(text_embs)
-    faiss.write_index(index, FAISS_TEXT_PATH)
-    print(f"✅ Saved text index -> {FAISS_TEXT_PATH} (dim: {dim})")
-
-
-def build_image_index(image_embs):
-    dim = image_embs.shape[1]
-    index = faiss.IndexFlatIP(dim)
-    index.add(image_embs)
-    faiss.write_index(index, FAISS_IMAGE_PATH)
-    print(f"✅ Saved image index -> {FAISS_IMAGE_PATH} (dim: {dim})")
-
-
-def main():
-    rentals = load_rentals()
-    if not rentals:
-        raise SystemExit("❌ No rentals found or parsed correctly. Check data/booking_rentals.json and parsing logic.")
-
+def embed_rentals(rentals, image_workers=16, image_batch_size=64, image_vectors=1):
+    """
+    Embeddings for `rentals`: (text_embs, image_embs, photo_vecs). Images go
+    through the download/encode pipeline of image_matcher.embed_images_pipelined
+    with `image_workers` concurrent downloads and CLIP batches of
+    `image_batch_size`. With image_vectors=1 the image embedding is the first
+    photo and photo_vecs is None; with more, up to `image_vectors` photos per
+    rental are embedded, photo_vecs = (vectors, per-rental counts) and the
+    image embedding is their normalised centroid.
+    """
     # --- 1) TEXT embeddings ---
     print("✍️ Embedding texts ...")
     texts = [r.get("desc", "") for r in rentals]
     text_embs = embed_text(texts)  # NxD
-    
+
     # Ensure consistent shape and normalization
     if text_embs.ndim == 1:
         text_embs = text_embs.reshape(1, -1)
     text_embs = text_embs / (np.linalg.norm(text_embs, axis=1, keepdims=True) + 1e-10)
     text_embs = text_embs.astype("float32")
-    
     print(f"Text embeddings shape: {text_embs.shape}")
-    build_text_index(text_embs)
 
-    # Save text embeddings in metadata
-    for i, emb in enumerate(text_embs):
-        # Store embeddings as lists, convert back to np array when needed
-        rentals[i]["text_emb"] = emb.flatten().tolist()
-
-    # --- 2) IMAGE embeddings (average per rental) ---
+    # --- 2) IMAGE embeddings ---
     print("🖼️ Embedding images ...")
-    image_embs_list = []
-    # Using ThreadPoolExecutor for concurrent image downloads/embeddings
-    # from matching_engine.image_matcher import embed_images_batch
-    # embed_images_batch is designed for a single listing, let's keep it simple for build time
-    # and embed sequentially or adapt to process all rentals' primary image
-
-    # For simplicity and to avoid overwhelming during build, we'll embed one image per rental sequentially
-    for r in tqdm(rentals, desc="Embedding rental images"):
-        imgs = r.get("images", [])
-        avg_emb = np.zeros((512,), dtype="float32") # Default zero vector if no image
-        
-        if imgs:
-            try:
-                # Assuming only one image per rental as per placeholder generation
-                emb = embed_image_url(imgs[0])
-                if emb is not None:
-                    avg_emb = emb.astype("float32").flatten()
-                    avg_emb /= (np.linalg.norm(avg_emb) + 1e-10) # Normalize
-            except Exception as e:
-                print(f"Warning: Failed to embed image {imgs[0]} for rental ID {r['id']}: {e}")
-        
-        image_embs_list.append(avg_emb)
-        r["image_emb"] = avg_emb.tolist()
-
+    photos = [[u for u in (r.get("images") or [])[:image_vectors] if u] for r in rentals]
+    with tqdm(total=len({u for urls in photos for u in urls}), desc="Embedding rental images", unit="img") as bar:
+        embedded = embed_images_pipelined([u for urls in photos for u in urls], workers=image_workers,
+                                          batch_size=image_batch_size, progress=bar.update)
 
-    image_embs = np.vstack(image_embs_list).astype("float32")
+    image_embs = np.zeros((len(rentals), 512), dtype="float32")  # zero vector: no image
+    vecs, counts = [], []
+    for i, urls in enumerate(photos):
+        rental_vecs = [embedded[u] / (np.linalg.norm(embedded[u]) + 1e-10) for u in urls
+                       if embedded.get(u) is not None]
+        vecs.extend(rental_vecs)
+        counts.append(len(rental_vecs))
+        if rental_vecs:
+            centroid = np.mean(rental_vecs, axis=0)
+            image_embs[i] = centroid / (np.linalg.norm(centroid) + 1e-10)
     print(f"Image embeddings shape: {image_embs.shape}")
-    build_image_index(image_embs)
 
-    # --- Save metadata ---
-    with open(OUT_META, "w", encoding="utf-8") as f:
-        json.dump(rentals, f, ensure_ascii=False, indent=2)
-    print(f"✅ Metadata saved -> {OUT_META}")
-    print("🎉 Finished building indexes.")
+    if image_vectors <= 1:
+        return text_embs, image_embs, None
+    vecs = np.vstack(vecs).astype("float32") if vecs else np.zeros((0, 512), dtype="float32")
+    print(f"📸 {len(vecs)} photo vectors for {len(rentals)} rentals (up to {image_vectors} each)")
+    return text_embs, image_embs, (vecs, np.array(counts, dtype=np.int64))
+
+
+def publish_bundle(write_store_to, text_index, image_index, text_params, image_params, manifest,
+                   keep_bundles=3, fused=None, shards=None):
+    """
+    Write prebuilt indexes plus a rental store as a new bundle and publish it.
+    `write_store_to(path)` writes the store; `manifest` adds to the bundle
+    manifest. `fused` is an optional (index, params) fused text+image index.
+    `shards` are shards.write_shards options to partition the bundle by market.
+    """
+    version = new_version()
+    out_dir = staging_dir(version)
+    save_index(text_index, os.path.join(out_dir, TEXT_INDEX_FILE), text_params)
+    save_index(image_index, os.path.join(out_dir, IMAGE_INDEX_FILE), image_params)
+    if fused is not None:
+        save_index(fused[0], os.path.join(out_dir, FUSED_INDEX_FILE), fused[1])
+        manifest = {**manifest, "fused_index": {"dim": int(fused[0].d), **fused[1]}}
+
+    # --- Save metadata: binary embeddings + columnar/line-indexed rental store ---
+    write_store_to(os.path.join(out_dir, STORE_SUBDIR))
+    if shards is not None:
+        store = RentalStore(os.path.join(out_dir, STORE_SUBDIR))
+        store.attach_index(text_index, image_index)
+        manifest = {**manifest, "shards": write_shards(
+            out_dir, store, fused_weights=manifest.get("fused_weights") if fused is not None else None, **shards)}
+
+    bundle_dir = finalize_bundle(out_dir, version, {
+        "source": DATA_IN,
+        **manifest,
+        "text_index": {"dim": int(text_index.d), **text_params},
+        "image_index": {"dim": int(image_index.d), **image_params},
+    })
+    publish(version)
+    prune_bundles(keep_bundles)
+    return bundle_dir
+
+
+def _index_args(spec):
+    """(index_type, params) from a spec string or from the params of an existing index."""
+    return parse_index_spec(spec) if isinstance(spec, str) else rebuild_params(spec)
+
+
+def build_bundle(rentals, text_embs, image_embs, text_index="flat", image_index="flat", manifest=None,
+                 keep_bundles=3, photo_vecs=None, fused_index=None, shards=None, trained=None):
+    """
+    Build fresh ID-mapped indexes over `rentals` (keyed by their stable "id")
+    and publish them with a new store. `text_index` / `image_index` are spec
+    strings or the params of the indexes being rebuilt. With `photo_vecs`
+    (see embed_rentals) the image index holds one vector per photo, keyed by
+    the photo's position in the store. `fused_index` (spec or params) adds an
+    index over the weighted text + image centroid concatenation; `shards`
+    (write_shards options) adds per-market shards. `trained` maps "text",
+    "image" or "fused" to an already trained empty index (trained_copy) to
+    fill instead of training that index again.
+    """
+    trained = trained or {}
+    ids = np.array([r["id"] for r in rentals], dtype=np.int64)
+    index_type, params = _index_args(text_index)
+    t_index, t_params = build_index(text_embs, index_type, ids=ids, trained=trained.get("text"), **params)
+    index_type, params = _index_args(image_index)
+    if photo_vecs is None:
+        i_index, i_params = build_index(image_embs, index_type, ids=ids, trained=trained.get("image"), **params)
+    else:
+        vecs = photo_vecs[0]
+        i_index, i_params = build_index(vecs, index_type, ids=np.arange(len(vecs), dtype=np.int64),
+                                        trained=trained.get("image"), **params)
+    print(f"✅ Built text index ({t_params}) and image index ({i_params}) over {len(rentals)} rentals")
+    fused = None
+    if fused_index is not None:
+        index_type, params = _index_args(fused_index)
+        fused = build_index(fuse_vectors(text_embs, image_embs, FUSED_WEIGHTS), index_type, ids=ids,
+                            trained=trained.get("fused"), **params)
+        print(f"✅ Built fused text+image index ({fused[1]}, weights {FUSED_WEIGHTS})")
+
+    # Compact (sq8/fp16) indexes are the only copy of their vectors
+    vectors_in_index, storage = [], {}
+    for kind, index, index_params, embs, index_ids in (
+            ("text", t_index, t_params, text_embs, ids),
+            ("image", i_index, i_params, image_embs if photo_vecs is None else photo_vecs[0],
+             ids if photo_vecs is None else None)):
+        if is_compact(index_params):
+            vectors_in_index.append(kind)
+            storage[kind] = report = {"index_type": index_params["index_type"],
+                                      **storage_report(index, embs, index_ids)}
+            print(f"📊 {kind} vectors: {report['index_type']} {report['compact_bytes'] / 2**20:.1f} MB vs "
+                  f"{report['float32_bytes'] / 2**20:.1f} MB float32 (index + store copy), "
+                  f"score drift mean {report.get('score_drift_mean')} / max {report.get('score_drift_max')}, "
+                  f"recall@{report.get('k')} {report.get('recall')}")
+
+    def write(path):
+        write_store(path, rentals, text_embs, image_embs, ids=ids,
+                    embed_hashes=[_embed_hash(r) for r in rentals],
+                    record_hashes=[_record_hash(r) for r in rentals],
+                    image_vecs=photo_vecs, vectors_in_index=vectors_in_index)
+
+    manifest = {"n_rentals": len(rentals), "n_tombstones": 0, "stale_vectors": 0, **(manifest or {})}
+    if storage:
+        manifest["vector_storage"] = storage
+    if fused is not None:
+        manifest["fused_weights"] = list(FUSED_WEIGHTS)
+    return publish_bundle(write, t_index, i_index, t_params, i_params, manifest, keep_bundles, fused, shards)
+
+
+def main(text_index="flat", image_index="flat", keep_bundles=3, image_workers=16, image_batch_size=64,
+         image_vectors=1, fused_index=None, shard_index=None, shard_min_rentals=200):
+    """
+    Build both indexes and the rental store into a new versioned bundle under
+    data/bundles/, then publish it as CURRENT (running engines pick it up via
+    reload). `text_index` / `image_index` are index specs such as
+    "flat", "ivf_flat,nlist=1024,nprobe=16", "ivf_pq,m=48,train_size=50000",
+    "hnsw,M=32,efSearch=128", "sq8" or "fp16" (see index_factory). image_vectors > 1 embeds
+    that many photos per rental into a multi-vector image index. `fused_index` adds a fused
+    text+image index of that spec, searched once per sale. `shard_index` partitions the
+    bundle into per-market shards with indexes of that spec (markets with fewer than
+    `shard_min_rentals` rentals share one shard). For daily refreshes use
+    matching_engine.update_indexes, which only embeds new or changed rentals.
+    """
+    rentals = load_rentals()
+    if not rentals:
+        raise SystemExit("❌ No rentals found or parsed correctly. Check data/booking_rentals.json and parsing logic.")
+
+    text_embs, image_embs, photo_vecs = embed_rentals(rentals, image_workers, image_batch_size, image_vectors)
+    bundle_dir = build_bundle(rentals, text_embs, image_embs, text_index, image_index,
+                              manifest={"image_vectors": image_vectors}, keep_bundles=keep_bundles,
+                              photo_vecs=photo_vecs, fused_index=fused_index,
+                              shards={"spec": shard_index, "min_rentals": shard_min_rentals} if shard_index else None)
+    print(f"🎉 Finished building indexes -> {bundle_dir}")
+
+
+def rebuild_shards(markets, spec=None, keep_bundles=3):
+    """
+    Rebuild only the shards of `markets` (city names) of the current bundle,
+    optionally with a new index `spec`, from the stored vectors. Everything
+    else is hard-linked into the new bundle version, which is then published.
+    """
+    version = current_version()
+    if version is None:
+        raise SystemExit("❌ No published bundle to rebuild shards of")
+    src = bundle_path(version)
+    with open(os.path.join(src, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if not manifest.get("shards"):
+        raise SystemExit(f"❌ Bundle {version} has no market shards (build with --shard-index)")
+
+    markets = [location_city(m) for m in markets]
+    new = new_version()
+    out_dir = staging_dir(new)
+    for name in os.listdir(src):
+        if name not in (MANIFEST_FILE, SHARDS_SUBDIR):
+            path = os.path.join(src, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(out_dir, name), copy_function=_link_or_copy)
+            else:
+                _link_or_copy(path, os.path.join(out_dir, name))
+
+    store = RentalStore(os.path.join(out_dir, STORE_SUBDIR))
+    if store.vectors_in_index:
+        store.attach_index(load_index(os.path.join(src, TEXT_INDEX_FILE)),
+                           load_index(os.path.join(src, IMAGE_INDEX_FILE)))
+    summary = write_shards(out_dir, store, spec=manifest["shards"]["spec"],
+                           min_rentals=manifest["shards"]["min_rentals"],
+                           fused_weights=manifest.get("fused_weights"), previous=src,
+                           specs={m: spec for m in markets} if spec else None, rebuild=markets)
+    manifest = {k: v for k, v in manifest.items() if k not in ("version", "created_at")}
+    bundle_dir = finalize_bundle(out_dir, new, {**manifest, "base_version": version, "shards": summary})
+    publish(new)
+    prune_bundles(keep_bundles)
+    print(f"🎉 Rebuilt shards {', '.join(markets)} -> {bundle_dir}")
+    return bundle_dir
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text-index", type=str, default="flat",
+                        help='Text index spec, e.g. "hnsw,M=32,efSearch=128"')
+    parser.add_argument("--image-index", type=str, default="flat",
+                        help='Image index spec, e.g. "ivf_flat,nlist=256,nprobe=16"')
+    parser.add_argument("--keep-bundles", type=int, default=3,
+                        help="Number of bundle versions to keep in data/bundles")
+    parser.add_argument("--image-workers", type=int, default=16, help="Concurrent image downloads")
+    parser.add_argument("--image-batch-size", type=int, default=64, help="Images per CLIP batch")
+    parser.add_argument("--image-vectors", type=int, default=1,
+                        help="Photos embedded per rental; >1 builds a multi-vector image index (one vector per photo)")
+    parser.add_argument("--fused-index", type=str, default=None,
+                        help='Also build a fused text+image index of this spec, e.g. "hnsw,M=32"')
+    parser.add_argument("--shard-index", type=str, default=None,
+                        help='Partition the bundle into per-market shards with indexes of this spec, e.g. "flat"')
+    parser.add_argument("--shard-min-rentals", type=int, default=200,
+                        help="Markets with fewer live rentals share one shard")
+    parser.add_argument("--rebuild-shards", type=str, nargs="+", metavar="MARKET",
+                        help="Only rebuild these market shards of the current bundle (with --shard-index as new spec)")
+    args = parser.parse_args()
+
     # Create the data directory if it doesn't exist
     os.makedirs("data", exist_ok=True)
-    main()
\ No newline at end of file
+    if args.rebuild_shards:
+        rebuild_shards(args.rebuild_shards, spec=args.shard_index, keep_bundles=args.keep_bundles)
+        raise SystemExit(0)
+    main(text_index=args.text_index, image_index=args.image_index, keep_bundles=args.keep_bundles,
+         image_workers=args.image_workers, image_batch_size=args.image_batch_size, image_vectors=args.image_vectors,
+         fused_index=args.fused_index, shard_index=args.shard_index, shard_min_rentals=args.shard_min_rentals)
\ No newline at end of file
@@ -0,0 +1,172 @@
+# matching_engine/bundle.py
+import json
+import os
+import re
+import shutil
+import time
+
+from matching_engine.index_factory import load_index, load_index_params, mapped_rss_bytes, process_rss_bytes
+from matching_engine.rental_store import RentalStore
+from matching_engine.shards import load_shards
+
+# Versioned index bundles. Each build writes a self-contained directory
+#   data/bundles/<version>/
+#       manifest.json
+#       faiss_text.index   (+ faiss_text.params.json)
+#       faiss_image.index  (+ faiss_image.params.json)
+#       faiss_fused.index  (optional, + faiss_fused.params.json)
+#       rentals_store/
+#       shards/            (optional per-market indexes, see shards.py)
+# and then atomically points data/bundles/CURRENT at it. Running engines load
+# the new bundle next to the old one and swap a single reference.
+BUNDLES_DIR = os.path.join("data", "bundles")
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+TEXT_INDEX_FILE = "faiss_text.index"
+IMAGE_INDEX_FILE = "faiss_image.index"
+# Weighted text+image concatenation (index_factory.fuse_vectors), built with --fused-index
+FUSED_INDEX_FILE = "faiss_fused.index"
+STORE_SUBDIR = "rentals_store"
+# Names new_version hands out: UTC timestamp, optionally "-<n>" for same-second builds
+VERSION_PATTERN = re.compile(r"^(\d{8}T\d{6}Z)(?:-(\d+))?$")
+
+
+def new_version(bundles_dir=BUNDLES_DIR):
+    """Timestamp version name, suffixed if a bundle with that name already exists."""
+    base = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    version, n = base, 1
+    while os.path.exists(os.path.join(bundles_dir, version)):
+        n += 1
+        version = f"{base}-{n}"
+    return version
+
+
+def staging_dir(version, bundles_dir=BUNDLES_DIR):
+    """Directory to build a bundle in before `finalize_bundle` moves it into place."""
+    path = os.path.join(bundles_dir, f".tmp-{version}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def finalize_bundle(staging_path, version, manifest, bundles_dir=BUNDLES_DIR):
+    """Write the manifest and move a fully written staging directory to bundles/<version>."""
+    manifest = {"version": version, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), **manifest}
+    with open(os.path.join(staging_path, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    final_path = os.path.join(bundles_dir, version)
+    os.replace(staging_path, final_path)
+    return final_path
+
+
+def publish(version, bundles_dir=BUNDLES_DIR):
+    """Atomically make `version` the current bundle."""
+    tmp = os.path.join(bundles_dir, f".{CURRENT_FILE}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(bundles_dir, CURRENT_FILE))
+    print(f"✅ Published bundle {version}")
+
+
+def current_version(bundles_dir=BUNDLES_DIR):
+    try:
+        with open(os.path.join(bundles_dir, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def bundle_path(version, bundles_dir=BUNDLES_DIR):
+    return os.path.join(bundles_dir, version)
+
+
+def is_published_version(version, bundles_dir=BUNDLES_DIR):
+    """True if `version` is a new_version-style name of an existing bundle directory."""
+    if not isinstance(version, str) or not VERSION_PATTERN.match(version):
+        return False
+    try:
+        return version in os.listdir(bundles_dir)
+    except FileNotFoundError:
+        return False
+
+
+def _version_order(version):
+    """Sort key of new_version names: (timestamp, n), so "-10" sorts after "-2"."""
+    m = VERSION_PATTERN.match(version)
+    return (m.group(1), int(m.group(2) or 1)) if m else (version, 0)
+
+
+def prune_bundles(keep=3, bundles_dir=BUNDLES_DIR):
+    """Delete all but the newest `keep` bundles, never the current one."""
+    current = current_version(bundles_dir)
+    versions = sorted((v for v in os.listdir(bundles_dir)
+                       if os.path.exists(os.path.join(bundles_dir, v, MANIFEST_FILE))), key=_version_order)
+    for v in versions[:-keep] if keep > 0 else versions:
+        if v != current:
+            shutil.rmtree(os.path.join(bundles_dir, v), ignore_errors=True)
+
+
+class IndexBundle:
+    """
+    Everything one match request reads: both FAISS indexes and the rental
+    store (plus the optional fused index and market shards). Immutable once
+    loaded, so requests holding a reference keep working while a newer bundle
+    is swapped in.
+    """
+
+    def __init__(self, version, text_index, image_index, store, manifest=None, index_memory=None,
+                 fused_index=None):
+        self.version = version
+        self.text_index = text_index
+        self.image_index = image_index
+        self.fused_index = fused_index
+        self.shards = None  # shards.ShardMap of sharded bundles
+        self.store = store
+        self.manifest = manifest or {}
+        self.index_memory = index_memory or {}
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """Load a bundle directory written by build_indexes."""
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        fused_path = os.path.join(path, FUSED_INDEX_FILE)
+        bundle = cls.from_files(manifest["version"], os.path.join(path, TEXT_INDEX_FILE),
+                                os.path.join(path, IMAGE_INDEX_FILE), os.path.join(path, STORE_SUBDIR),
+                                mmap, manifest, fused_path if os.path.exists(fused_path) else None)
+        bundle.shards = load_shards(path, bundle, mmap)
+        return bundle
+
+    @classmethod
+    def from_files(cls, version, text_path, image_path, store_path, mmap, manifest=None, fused_path=None):
+        memory = {}
+        text_index = _load_index_measured("text", text_path, mmap, memory)
+        image_index = _load_index_measured("image", image_path, mmap, memory)
+        fused_index = _load_index_measured("fused", fused_path, mmap, memory) if fused_path else None
+        store = RentalStore(store_path)
+        store.attach_index(text_index, image_index)
+        return cls(version, text_index, image_index, store, manifest, memory, fused_index)
+
+
+def _load_index_measured(name, path, mmap, memory):
+    rss_before = process_rss_bytes()
+    index = load_index(path, mmap=mmap)
+    if mmap:
+        resident = mapped_rss_bytes(path)
+    else:
+        rss_after = process_rss_bytes()
+        resident = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+
+    memory[name] = {
+        "path": path,
+        "mmap": mmap,
+        "index_type": load_index_params(path).get("index_type"),
+        "ntotal": index.ntotal,
+        "file_bytes": os.path.getsize(path),
+        "resident_bytes": resident,
+    }
+    res = f"{resident / 2**20:.1f} MB" if resident is not None else "n/a"
+    print(f"📊 {name} index: {index.ntotal} vectors, {res} resident "
+          f"({'mmap, shared' if mmap else 'private heap'}; {os.path.getsize(path) / 2**20:.1f} MB on disk)")
+    return index
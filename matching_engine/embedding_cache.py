@@ -0,0 +1,269 @@
+# matching_engine/embedding_cache.py
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# Persistent key -> embedding cache in SQLite (WAL mode). Vectors are stored as
+# raw float32 blobs, NULL marks a known failure (e.g. an image that could not
+# be downloaded). Entries are read on demand, so startup does not read the whole cache,
+# and writes are buffered and flushed in one transaction per batch. Several
+# processes (API workers, a build) can share one file; SQLite serialises the
+# writers and readers never see a half-written batch.
+#
+# In front of SQLite sits a bounded in-memory LRU, so hot keys do not hit disk
+# and long-running workers keep a stable footprint. Limits per cache:
+#   MATCHING_EMBEDDING_CACHE_ENTRIES  max entries kept in memory (default 10000, 0 = no memory tier)
+#   MATCHING_EMBEDDING_CACHE_MB       max vector bytes kept in memory (default: unbounded)
+DEFAULT_MAX_ENTRIES = int(os.environ.get("MATCHING_EMBEDDING_CACHE_ENTRIES", "10000"))
+DEFAULT_MAX_BYTES = int(float(os.environ.get("MATCHING_EMBEDDING_CACHE_MB", "0")) * 2**20) or None
+
+_MISSING = object()
+
+
+class EmbeddingCache:
+    def __init__(self, path, legacy_json=None, flush_every=64, max_entries=None, max_bytes=None):
+        """
+        `path` is the SQLite file. If `legacy_json` (an old {key: list|None}
+        JSON cache) exists it is imported once and renamed to *.migrated.
+        Buffered writes are flushed every `flush_every` puts, at the end of
+        each batch (`flush()`), and at interpreter exit. `max_entries` /
+        `max_bytes` bound the in-memory LRU (defaults from the environment).
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.max_entries = DEFAULT_MAX_ENTRIES if max_entries is None else max_entries
+        self.max_bytes = DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._lru = OrderedDict()
+        self._lru_bytes = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        self._conn_pid = None
+        self._conn = None
+        if legacy_json and os.path.exists(legacy_json):
+            self._migrate_json(legacy_json)
+        atexit.register(self.flush)
+
+    def _connection(self):
+        # One connection per process: a connection inherited across fork() must not be reused
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB) WITHOUT ROWID")
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _encode(vec):
+        return None if vec is None else np.asarray(vec, dtype="float32").reshape(-1).tobytes()
+
+    @staticmethod
+    def _decode(blob):
+        return None if blob is None else np.frombuffer(blob, dtype="float32").copy()
+
+    def get(self, key, default=_MISSING):
+        """Cached vector (float32), None for a cached failure, `default` if the key is unknown."""
+        found = self.get_many([key])
+        if key in found:
+            return found[key]
+        return None if default is _MISSING else default
+
+    def __contains__(self, key):
+        return key in self.get_many([key])
+
+    def get_many(self, keys):
+        """{key: vector or None} for the keys that are cached (pending writes included)."""
+        keys = list(dict.fromkeys(keys))
+        found, rest = {}, []
+        with self._lock:
+            for k in keys:
+                if k in self._lru:
+                    self._lru.move_to_end(k)
+                    found[k] = self._lru[k]
+                elif k in self._pending:
+                    found[k] = self._decode(self._pending[k])
+                else:
+                    rest.append(k)
+            self.hits += len(found)
+
+            conn = self._connection()
+            for i in range(0, len(rest), 500):
+                chunk = rest[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for k, blob in rows:
+                    found[k] = self._decode(blob)
+                    self._remember(k, found[k])
+                    self.disk_hits += 1
+            self.misses += len(keys) - len(found)
+        # Callers get their own copies; the memory tier must not be modified in place
+        return {k: None if v is None else v.copy() for k, v in found.items()}
+
+    def _remember(self, key, vec):
+        """Insert into the LRU and evict the least recently used entries over the limits."""
+        if self.max_entries <= 0:
+            return
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self._lru_bytes -= old.nbytes
+        self._lru[key] = vec
+        self._lru_bytes += 0 if vec is None else vec.nbytes
+        while len(self._lru) > self.max_entries or (self.max_bytes and self._lru_bytes > self.max_bytes):
+            _, evicted = self._lru.popitem(last=False)
+            self._lru_bytes -= 0 if evicted is None else evicted.nbytes
+            self.evictions += 1
+
+    def stats(self):
+        """Memory-tier size and hit/miss/eviction counters."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._lru),
+                "bytes": self._lru_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+            }
+
+    def put(self, key, vec):
+        """Buffer `vec` (or None for a failure) under `key`."""
+        self.put_many([(key, vec)])
+
+    def put_many(self, items):
+        with self._lock:
+            for key, vec in items:
+                self._pending[key] = self._encode(vec)
+                self._remember(key, self._decode(self._pending[key]))
+            full = len(self._pending) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered entries in a single transaction."""
+        with self._lock:
+            if not self._pending:
+                return
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+                                 list(self._pending.items()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._pending.clear()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _migrate_json(self, json_path):
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Could not read legacy cache {json_path}: {e}")
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            # OR IGNORE: entries written since (or by a concurrent migration) win
+            conn.executemany("INSERT OR IGNORE INTO embeddings (key, vec) VALUES (?, ?)",
+                             ((k, self._encode(v) if v else None) for k, v in legacy.items()))
+            conn.execute("COMMIT")
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except FileNotFoundError:
+            pass  # another process finished the migration first
+        print(f"✅ Migrated {len(legacy)} cached embeddings from {json_path} to {self.path}")
+
+
+# Seconds a failed fetch is not retried, per failure reason. Repeated
+# failures of the same key double the TTL (up to NEGATIVE_MAX_TTL).
+NEGATIVE_TTLS = {
+    "timeout": 10 * 60,            # transient: slow host, network blip
+    "server_error": 30 * 60,       # 5xx / 429
+    "error": 60 * 60,              # anything unclassified
+    "client_error": 24 * 3600,     # other 4xx (403, ...)
+    "bad_image": 7 * 24 * 3600,    # not decodable as an image
+    "not_found": 7 * 24 * 3600,    # 404 / 410
+    "too_large": 30 * 24 * 3600,   # over the download size cap
+}
+NEGATIVE_MAX_TTL = 30 * 24 * 3600
+
+
+class NegativeCache:
+    """
+    Failed fetches with an expiry, kept apart from the embeddings so that a
+    transient failure is retried once its TTL has passed instead of being
+    cached as "no embedding" forever. Shares the SQLite file of the
+    embedding cache (table `failures`).
+    """
+
+    def __init__(self, path, ttls=None, max_ttl=NEGATIVE_MAX_TTL):
+        self.path = path
+        self.ttls = {**NEGATIVE_TTLS, **(ttls or {})}
+        self.max_ttl = max_ttl
+        self._lock = threading.Lock()
+        self._conn_pid = None
+        self._conn = None
+        self.skipped = self.recorded = 0
+
+    def _connection(self):
+        # One connection per process: a connection inherited across fork() must not be reused
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS failures (key TEXT PRIMARY KEY, reason TEXT, "
+                         "attempts INTEGER, retry_at REAL) WITHOUT ROWID")
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def blocked(self, keys, now=None):
+        """{key: reason} for the keys whose last failure has not expired yet."""
+        now = time.time() if now is None else now
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = conn.execute(f"SELECT key, reason FROM failures WHERE retry_at > ? "
+                                    f"AND key IN ({','.join('?' * len(chunk))})", [now, *chunk])
+                found.update(rows)
+            self.skipped += len(found)
+        return found
+
+    def record(self, key, reason, now=None):
+        """Remember a failure; each consecutive failure of `key` doubles its TTL."""
+        now = time.time() if now is None else now
+        ttl = self.ttls.get(reason, self.ttls["error"])
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO failures (key, reason, attempts, retry_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(key) DO UPDATE SET reason = excluded.reason, attempts = attempts + 1, "
+                "retry_at = ? + min(? * (1 << min(attempts, 20)), ?)",
+                (key, reason, now + ttl, now, ttl, self.max_ttl))
+            self.recorded += 1
+
+    def forget(self, key):
+        """Drop the failure history of `key` (after a successful fetch), resetting its TTL backoff."""
+        with self._lock:
+            self._connection().execute("DELETE FROM failures WHERE key = ?", (key,))
+
+    def stats(self):
+        with self._lock:
+            return {"skipped": self.skipped, "recorded": self.recorded}
@@ -1,125 +1,614 @@
 import faiss
 import numpy as np
-import json
 import os
-from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+import time
+from collections import namedtuple
 
-from matching_engine.text_matcher import embed_text
-from matching_engine.image_matcher import embed_images_batch
-from matching_engine.structured_matcher import price_similarity_sale_to_rental, rooms_similarity, location_similarity
+from matching_engine import image_matcher, text_matcher
+from matching_engine.bundle import BUNDLES_DIR, IndexBundle, bundle_path, current_version, is_published_version
+from matching_engine.index_factory import FUSED_WEIGHTS, IMAGE_WEIGHT, TEXT_WEIGHT, fuse_vectors, search_params
+from matching_engine.text_matcher import embed_text, cache_stats as text_cache_stats
+from matching_engine.image_matcher import embed_images_batch, cache_stats as image_cache_stats, dedup_stats, \
+    negative_cache_stats
+from matching_engine.rental_store import RentalStore, STORE_DIR, convert_legacy_meta
+from matching_engine.structured_matcher import parse_coords, structured_similarity_batch
 
-DATA_META = os.path.join("data", "rentals_meta.json")
+# Pre-bundle layout, still loaded when data/bundles/CURRENT does not exist
+DATA_META = os.path.join("data", "rentals_meta.json")  # legacy JSON metadata, converted on first load
 FAISS_TEXT_PATH = os.path.join("data", "faiss_text.index")
 FAISS_IMAGE_PATH = os.path.join("data", "faiss_image.index")
 
-_text_index = None
-_image_index = None
-_rentals_meta = None
-
-def load_indexes():
-    global _text_index, _image_index, _rentals_meta
-    if _text_index is None:
-        _text_index = faiss.read_index(FAISS_TEXT_PATH)
-    if _image_index is None:
-        _image_index = faiss.read_index(FAISS_IMAGE_PATH)
-    if _rentals_meta is None:
-        with open(DATA_META, "r", encoding="utf-8") as f:
-            _rentals_meta = json.load(f)
-
-def search_text_topk(sale_desc, top_k=150):
-    emb = embed_text(sale_desc).astype("float32").flatten()
+# Memory-map both FAISS indexes read-only so that gunicorn/uvicorn workers
+# on one box share page-cache pages instead of holding N private copies.
+MMAP_INDEXES = os.getenv("MATCHING_MMAP_INDEXES", "0").lower() in ("1", "true", "yes")
+
+# The active IndexBundle (both FAISS indexes + RentalStore). Requests read it
+# once and use that object throughout, so reload_indexes can swap in a new
+# bundle while in-flight requests finish on the old one.
+_bundle = None
+_bundle_lock = threading.Lock()
+
+def _load_bundle(version=None, mmap=None):
+    mmap = MMAP_INDEXES if mmap is None else mmap
+    version = version or current_version(BUNDLES_DIR)
+    if version:
+        return IndexBundle.load(bundle_path(version, BUNDLES_DIR), mmap=mmap)
+
+    # Legacy flat data/ layout
+    if not RentalStore.exists(STORE_DIR) and os.path.exists(DATA_META):
+        print(f"🔄 Converting legacy {DATA_META} -> {STORE_DIR}")
+        convert_legacy_meta(DATA_META, STORE_DIR,
+                            faiss.read_index(FAISS_TEXT_PATH).d, faiss.read_index(FAISS_IMAGE_PATH).d)
+    return IndexBundle.from_files("legacy", FAISS_TEXT_PATH, FAISS_IMAGE_PATH, STORE_DIR, mmap)
+
+def load_indexes(mmap=None):
+    """Load the current bundle once; later calls are no-ops."""
+    global _bundle
+    if _bundle is None:
+        with _bundle_lock:
+            if _bundle is None:
+                _bundle = _load_bundle(mmap=mmap)
+    return _bundle
+
+def reload_indexes(version=None, mmap=None):
+    """
+    Load `version` (default: the bundle CURRENT points at) next to the active
+    one and swap it in. Requests already running keep the bundle they started
+    with. Returns the active version.
+    """
+    global _bundle
+    if version is not None and not is_published_version(version, BUNDLES_DIR):
+        raise ValueError(f"Unknown index bundle version: {version!r}")
+    new_bundle = _load_bundle(version, mmap)
+    with _bundle_lock:
+        old_version = _bundle.version if _bundle is not None else None
+        _bundle = new_bundle
+    print(f"🔁 Swapped index bundle {old_version} -> {new_bundle.version}")
+    return new_bundle.version
+
+def active_bundle():
+    return load_indexes()
+
+def index_memory_report():
+    """Per-index memory figures recorded when the active bundle was loaded."""
+    return dict(active_bundle().index_memory)
+
+def embedding_cache_stats():
+    """Memory-tier size and hit/miss/eviction counters of both embedding caches, plus image dedup hits and skipped failed fetches."""
+    return {"text": text_cache_stats(), "image": image_cache_stats(), "image_dedup": dedup_stats(),
+            "image_failures": negative_cache_stats()}
+
+def start_bundle_watcher(interval=10.0):
+    """
+    Poll data/bundles/CURRENT every `interval` seconds and reload when it
+    points at a new version. Runs in a daemon thread; returns the thread.
+    """
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                version = current_version(BUNDLES_DIR)
+                if version and version != active_bundle().version:
+                    reload_indexes(version)
+            except Exception as e:
+                print(f"❌ Bundle reload failed: {e}")
+
+    thread = threading.Thread(target=watch, name="bundle-watcher", daemon=True)
+    thread.start()
+    return thread
+
+# Per-request sale embeddings: normalised text vector, image centroid and
+# the (n, D) matrix of individual photo vectors (both None when no sale image
+# could be embedded). Computed once by _embed_sale and shared by candidate
+# search and scoring.
+SaleEmbedding = namedtuple("SaleEmbedding", ["text", "image", "image_vecs"], defaults=(None,))
+
+# Multi-vector image bundles (one index vector per rental photo) score a
+# rental by its best photo pairs: "max" takes the best (sale photo, rental
+# photo) similarity, "top<m>" (e.g. "top2") the mean of the m best pairs.
+IMAGE_AGGREGATE = os.environ.get("MATCHING_IMAGE_AGGREGATE", "max")
+SALE_IMAGE_LIMIT = 3
+
+# Weights of the final score: 0.45 text + 0.35 image (TEXT_WEIGHT / IMAGE_WEIGHT,
+# defined with the fused vectors in index_factory) + 0.2 structured similarity
+STRUCTURED_WEIGHT = 0.2
+
+# Bundles built with --fused-index carry one index over the weighted
+# text+image concatenation (index_factory.fuse_vectors): a single search
+# returns candidates ordered by the combined semantic score. Sales without an
+# embedded image still take the text + image search union.
+FUSED_SEARCH = os.environ.get("MATCHING_FUSED_SEARCH", "1") == "1"
+
+# Bundles built with --shard-index hold per-market shards (see shards.py). A
+# sale searches its market's shard, fans out to up to SHARD_FANOUT neighbouring
+# shards (ShardMap.neighbours) while it has fewer than SHARD_MIN_CANDIDATES
+# candidates, and falls back to the global indexes.
+SHARD_ROUTING = os.environ.get("MATCHING_SHARD_ROUTING", "1") == "1"
+SHARD_FANOUT = int(os.environ.get("MATCHING_SHARD_FANOUT", "2"))
+SHARD_MIN_CANDIDATES = int(os.environ.get("MATCHING_SHARD_MIN_CANDIDATES", "50"))
+
+# Pre-filters passing less than this share of the live rentals skip the
+# ANN searches: their rows are scored exactly (see _exact_candidates), since
+# an IVF probe or HNSW walk would mostly visit filtered-out vectors. Less
+# selective filters search with nprobe / efSearch scaled by 1/selectivity
+# (index_factory.search_params).
+EXACT_FILTER_FRACTION = float(os.environ.get("MATCHING_EXACT_FILTER_FRACTION", "0.05"))
+
+# Background warm-up of the embedding models (see warm_up / readiness)
+_warmup = {"thread": None, "started": None, "finished": None, "error": None}
+
+def warm_up(background=True):
+    """
+    Load the index bundle and both embedding models ahead of the first
+    request. Until then they load lazily on the first cache miss. With
+    background=True this runs in a daemon thread (returned) so the process
+    can accept traffic meanwhile; readiness() reports when it is done.
+    """
+    def run():
+        _warmup["started"] = time.time()
+        try:
+            load_indexes()
+            text_matcher._get_model()
+            image_matcher._get_model()
+        except Exception as e:
+            _warmup["error"] = f"{type(e).__name__}: {e}"
+            print(f"❌ Warm-up failed: {e}")
+        finally:
+            _warmup["finished"] = time.time()
+        if _warmup["error"] is None:
+            print(f"✅ Warm-up done in {_warmup['finished'] - _warmup['started']:.1f}s")
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    _warmup["thread"] = thread
+    thread.start()
+    return thread
+
+def set_worker_threads(threads):
+    """
+    Cap torch, ONNX Runtime and FAISS intra-op threads in this process, e.g. in each
+    pre-forked worker so N workers do not oversubscribe the CPU. If torch is
+    not imported yet, OMP_NUM_THREADS is set for when it is.
+    """
+    threads = max(1, int(threads))
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(threads)
+    else:
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+    # ONNX sessions are created per process on first use and read this then
+    os.environ.setdefault("MATCHING_ONNX_THREADS", str(threads))
+    faiss.omp_set_num_threads(threads)
+
+def readiness():
+    """
+    {"ready": bool, ...}: the index bundle is loaded and, if warm_up was
+    started, it finished without error. Also reports which models are loaded.
+    """
+    started, finished = _warmup["started"], _warmup["finished"]
+    status = {
+        "bundle": _bundle.version if _bundle is not None else None,
+        "text_model": text_matcher.model_loaded(),
+        "image_model": image_matcher.model_loaded(),
+        "warming_up": _warmup["thread"] is not None and finished is None,
+    }
+    status["ready"] = status["bundle"] is not None and not status["warming_up"] and _warmup["error"] is None
+    if _warmup["error"]:
+        status["error"] = _warmup["error"]
+    if started and finished:
+        status["warmup_seconds"] = round(finished - started, 2)
+    return status
+
+def _search_topk(index, store, query, top_k, row_filter=None):
+    return _search_topk_many(index, store, query.reshape(1, -1), top_k, row_filter)[0]
+
+def _search_topk_many(index, store, queries, top_k, row_filter=None):
+    """
+    One multi-row FAISS search; returns a [(row, score), ...] list per query
+    row. FAISS returns stable rental ids, which the store maps to live rows;
+    deleted rentals and -1 padding (fewer than top_k hits) are dropped. With
+    a RowFilter only the rentals passing it are searched.
+    """
+    params = search_params(index, row_filter.selector(), top_k, row_filter.fraction) if row_filter is not None \
+        else None
+    D, I = index.search(np.ascontiguousarray(queries, dtype="float32"), top_k, params=params)
+    rows = store.rows_for_ids(I)
+    return [[(r, d) for r, d in zip(rr, scores) if r >= 0] for rr, scores in zip(rows.tolist(), D.tolist())]
+
+def _search_photos_many(bundle, sale_embs, top_k, row_filter=None):
+    """
+    Image candidates for a multi-vector bundle: all photo vectors of all
+    sales go through one FAISS search, hits are mapped from photo vectors to
+    rental rows, and each sale keeps its top_k rentals by best photo score.
+    Returns a [(row, score), ...] list per sale (empty without sale photos).
+    """
+    store = bundle.store
+    owners = [j for j, e in enumerate(sale_embs) if e.image_vecs is not None for _ in range(len(e.image_vecs))]
+    hits = [[] for _ in sale_embs]
+    if not owners:
+        return hits
+
+    # Over-fetch photo vectors so that top_k distinct rentals survive the grouping
+    per_rental = max(1, int(np.ceil(len(store.image_vecs) / max(len(store.live_rows), 1))))
+    k = min(top_k * per_rental, bundle.image_index.ntotal)
+    queries = np.vstack([e.image_vecs for e in sale_embs if e.image_vecs is not None])
+    params = search_params(bundle.image_index, row_filter.selector("photo"), k, row_filter.fraction) \
+        if row_filter is not None else None
+    D, I = bundle.image_index.search(np.ascontiguousarray(queries, dtype="float32"), k, params=params)
+    rows = store.rows_for_vectors(I)
+
+    owners = np.asarray(owners)
+    for j in np.unique(owners).tolist():
+        r, d = rows[owners == j].ravel(), D[owners == j].ravel()
+        keep = r >= 0
+        r, d = r[keep], d[keep]
+        order = np.argsort(-d, kind="stable")
+        best = {}
+        for row, score in zip(r[order].tolist(), d[order].tolist()):
+            if row not in best:
+                best[row] = score
+                if len(best) >= top_k:
+                    break
+        hits[j] = list(best.items())
+    return hits
+
+def _aggregate_photo_scores(store, rows, sale_vecs, aggregate=None):
+    """
+    Image similarity of each rental row to the sale photos in a multi-vector
+    store, aggregated over all (rental photo, sale photo) pairs; 0 for
+    rentals without photo vectors.
+    """
+    aggregate = aggregate or IMAGE_AGGREGATE
+    off = store.image_vec_offsets
+    counts = off[rows + 1] - off[rows]
+    scores = np.zeros(len(rows), dtype=np.float64)
+    if counts.sum() == 0:
+        return scores
+
+    seg = np.repeat(np.arange(len(rows)), counts)
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    sims = store.image_vecs[off[rows][seg] + within] @ np.asarray(sale_vecs, dtype="float32").T
+
+    padded = np.full((len(rows), counts.max(), sims.shape[1]), -np.inf, dtype=np.float64)
+    padded[seg, within] = sims
+    flat = padded.reshape(len(rows), -1)
+    if aggregate == "max":
+        best = flat.max(axis=1)
+    elif aggregate.startswith("top"):
+        top = -np.sort(-flat, axis=1)[:, :int(aggregate[3:])]
+        valid = np.isfinite(top)
+        best = np.where(valid, top, 0.0).sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+    else:
+        raise ValueError(f"Unknown image aggregation '{aggregate}', expected 'max' or 'top<m>'")
+    has_vecs = counts > 0
+    scores[has_vecs] = best[has_vecs]
+    return scores
+
+def _normalize(emb):
+    emb = emb.astype("float32").flatten()
     emb /= (np.linalg.norm(emb) + 1e-10)
-    D, I = _text_index.search(emb.reshape(1, -1), top_k)
-    return list(zip(I[0].tolist(), D[0].tolist()))
+    return emb
+
+def _embed_sale_text(desc):
+    return _normalize(embed_text(desc))
 
-def search_image_topk_from_urls(img_urls, top_k=150):
-    emb_list = embed_images_batch(img_urls[:3])
+def _image_centroid(emb_list):
     emb_list = [e for e in emb_list if e is not None]
     if not emb_list:
-        return []
+        return None
     avg = np.mean(emb_list, axis=0)
     avg /= (np.linalg.norm(avg) + 1e-10)
-    D, I = _image_index.search(avg.reshape(1, -1), top_k)
-    return list(zip(I[0].tolist(), D[0].tolist()))
+    return avg
+
+def _photo_vectors(emb_list):
+    emb_list = [e for e in emb_list if e is not None]
+    return np.vstack([_normalize(e) for e in emb_list]) if emb_list else None
 
 def _embed_sale(sale):
-    text_emb = embed_text(sale.get("desc", "")).astype("float32").flatten()
-    text_emb /= (np.linalg.norm(text_emb) + 1e-10)
+    image_embs = embed_images_batch(sale.get("images", [])[:SALE_IMAGE_LIMIT])
+    return SaleEmbedding(_embed_sale_text(sale.get("desc", "")),
+                         _image_centroid(image_embs), _photo_vectors(image_embs))
 
-    image_embs = embed_images_batch(sale.get("images", [])[:3])
-    image_embs = [e for e in image_embs if e is not None]
-    image_avg = np.mean(image_embs, axis=0) if image_embs else None
-    if image_avg is not None:
-        image_avg /= (np.linalg.norm(image_avg) + 1e-10)
+def _embed_sales(sales):
+    """Batch version of _embed_sale: one text encode and one image batch for all sales."""
+    text_embs = embed_text([s.get("desc", "") for s in sales])
+    image_urls = [s.get("images", [])[:SALE_IMAGE_LIMIT] for s in sales]
+    flat_embs = embed_images_batch([u for urls in image_urls for u in urls])
 
-    return text_emb, image_avg
+    embs, pos = [], 0
+    for text_emb, urls in zip(text_embs, image_urls):
+        image_embs = flat_embs[pos:pos + len(urls)]
+        embs.append(SaleEmbedding(_normalize(text_emb), _image_centroid(image_embs), _photo_vectors(image_embs)))
+        pos += len(urls)
+    return embs
 
-def compute_final_scores(sale, candidate_idxs):
-    sale_price = sale.get("price")
-    sale_rooms = sale.get("rooms")
-    sale_location = sale.get("location")
-    sale_text_emb, sale_image_avg = _embed_sale(sale)
+def search_text_topk(sale_desc, top_k=150, filters=None):
+    bundle = active_bundle()
+    return _search_topk(bundle.text_index, bundle.store, _embed_sale_text(sale_desc), top_k,
+                        bundle.store.row_filter(filters))
 
-    results = []
-    for idx in candidate_idxs:
-        meta = _rentals_meta[idx]
-        rental_text_emb = np.array(meta.get("text_emb"), dtype="float32").reshape(-1)
-        rental_text_emb /= (np.linalg.norm(rental_text_emb) + 1e-10)
-        text_score = float(np.dot(sale_text_emb, rental_text_emb)) * 100.0
-
-        image_score = 0.0
-        if sale_image_avg is not None and meta.get("image_emb"):
-            rental_image_emb = np.array(meta["image_emb"], dtype="float32").reshape(-1)
-            rental_image_emb /= (np.linalg.norm(rental_image_emb) + 1e-10)
-            image_score = float(np.dot(sale_image_avg, rental_image_emb)) * 100.0
-
-        structured_score = round(
-            (price_similarity_sale_to_rental(sale_price, meta.get("price")) +
-             rooms_similarity(sale_rooms, meta.get("rooms")) +
-             location_similarity(sale_location, meta.get("location"))) / 3.0, 2
-        )
-
-        final = round(0.45 * text_score + 0.35 * image_score + 0.2 * structured_score, 2)
-
-        results.append({
-            "rental_index": idx,
-            "platform": meta.get("platform"),
-            "url": meta.get("url"),
-            "title": meta.get("title"),
-            "text_similarity": round(text_score, 2),
-            "image_similarity": round(image_score, 2),
-            "structured_similarity": structured_score,
-            "final_score": final,
-            "image": meta.get("images")[0] if meta.get("images") else "https://via.placeholder.com/400x250"
-        })
-
-    return sorted(results, key=lambda x: x["final_score"], reverse=True)
-
-def match_sale_to_rentals(sale: dict, top_k_text=120, top_k_image=120, final_candidate_limit=200):
-    load_indexes()
-    text_hits = [i for i, _ in search_text_topk(sale.get("desc", ""), top_k=top_k_text)]
-    image_hits = [i for i, _ in search_image_topk_from_urls(sale.get("images", []), top_k=top_k_image)]
+def search_image_topk_from_urls(img_urls, top_k=150, filters=None):
+    image_embs = embed_images_batch(img_urls[:SALE_IMAGE_LIMIT])
+    avg = _image_centroid(image_embs)
+    if avg is None:
+        return []
+    bundle = active_bundle()
+    row_filter = bundle.store.row_filter(filters)
+    if bundle.store.image_vecs is not None:
+        return _search_photos_many(bundle, [SaleEmbedding(None, avg, _photo_vectors(image_embs))], top_k,
+                                   row_filter)[0]
+    return _search_topk(bundle.image_index, bundle.store, avg, top_k, row_filter)
+
+def _search_images_many(bundle, sale_embs, top_k, row_filter=None):
+    """Image candidates per sale: photo-vector search or one centroid query per sale."""
+    if bundle.store.image_vecs is not None:
+        return _search_photos_many(bundle, sale_embs, top_k, row_filter)
+    hits = [[] for _ in sale_embs]
+    with_images = [j for j, e in enumerate(sale_embs) if e.image is not None]
+    if with_images:
+        found = _search_topk_many(bundle.image_index, bundle.store,
+                                  np.vstack([sale_embs[j].image for j in with_images]), top_k, row_filter)
+        for j, h in zip(with_images, found):
+            hits[j] = h
+    return hits
+
+def _score_candidates(bundle, sale, candidate_idxs, sale_emb=None):
+    """
+    Score candidate rows without materialising rental dicts. Returns
+    (rows, text, image, structured, final) arrays sorted by final score,
+    best first.
+    """
+    sale_emb = sale_emb if sale_emb is not None else _embed_sale(sale)
+    sale_text_emb, sale_image_avg = sale_emb.text, sale_emb.image
+    store = bundle.store
+
+    # One gathered matrix-vector product per modality over all candidates.
+    rows = np.asarray(candidate_idxs, dtype=np.int64)
+    text_scores = (store.text_embs[rows] @ sale_text_emb).astype(np.float64) * 100.0
+    if store.image_vecs is not None and sale_emb.image_vecs is not None:
+        image_scores = _aggregate_photo_scores(store, rows, sale_emb.image_vecs) * 100.0
+    elif sale_image_avg is not None:
+        image_scores = (store.image_embs[rows] @ sale_image_avg).astype(np.float64) * 100.0
+        image_scores[~store.has_image[rows]] = 0.0
+    else:
+        image_scores = np.zeros(len(rows), dtype=np.float64)
+    structured_scores = structured_similarity_batch(sale, store.columns, rows)
+
+    final_scores = np.array([
+        round(TEXT_WEIGHT * t + IMAGE_WEIGHT * i + STRUCTURED_WEIGHT * s, 2)
+        for t, i, s in zip(text_scores.tolist(), image_scores.tolist(), structured_scores.tolist())
+    ])
+    order = np.argsort(-final_scores, kind="stable")
+    return rows[order], text_scores[order], image_scores[order], structured_scores[order], final_scores[order]
+
+def _result_dict(bundle, row, text_score, image_score, structured_score, final):
+    # rental_id is the stable id (same rental, same id across bundles);
+    # rental_index is the store row and only valid within this bundle version
+    meta = bundle.store.record(row)
+    return {
+        "rental_id": int(bundle.store.ids[row]),
+        "rental_index": row,
+        "platform": meta.get("platform"),
+        "url": meta.get("url"),
+        "title": meta.get("title"),
+        "text_similarity": round(text_score, 2),
+        "image_similarity": round(image_score, 2),
+        "structured_similarity": structured_score,
+        "final_score": final,
+        "image": meta.get("images")[0] if meta.get("images") else "https://via.placeholder.com/400x250"
+    }
+
+def _iter_results(bundle, scored):
+    for fields in zip(*(a.tolist() for a in scored)):
+        yield _result_dict(bundle, *fields)
+
+def compute_final_scores(sale, candidate_idxs, sale_emb=None):
+    bundle = active_bundle()
+    return list(_iter_results(bundle, _score_candidates(bundle, sale, candidate_idxs, sale_emb)))
+
+def match_sale_to_rentals(sale: dict, top_k_text=120, top_k_image=120, final_candidate_limit=200, filters=None):
+    """
+    Ranked rental matches for one sale listing. `filters` are optional hard
+    pre-filters (city, min_rooms, max_rooms, min_price, max_price; see
+    structured_matcher.FILTER_KEYS) applied inside the candidate searches.
+    """
+    bundle = active_bundle()
+    return list(_iter_results(bundle, _match_scored(bundle, sale, top_k_text, top_k_image, final_candidate_limit,
+                                                    filters)))
+
+def _match_scored(bundle, sale, top_k_text=120, top_k_image=120, final_candidate_limit=200, filters=None):
+    sale_emb = _embed_sale(sale)
+    candidates = _candidates_many(bundle, [sale_emb], top_k_text, top_k_image, final_candidate_limit,
+                                  bundle.store.row_filter(filters), [sale])[0]
+    return _score_candidates(bundle, sale, candidates, sale_emb)
+
+def _fused_query(bundle, sale_emb):
+    """The sale's query vector for the fused index, with the weights the bundle was built with."""
+    weights = bundle.manifest.get("fused_weights", FUSED_WEIGHTS)
+    return fuse_vectors(sale_emb.text, sale_emb.image, weights)[0]
+
+def _candidates_many(bundle, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter=None,
+                     sales=None):
+    """
+    Candidate rows per sale. Sales with an image embedding use one fused
+    search of final_candidate_limit when the bundle has a fused index; the
+    rest merge a text and an image search. With a RowFilter the searches only
+    visit the rentals passing it; when no more than final_candidate_limit
+    pass, they are all candidates and nothing is searched, and when fewer
+    than EXACT_FILTER_FRACTION of the rentals pass, they are scored exactly.
+    Sharded bundles route `sales` to their market shards (see
+    _routed_candidates).
+    """
+    if row_filter is not None and len(row_filter) <= final_candidate_limit:
+        return [row_filter.rows.tolist() for _ in sale_embs]
 
+    if row_filter is not None and row_filter.fraction < EXACT_FILTER_FRACTION:
+        candidates = _exact_candidates(bundle, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter)
+    elif sales is not None and SHARD_ROUTING and bundle.shards is not None:
+        candidates = _routed_candidates(bundle, sales, sale_embs, top_k_text, top_k_image, final_candidate_limit,
+                                        row_filter)
+    else:
+        candidates = _search_candidates(bundle, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter)
+    fallback = (bundle.store.live_rows if row_filter is None else row_filter.rows)[:200].tolist()
+    return [c or fallback for c in candidates]
+
+def _exact_candidates(bundle, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter):
+    """
+    _search_candidates without the indexes: gathered matrix products over the
+    rows passing `row_filter` rank them as exact (flat) searches would.
+    """
+    store, rows = bundle.store, row_filter.rows
+    text_sims = store.text_embs[rows] @ np.vstack([e.text for e in sale_embs]).T
+    fused = FUSED_SEARCH and bundle.fused_index is not None
+    weights = bundle.manifest.get("fused_weights", FUSED_WEIGHTS)
+    with_image = store.has_image[rows]
+
+    candidates = []
+    for j, e in enumerate(sale_embs):
+        if e.image is None:
+            image_top = []
+        elif fused:
+            # The fused index holds the centroid image rows (zero without photos)
+            fused_sims = weights[0] * text_sims[:, j] + weights[1] * (store.image_embs[rows] @ e.image)
+            candidates.append(_top_rows(rows, fused_sims, final_candidate_limit))
+            continue
+        elif store.image_vecs is not None and e.image_vecs is not None:
+            image_top = _top_rows(rows[with_image], _aggregate_photo_scores(store, rows[with_image], e.image_vecs,
+                                                                            "max"), top_k_image)
+        else:
+            image_top = _top_rows(rows[with_image], store.image_embs[rows[with_image]] @ e.image, top_k_image)
+        candidates.append(_merge_candidates(_top_rows(rows, text_sims[:, j], top_k_text), image_top,
+                                            final_candidate_limit))
+    return candidates
+
+def _top_rows(rows, scores, k):
+    return rows[np.argsort(-np.asarray(scores), kind="stable")[:k]].tolist()
+
+def _search_candidates(view, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter=None):
+    """Fused or text + image candidate searches of `view` (an IndexBundle or one of its shards)."""
+    fused = [j for j, e in enumerate(sale_embs) if e.image is not None] \
+        if FUSED_SEARCH and view.fused_index is not None else []
+    candidates = [None] * len(sale_embs)
+    if fused:
+        hits = _search_topk_many(view.fused_index, view.store,
+                                 np.vstack([_fused_query(view, sale_embs[j]) for j in fused]),
+                                 final_candidate_limit, row_filter)
+        for j, h in zip(fused, hits):
+            candidates[j] = _merge_candidates([i for i, _ in h], [], final_candidate_limit)
+
+    rest = [j for j in range(len(sale_embs)) if candidates[j] is None]
+    if rest:
+        embs = [sale_embs[j] for j in rest]
+        text_hits = _search_topk_many(view.text_index, view.store, np.vstack([e.text for e in embs]), top_k_text,
+                                      row_filter)
+        image_hits = _search_images_many(view, embs, top_k_image, row_filter)
+        for j, t_hits, i_hits in zip(rest, text_hits, image_hits):
+            candidates[j] = _merge_candidates([i for i, _ in t_hits], [i for i, _ in i_hits], final_candidate_limit)
+    return candidates
+
+def _routed_candidates(bundle, sales, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter=None):
+    """
+    Candidates in a sharded bundle. Each sale searches the shard of its
+    market, then up to SHARD_FANOUT neighbouring shards while it has fewer than
+    SHARD_MIN_CANDIDATES (at most final_candidate_limit) candidates. Sales
+    outside every market, or still short after the fan-out, search the
+    global indexes. Sales visiting the same shard share its searches.
+    """
+    shards = bundle.shards
+    needed = min(SHARD_MIN_CANDIDATES, final_candidate_limit)
+    plans = []
+    for sale, emb in zip(sales, sale_embs):
+        market = shards.route(sale.get("location"))
+        plans.append([] if market is None else
+                     [market] + shards.neighbours(market, emb.text, SHARD_FANOUT, parse_coords(sale.get("location"))))
+
+    candidates = [[] for _ in sales]
+    for step in range(SHARD_FANOUT + 1):
+        groups = {}
+        for j, plan in enumerate(plans):
+            if step < len(plan) and len(candidates[j]) < needed:
+                groups.setdefault(plan[step], []).append(j)
+        for market, group in groups.items():
+            found = _search_candidates(shards.shards[market], [sale_embs[j] for j in group], top_k_text,
+                                       top_k_image, final_candidate_limit, row_filter)
+            for j, rows in zip(group, found):
+                candidates[j] = _merge_candidates(candidates[j], rows, final_candidate_limit)
+
+    short = [j for j in range(len(sales)) if len(candidates[j]) < needed]
+    if short:
+        found = _search_candidates(bundle, [sale_embs[j] for j in short], top_k_text, top_k_image,
+                                   final_candidate_limit, row_filter)
+        for j, rows in zip(short, found):
+            candidates[j] = _merge_candidates(candidates[j], rows, final_candidate_limit)
+    return candidates
+
+def _merge_candidates(text_hits, image_hits, final_candidate_limit):
     seen, candidates = {}, []
     for i in text_hits + image_hits:
         if i not in seen and len(candidates) < final_candidate_limit:
             seen[i] = True
             candidates.append(i)
-    if not candidates:
-        candidates = list(range(min(200, len(_rentals_meta))))
+    return candidates
+
+def match_many(sales, top_k_text=120, top_k_image=120, final_candidate_limit=200, batch_size=64, filters=None):
+    """
+    Match many sale listings at once. Per chunk of `batch_size` sales, all
+    descriptions and images are embedded in batches and each modality gets one
+    multi-row FAISS search. `filters` apply to every sale. Returns one result
+    list per sale, as match_sale_to_rentals would.
+    """
+    bundle = active_bundle()
+    return [list(_iter_results(bundle, scored))
+            for scored in _match_many_scored(bundle, sales, top_k_text, top_k_image, final_candidate_limit, batch_size,
+                                             filters)]
 
-    return compute_final_scores(sale, candidates)
+def _match_many_scored(bundle, sales, top_k_text=120, top_k_image=120, final_candidate_limit=200, batch_size=64,
+                       filters=None):
+    row_filter = bundle.store.row_filter(filters)
+    results = []
+    for start in range(0, len(sales), batch_size):
+        chunk = sales[start:start + batch_size]
+        sale_embs = _embed_sales(chunk)
+        candidates = _candidates_many(bundle, sale_embs, top_k_text, top_k_image, final_candidate_limit, row_filter,
+                                      chunk)
+        for sale, sale_emb, rows in zip(chunk, sale_embs, candidates):
+            results.append(_score_candidates(bundle, sale, rows, sale_emb))
+    return results
 
 class MatchingEngine:
     def __init__(self):
         load_indexes()
 
-    def match_sale_to_rentals(self, sale_listing, top_k=5):
-        results = match_sale_to_rentals(sale_listing)
-        seen_urls = set()
-        unique_results = []
-        for r in results:
-            if r["url"] not in seen_urls:
-                unique_results.append(r)
-                seen_urls.add(r["url"])
-        return unique_results[:top_k]
+    def match_sale_to_rentals(self, sale_listing, top_k=5, filters=None):
+        bundle = active_bundle()
+        return _unique_by_url(_iter_results(bundle, _match_scored(bundle, sale_listing, filters=filters)), top_k)
+
+    def match_many(self, sales, top_k=5, filters=None):
+        """Batch counterpart of match_sale_to_rentals: one result list per sale listing."""
+        bundle = active_bundle()
+        return [_unique_by_url(_iter_results(bundle, scored), top_k)
+                for scored in _match_many_scored(bundle, sales, filters=filters)]
+
+    def reload(self, version=None):
+        """Swap in a newly published index bundle without dropping in-flight requests."""
+        return reload_indexes(version)
+
+    @property
+    def bundle_version(self):
+        return active_bundle().version
+
+def _unique_by_url(results, top_k):
+    """First top_k results with distinct URLs; `results` may be a lazy iterator."""
+    seen_urls = set()
+    unique_results = []
+    for r in results:
+        if len(unique_results) >= top_k:
+            break
+        if r["url"] not in seen_urls:
+            unique_results.append(r)
+            seen_urls.add(r["url"])
+    return unique_results
@@ -0,0 +1,147 @@
+# matching_engine/image_dedup.py
+import os
+import sqlite3
+import threading
+import numpy as np
+from PIL import Image
+
+# Perceptual-hash index of embedded images. Portals serve the same photo
+# under many URLs (CDN resizes, query-string variants); those decode to
+# near-identical thumbnails, so their 64-bit dHash differs in a few bits at
+# most and the embedding of the first copy can be reused instead of running
+# CLIP again.
+#
+# Near-duplicate lookup uses multi-index hashing: the hash is split into
+# 4 bands of 16 bits, each indexed in SQLite. Two hashes within Hamming
+# distance 3 share at least one band exactly, so a lookup only compares the
+# rows sharing a band. Matches must also agree on the mean colour, since
+# dHash only sees luminance structure.
+BANDS = 4
+BAND_BITS = 64 // BANDS
+MAX_DISTANCE = min(int(os.environ.get("MATCHING_PHASH_MAX_DISTANCE", "3")), BANDS - 1)
+MAX_COLOR_DIFF = 16
+# Near-uniform images (blank placeholders, solid colours) have almost no set
+# or unset bits and would all collide; they are never deduplicated.
+MIN_BITS = 8
+# The same goes for single bands: flat regions (sky, walls, letterboxing)
+# give many unrelated photos a band with at most UNIFORM_BAND_BITS set or
+# unset bits, and those buckets are not looked up. Every other bucket yields
+# at most MAX_BUCKET_CANDIDATES rows, so a lookup compares no more than
+# BANDS * MAX_BUCKET_CANDIDATES hashes. Either limit can only miss a reuse
+# (one more CLIP run), never return a wrong one.
+UNIFORM_BAND_BITS = 2
+MAX_BUCKET_CANDIDATES = int(os.environ.get("MATCHING_PHASH_BUCKET_LIMIT", "64"))
+
+
+def dhash(img):
+    """64-bit difference hash of a PIL image (9x8 greyscale gradient signs)."""
+    px = np.asarray(img.convert("L").resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def mean_color(img):
+    """Mean RGB packed into one int (0xRRGGBB)."""
+    r, g, b = np.asarray(img.convert("RGB").resize((8, 8), Image.Resampling.BILINEAR),
+                         dtype=np.float32).reshape(-1, 3).mean(axis=0).round().astype(int)
+    return (int(r) << 16) | (int(g) << 8) | int(b)
+
+
+def _bands(h):
+    return [(h >> (BAND_BITS * i)) & ((1 << BAND_BITS) - 1) for i in range(BANDS)]
+
+
+def _signed(h):
+    # SQLite integers are signed 64-bit
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+def _colors_close(a, b):
+    return all(abs(((a >> s) & 0xFF) - ((b >> s) & 0xFF)) <= MAX_COLOR_DIFF for s in (16, 8, 0))
+
+
+def is_near_duplicate(a, b, max_distance=MAX_DISTANCE):
+    """True if fingerprints `a` and `b` (see PerceptualHashIndex.fingerprint) match."""
+    return bin(a[0] ^ b[0]).count("1") <= max_distance and _colors_close(a[1], b[1])
+
+
+class PerceptualHashIndex:
+    """dHash -> embedding cache key, persisted in SQLite next to the embedding cache."""
+
+    def __init__(self, path, max_distance=MAX_DISTANCE):
+        self.path = path
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self.lookups = self.hits = self.skipped = self.examined = 0
+
+    def _connection(self):
+        # One connection per process: a connection inherited across fork() must not be reused
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS phash (key TEXT PRIMARY KEY, hash INTEGER, color INTEGER, "
+                         + ", ".join(f"b{i} INTEGER" for i in range(BANDS)) + ")")
+            for i in range(BANDS):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS phash_b{i} ON phash (b{i})")
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    @staticmethod
+    def fingerprint(img):
+        """(dhash, mean colour) of a decoded image, or None if it is too uniform to match safely."""
+        h = dhash(img)
+        if not MIN_BITS <= bin(h).count("1") <= 64 - MIN_BITS:
+            return None
+        return h, mean_color(img)
+
+    def find(self, fp):
+        """Cache key of a stored near-duplicate of fingerprint `fp`, or None."""
+        with self._lock:
+            if fp is None:
+                self.skipped += 1
+                return None
+            self.lookups += 1
+            h, color = fp
+            bands = [(i, b) for i, b in enumerate(_bands(h))
+                     if UNIFORM_BAND_BITS < bin(b).count("1") < BAND_BITS - UNIFORM_BAND_BITS]
+            if not bands:
+                return None
+            rows = self._connection().execute(
+                " UNION ALL ".join(f"SELECT * FROM (SELECT key, hash, color FROM phash WHERE b{i} = ? LIMIT ?)"
+                                   for i, _ in bands),
+                [v for _, b in bands for v in (b, MAX_BUCKET_CANDIDATES)]).fetchall()
+            self.examined += len(rows)
+            best = None
+            for key, other, other_color in rows:
+                dist = bin(h ^ (other & ((1 << 64) - 1))).count("1")
+                if dist <= self.max_distance and _colors_close(color, other_color) and \
+                        (best is None or dist < best[0]):
+                    best = (dist, key)
+            return best[1] if best is not None else None
+
+    def count_hit(self):
+        """Count an image whose embedding was reused instead of computed."""
+        with self._lock:
+            self.hits += 1
+
+    def add_many(self, items):
+        """Register [(cache key, fingerprint), ...] of freshly embedded images in one transaction."""
+        items = [(key, fp) for key, fp in items if fp is not None]
+        if not items:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO phash VALUES (?, ?, ?, {', '.join('?' * BANDS)})",
+                [(key, _signed(h), color, *_bands(h)) for key, (h, color) in items])
+            conn.execute("COMMIT")
+
+    def stats(self):
+        with self._lock:
+            return {"lookups": self.lookups, "hits": self.hits, "skipped_uniform": self.skipped,
+                    "candidates_examined": self.examined,
+                    "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else None}
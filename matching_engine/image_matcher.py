@@ -1,66 +1,276 @@
 import os
-import json
 import hashlib
 import requests
 import numpy as np
 from PIL import Image
 from io import BytesIO
-import torch
-from sentence_transformers import SentenceTransformer
+import queue
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+
+from matching_engine.embedding_cache import EmbeddingCache, NegativeCache
+from matching_engine.image_dedup import PerceptualHashIndex, is_near_duplicate
 
 IMAGE_MODEL_NAME = "clip-ViT-B-32"
+# Loaded on first use (or by engine.warm_up); torch is only imported then.
 _image_model = None
-CACHE_FILE = os.path.join("data", "image_embedding_cache.json")
+_model_lock = threading.Lock()
+# "cpu" / "cuda"; default: cuda if available. Pre-forked servers must use cpu
+# (a CUDA context does not survive fork).
+MODEL_DEVICE = os.environ.get("MATCHING_MODEL_DEVICE")
+# torch (SentenceTransformer), onnx or onnx-int8 (CLIP vision tower on ONNX
+# Runtime, CPU only; see onnx_encoder)
+IMAGE_BACKEND = os.environ.get("MATCHING_IMAGE_BACKEND", "torch")
+CACHE_FILE = os.path.join("data", "image_embedding_cache.sqlite")
+LEGACY_CACHE_FILE = os.path.join("data", "image_embedding_cache.json")
 
 # ---------------- Cache ----------------
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, "r", encoding="utf-8") as f:
-        _cache = json.load(f)
-else:
-    _cache = {}
+# Failed fetches live in the negative cache with a per-reason TTL; None
+# entries left in the embedding cache by older versions are ignored, so those
+# URLs get retried.
+_cache = EmbeddingCache(CACHE_FILE, legacy_json=LEGACY_CACHE_FILE)
+_negative = NegativeCache(CACHE_FILE)
+
+# Near-duplicate photos under different URLs reuse one embedding (see image_dedup)
+DEDUP = os.environ.get("MATCHING_IMAGE_DEDUP", "1") == "1"
+_phash = PerceptualHashIndex(os.path.join("data", "image_phash.sqlite"))
+
+def cache_stats():
+    """Hit/miss/eviction counters of the image embedding cache."""
+    return _cache.stats()
+
+def dedup_stats():
+    """Perceptual-hash lookups and reused embeddings in this process."""
+    return _phash.stats()
+
+def negative_cache_stats():
+    """Fetches skipped because of an unexpired failure, and failures recorded, in this process."""
+    return _negative.stats()
+
+def _cached_embeddings(keys):
+    """Cached embeddings by key, without the None failure markers of older caches."""
+    return {k: v for k, v in _cache.get_many(keys).items() if v is not None}
+
+def _reuse_duplicates(items):
+    """
+    Split freshly decoded [(url, img)] into images that still need CLIP and
+    near-duplicates of already embedded ones. Returns (unique [(url, img, fp)],
+    reused {url: embedding}, aliases {url: url of its twin in unique}).
+    """
+    unique, reused, aliases = [], {}, {}
+    for url, img in items:
+        fp = _phash.fingerprint(img) if DEDUP else None
+        if fp is not None:
+            key = _phash.find(fp)
+            emb = _cache.get(key, None) if key is not None else None
+            if emb is not None:
+                _phash.count_hit()
+                reused[url] = emb
+                continue
+            twin = next((u for u, _, f in unique if f is not None and is_near_duplicate(fp, f)), None)
+            if twin is not None:
+                _phash.count_hit()
+                aliases[url] = twin
+                continue
+        unique.append((url, img, fp))
+    return unique, reused, aliases
+
+def _store_embeddings(embedded, unique, reused, aliases):
+    """Cache new and reused embeddings and register the new images' fingerprints."""
+    for url, emb in reused.items():
+        embedded[url] = emb
+    for url, twin in aliases.items():
+        embedded[url] = embedded.get(twin)
+    for url, emb in embedded.items():
+        if emb is not None:
+            _cache.put(_hash_url(url), emb)
+    _phash.add_many([(_hash_url(url), fp) for url, _, fp in unique if embedded.get(url) is not None])
+
+# ---------------- Downloads ----------------
+# Batches download over one pooled session (keep-alive, reused TLS connections)
+# on a shared thread pool; each worker also decodes its image, so decoding
+# overlaps the other downloads. A batch waits at most BATCH_DEADLINE seconds.
+DOWNLOAD_WORKERS = int(os.environ.get("MATCHING_IMAGE_DOWNLOAD_WORKERS", "8"))
+BATCH_DEADLINE = float(os.environ.get("MATCHING_IMAGE_BATCH_DEADLINE", "8"))
+
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
+_session.mount("https://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
+_download_pool = None
+_download_pool_lock = threading.Lock()
+
+def _get_download_pool():
+    global _download_pool
+    with _download_pool_lock:
+        if _download_pool is None:
+            _download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="image-dl")
+    return _download_pool
 
 def _get_model():
-    """Lazy load the model with GPU if available."""
+    """Lazy load the model with GPU if available; concurrent callers wait for the same load."""
     global _image_model
-    if _image_model is None:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"🔄 Loading CLIP model on {device}...")
-        _image_model = SentenceTransformer(IMAGE_MODEL_NAME, device=device)
-        print("✅ CLIP model loaded")
+    if _image_model is not None:
+        return _image_model
+    with _model_lock:
+        if _image_model is None:
+            if IMAGE_BACKEND in ("onnx", "onnx-int8"):
+                from matching_engine.onnx_encoder import OnnxClipVisionEncoder
+                print(f"🔄 Loading CLIP vision tower ({IMAGE_BACKEND})...")
+                _image_model = OnnxClipVisionEncoder(IMAGE_MODEL_NAME, quantize=IMAGE_BACKEND == "onnx-int8")
+            elif IMAGE_BACKEND == "torch":
+                import torch
+                from sentence_transformers import SentenceTransformer
+                device = MODEL_DEVICE or ("cuda" if torch.cuda.is_available() else "cpu")
+                print(f"🔄 Loading CLIP model on {device}...")
+                _image_model = SentenceTransformer(IMAGE_MODEL_NAME, device=device)
+            else:
+                raise ValueError(f"Unknown MATCHING_IMAGE_BACKEND {IMAGE_BACKEND!r} (torch, onnx, onnx-int8)")
+            print("✅ CLIP model loaded")
     return _image_model
 
+def model_loaded():
+    return _image_model is not None
+
 def _hash_url(url: str) -> str:
     return hashlib.md5(url.encode()).hexdigest()
 
-def _save_cache():
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(_cache, f)
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Transient failures are retried within the request with jittered
+# exponential backoff; every final failure goes to the negative cache.
+# Seconds per HTTP request (connect / between bytes)
+FETCH_TIMEOUT = 3
+FETCH_RETRIES = int(os.environ.get("MATCHING_IMAGE_FETCH_RETRIES", "2"))
+RETRY_BACKOFF = 0.5
+RETRYABLE_REASONS = {"timeout", "server_error"}
+
+class ImageFetchError(Exception):
+    """A failed image fetch; `reason` is a key of embedding_cache.NEGATIVE_TTLS."""
+
+    def __init__(self, reason, message=""):
+        super().__init__(message or reason)
+        self.reason = reason
+
+def _failure_reason(e):
+    if isinstance(e, ImageFetchError):
+        return e.reason
+    if isinstance(e, (requests.Timeout, requests.ConnectionError)):
+        return "timeout"
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        code = e.response.status_code
+        if code in (404, 410):
+            return "not_found"
+        return "server_error" if code == 429 or code >= 500 else "client_error"
+    if isinstance(e, requests.RequestException):
+        return "error"
+    if isinstance(e, (OSError, SyntaxError, ValueError)):  # PIL decode errors
+        return "bad_image"
+    return "error"
+
+def _read_body(r, max_size=MAX_IMAGE_BYTES):
+    """
+    Read a streamed response into one preallocated buffer (sized from
+    Content-Length when present) instead of concatenating bytes chunks.
+    Oversized images are rejected before or while downloading.
+    """
+    length = r.headers.get("Content-Length")
+    length = int(length) if length and length.isdigit() else None
+    if length is not None and length > max_size:
+        raise ImageFetchError("too_large", f"Image too large ({length} bytes)")
 
-def load_image_from_url(url: str, size=(224, 224), timeout: int = 3):
+    buf = bytearray(length if length else 256 * 1024)
+    n = 0
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        end = n + len(chunk)
+        if end > max_size:
+            raise ImageFetchError("too_large", "Image too large")
+        if end > len(buf):
+            buf.extend(bytes(max(end - len(buf), len(buf))))
+        buf[n:end] = chunk
+        n = end
+    return memoryview(buf)[:n]
+
+def _decode_image(data, size=(224, 224)):
+    """
+    Decode to RGB at roughly `size`. For JPEGs draft() lets libjpeg decode at
+    1/2, 1/4 or 1/8 scale (never below `size`), so large photos are not
+    decoded at full resolution just to be thumbnailed.
+    """
+    img = Image.open(BytesIO(data))
+    img.draft("RGB", size)
+    img = img.convert("RGB")
+    img.thumbnail(size, Image.Resampling.LANCZOS)
+    return img
+
+def load_image_from_url(url: str, size=(224, 224), timeout: float = FETCH_TIMEOUT, raise_errors=False):
+    """Download and decode one image; None on failure, or ImageFetchError with raise_errors=True."""
     try:
-        r = requests.get(url, timeout=timeout, stream=True)
-        r.raise_for_status()
-        content = b""
-        max_size = 5 * 1024 * 1024
-        for chunk in r.iter_content(chunk_size=8192):
-            content += chunk
-            if len(content) > max_size:
-                raise Exception("Image too large")
-        img = Image.open(BytesIO(content)).convert("RGB")
-        img.thumbnail(size, Image.Resampling.LANCZOS)
-        return img
+        with _session.get(url, timeout=timeout, stream=True) as r:
+            r.raise_for_status()
+            data = _read_body(r)
+        return _decode_image(data, size)
     except Exception as e:
+        if raise_errors:
+            raise ImageFetchError(_failure_reason(e), str(e)) from e
         print(f"❌ Failed to load {url[:50]}: {e}")
         return None
 
+def _fetch(url, deadline_at=None):
+    """
+    load_image_from_url with bounded retries of transient failures. A final
+    failure is recorded in the negative cache and returns None; a success
+    clears the URL's failure history. `deadline_at` (time.monotonic()) bounds
+    the whole fetch: each request's timeout is capped at the time left, and
+    no retry or backoff starts after it. A fetch that was still queued at the
+    deadline returns None without recording a failure.
+    """
+    reason = "error"
+    for attempt in range(FETCH_RETRIES + 1):
+        timeout = FETCH_TIMEOUT
+        if deadline_at is not None:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                if attempt == 0:
+                    return None
+                break
+            timeout = min(timeout, remaining)
+        try:
+            img = load_image_from_url(url, timeout=timeout, raise_errors=True)
+            if img is not None:
+                _negative.forget(_hash_url(url))
+                return img
+            reason = "error"
+        except ImageFetchError as e:
+            reason = e.reason
+        if reason not in RETRYABLE_REASONS or attempt == FETCH_RETRIES:
+            break
+        backoff = RETRY_BACKOFF * 2 ** attempt * (0.5 + random.random())
+        if deadline_at is not None and time.monotonic() + backoff >= deadline_at:
+            break
+        time.sleep(backoff)
+    print(f"❌ Failed to load {url[:50]} ({reason})")
+    _negative.record(_hash_url(url), reason)
+    return None
+
+def _skip_failed(urls):
+    """`urls` without those whose last fetch failed and has not expired yet."""
+    blocked = _negative.blocked([_hash_url(u) for u in urls])
+    return [u for u in urls if _hash_url(u) not in blocked]
+
+def encode_images(pil_images):
+    """One CLIP batch over `pil_images`; returns an (N, D) L2-normalised float32 matrix."""
+    model = _get_model()
+    embs = model.encode(pil_images, convert_to_numpy=True, show_progress_bar=False, use_fast=True)
+    embs = embs.astype("float32")
+    embs /= (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-10)
+    return embs
+
 def embed_image_pil(pil_image):
     try:
-        model = _get_model()
-        emb = model.encode([pil_image], convert_to_numpy=True, show_progress_bar=False, use_fast=True)
-        emb = emb.astype("float32")
-        emb /= (np.linalg.norm(emb, axis=1, keepdims=True) + 1e-10)
-        return emb[0]
+        return encode_images([pil_image])[0]
     except Exception as e:
         print(f"❌ Failed to embed image: {e}")
         return None
@@ -71,69 +281,171 @@ def embed_image_url(url: str):
         return None
 
     key = _hash_url(url)
-    if key in _cache:
-        cached = _cache[key]
-        return np.array(cached, dtype="float32") if cached else None
+    cached = _cached_embeddings([key])
+    if key in cached:
+        return cached[key]
+    if not _skip_failed([url]):
+        return None
 
     start_time = time.time()
-    pil = load_image_from_url(url)
+    pil = _fetch(url)
     if pil is None:
-        _cache[key] = None
-        _save_cache()
         return None
 
-    emb = embed_image_pil(pil)
-    _cache[key] = emb.tolist() if emb is not None else None
-    _save_cache()
+    unique, reused, _ = _reuse_duplicates([(url, pil)])
+    emb = reused[url] if url in reused else embed_image_pil(pil)
+    if emb is not None:
+        _cache.put(key, emb)
+        if unique:
+            _phash.add_many([(key, unique[0][2])])
     print(f"⚡ Embedded {url[:30]} in {time.time()-start_time:.2f}s")
     return emb
 
-def embed_images_batch(urls: list):
-    """Batch embedding multiple images with caching"""
+def load_images_concurrently(urls, deadline=None):
+    """
+    Download and decode `urls` in parallel. Returns {url: PIL image or None};
+    URLs still in flight when `deadline` seconds have passed are left out.
+    The deadline also bounds each fetch including its retries, so slow hosts
+    do not keep the shared pool's workers busy after the batch has given up.
+    """
+    deadline = BATCH_DEADLINE if deadline is None else deadline
+    pool = _get_download_pool()
+    deadline_at = time.monotonic() + deadline
+    futures = {pool.submit(_fetch, url, deadline_at): url for url in urls}
+    done, not_done = wait(futures, timeout=deadline)
+    for f in not_done:
+        f.cancel()
+    if not_done:
+        print(f"⏱️ {len(not_done)} image downloads missed the {deadline:.1f}s batch deadline")
+    return {futures[f]: f.result() for f in done}
+
+def embed_images_batch(urls: list, deadline=None):
+    """
+    Batch embedding multiple images with caching. Uncached images are
+    downloaded concurrently (see load_images_concurrently) and encoded in a
+    single CLIP batch. Images that miss the deadline come back as None and
+    are not cached, so a later call retries them; URLs with a recent failure
+    in the negative cache are skipped.
+    """
     if not urls:
         return []
 
-    results, new_cache = [], False
-    pil_images, url_keys, pending_indices = [], [], []
-
-    for i, url in enumerate(urls):
-        if not url or not url.strip():
-            results.append(None)
-            continue
+    valid = [u for u in urls if u and u.strip()]
+    cached = _cached_embeddings([_hash_url(u) for u in valid])
+    to_load = _skip_failed(list(dict.fromkeys(u for u in valid if _hash_url(u) not in cached)))
+    loaded = load_images_concurrently(to_load, deadline) if to_load else {}
 
-        key = _hash_url(url)
-        if key in _cache:
-            cached = _cache[key]
-            results.append(np.array(cached, dtype="float32") if cached else None)
-        else:
-            img = load_image_from_url(url)
-            if img is None:
-                results.append(None)
-                _cache[key] = None
-                new_cache = True
-            else:
-                pil_images.append(img)
-                url_keys.append((url, key))
-                pending_indices.append(len(results))
-                results.append("__PENDING__")
+    embedded = {}
+    unique, reused, aliases = _reuse_duplicates([(u, loaded[u]) for u in to_load if loaded.get(u) is not None])
 
-    if pil_images:
+    if unique:
         try:
-            model = _get_model()
-            embs = model.encode(pil_images, convert_to_numpy=True, show_progress_bar=False, use_fast=True)
-            embs = embs.astype("float32")
-            embs /= (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-10)
-
-            for i, (url, key) in enumerate(url_keys):
-                results[pending_indices[i]] = embs[i]
-                _cache[key] = embs[i].tolist()
-                new_cache = True
+            embs = encode_images([img for _, img, _ in unique])
+            for (url, _, _), emb in zip(unique, embs):
+                embedded[url] = emb
         except Exception as e:
             print(f"❌ Batch embedding failed: {e}")
-            for idx in pending_indices:
-                results[idx] = None
+    _store_embeddings(embedded, unique, reused, aliases)
 
-    if new_cache:
-        _save_cache()
+    _cache.flush()
 
+    results = []
+    for url in urls:
+        if not url or not url.strip():
+            results.append(None)
+        elif _hash_url(url) in cached:
+            results.append(cached[_hash_url(url)])
+        else:
+            results.append(embedded.get(url))
     return results
+
+
+def embed_images_pipelined(urls, workers=16, batch_size=64, progress=None):
+    """
+    Build-time image embedding for many URLs. Download workers fetch and
+    decode images into a bounded queue while this thread encodes them in
+    fixed-size CLIP batches, so downloads keep running during encoding and
+    throughput is bounded by bandwidth rather than per-image latency.
+    Returns {url: embedding or None}. `progress(n)` is called as images finish.
+    """
+    unique = list(dict.fromkeys(u for u in urls if u and u.strip()))
+    cached = _cached_embeddings([_hash_url(u) for u in unique])
+    out = {u: cached[_hash_url(u)] for u in unique if _hash_url(u) in cached}
+    todo = _skip_failed([u for u in unique if u not in out])
+    n_skipped = len(unique) - len(out) - len(todo)
+    out.update((u, None) for u in unique if u not in out and u not in todo)
+    if progress and out:
+        progress(len(out))
+    if not todo:
+        return out
+
+    decoded = queue.Queue(maxsize=batch_size * 4)  # backpressure: workers wait while the encoder is busy
+    pending = iter(todo)
+    pending_lock = threading.Lock()
+    done_marker = object()
+
+    def download_worker():
+        while True:
+            with pending_lock:
+                url = next(pending, None)
+            if url is None:
+                decoded.put(done_marker)
+                return
+            decoded.put((url, _fetch(url)))
+
+    n_workers = max(1, min(workers, len(todo)))
+    threads = [threading.Thread(target=download_worker, daemon=True, name=f"image-build-{i}")
+               for i in range(n_workers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+
+    batch, finished, failed, encode_time, n_reused = [], 0, 0, 0.0, 0
+
+    def encode_batch():
+        nonlocal encode_time, failed, n_reused
+        unique, reused, aliases = _reuse_duplicates(batch)
+        n_reused += len(reused) + len(aliases)
+        embedded = {}
+        t0 = time.time()
+        if unique:
+            try:
+                embs = encode_images([img for _, img, _ in unique])
+            except Exception as e:
+                print(f"❌ Batch embedding failed: {e}")
+                embs = [None] * len(unique)
+                failed += len(unique) + len(aliases)
+            embedded.update((url, emb) for (url, _, _), emb in zip(unique, embs))
+        encode_time += time.time() - t0
+        _store_embeddings(embedded, unique, reused, aliases)
+        out.update(embedded)
+        _cache.flush()
+        if progress:
+            progress(len(batch))
+        batch.clear()
+
+    while finished < n_workers:
+        item = decoded.get()
+        if item is done_marker:
+            finished += 1
+            continue
+        url, img = item
+        if img is None:
+            out[url] = None
+            failed += 1
+            if progress:
+                progress(1)
+            continue
+        batch.append(item)
+        if len(batch) >= batch_size:
+            encode_batch()
+    if batch:
+        encode_batch()
+    _cache.flush()
+
+    elapsed = time.time() - start
+    print(f"🖼️ Embedded {len(todo) - failed}/{len(todo)} new images in {elapsed:.1f}s "
+          f"({len(todo) / max(elapsed, 1e-9):.1f} img/s, {workers} download workers, "
+          f"CLIP encoding {encode_time:.1f}s); {len(out) - len(todo) - n_skipped} from cache, "
+          f"{n_reused} near-duplicates reused an embedding, {n_skipped} skipped after recent failures")
+    return out
@@ -0,0 +1,299 @@
+# matching_engine/index_factory.py
+import json
+import os
+import numpy as np
+import faiss
+
+# Index types selectable per modality at build time. All use inner product
+# on L2-normalised vectors, i.e. cosine similarity.
+#   flat     - exact brute force (default)
+#   ivf_flat - inverted lists over k-means cells, full vectors
+#   ivf_pq   - inverted lists with product-quantized vectors
+#   hnsw     - graph based, no training
+#   sq8      - brute force over 8-bit scalar-quantized vectors (1/4 of flat)
+#   fp16     - brute force over float16 vectors (1/2 of flat)
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "fp16")
+
+# Types whose index is the only copy of the vectors: the rental store does
+# not write float32 matrices for them and scoring decodes candidate vectors
+# from the index (see rental_store.IndexVectors).
+COMPACT_TYPES = ("sq8", "fp16")
+
+DEFAULT_PARAMS = {
+    "flat": {},
+    "ivf_flat": {"nlist": None, "nprobe": 16, "train_size": 100000},
+    "ivf_pq": {"nlist": None, "nprobe": 16, "train_size": 100000, "m": 16, "nbits": 8},
+    "hnsw": {"M": 32, "efConstruction": 80, "efSearch": 64},
+    "sq8": {"train_size": 100000},
+    "fp16": {},
+}
+
+# Parameters applied at search time through faiss.ParameterSpace
+SEARCH_PARAMS = ("nprobe", "efSearch")
+
+
+def parse_index_spec(spec):
+    """
+    Parse a build option like "ivf_pq,nlist=1024,nprobe=32,m=48" into
+    (index_type, params). Unknown types or parameters raise ValueError.
+    """
+    parts = [p.strip() for p in (spec or "flat").split(",") if p.strip()]
+    index_type = parts[0].lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+
+    params = {}
+    for p in parts[1:]:
+        key, _, value = p.partition("=")
+        if key not in DEFAULT_PARAMS[index_type]:
+            raise ValueError(f"Unknown parameter '{key}' for {index_type} index")
+        params[key] = int(value)
+    return index_type, params
+
+
+def _params_path(index_path):
+    return os.path.splitext(index_path)[0] + ".params.json"
+
+
+def build_index(embs, index_type="flat", ids=None, trained=None, **params):
+    """
+    Build and fill an inner-product index of `index_type` over the (N, D)
+    float32 matrix `embs`. With `ids` (int64 stable rental ids) the index is
+    wrapped in an IndexIDMap2 and searches return those ids instead of row
+    numbers. `trained` (see trained_copy) is filled instead of training a new
+    index. Returns (index, params) where params holds the effective settings,
+    including the search-time ones to persist.
+    """
+    embs = np.ascontiguousarray(embs, dtype="float32")
+    n, dim = embs.shape
+    params = {**DEFAULT_PARAMS[index_type], **params}
+
+    if trained is not None:
+        index = trained
+    elif index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["M"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["efConstruction"]
+    elif index_type in COMPACT_TYPES:
+        qtype = faiss.ScalarQuantizer.QT_8bit if index_type == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+    else:
+        # ~4*sqrt(N) cells is the usual starting point; never more cells than points
+        nlist = params["nlist"] or int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        params["nlist"] = nlist
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            if dim % params["m"] != 0:
+                raise ValueError(f"ivf_pq: m={params['m']} must divide the dimension {dim}")
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, params["m"], params["nbits"],
+                                     faiss.METRIC_INNER_PRODUCT)
+
+    if not index.is_trained:
+        # IVF cells / SQ8 value ranges are fitted on a sample
+        train_size = min(n, params.get("train_size", n))
+        sample = embs
+        if train_size < n:
+            rng = np.random.default_rng(0)
+            sample = embs[np.sort(rng.choice(n, train_size, replace=False))]
+        index.train(sample)
+
+    if ids is not None:
+        index = faiss.IndexIDMap2(index)
+        index.add_with_ids(embs, np.asarray(ids, dtype=np.int64))
+    else:
+        index.add(embs)
+    apply_search_params(index, params)
+    return index, {"index_type": index_type, **params}
+
+
+def trained_copy(index):
+    """
+    Empty copy of `index` (unwrapped from its id map) that keeps the trained
+    state, e.g. the sq8 value ranges. Re-encoding vectors decoded from a
+    compact index with it reproduces the same codes, so rebuilding a compact
+    index from its own vectors is lossless.
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    copy = faiss.clone_index(index)
+    copy.reset()
+    return copy
+
+
+# Weights of text and image similarity in the final score (the engine adds
+# STRUCTURED_WEIGHT). Fused indexes are built with FUSED_WEIGHTS, so their
+# inner product is the semantic part of that score.
+TEXT_WEIGHT, IMAGE_WEIGHT = 0.45, 0.35
+FUSED_WEIGHTS = (TEXT_WEIGHT, IMAGE_WEIGHT)
+
+
+def fuse_vectors(text_embs, image_embs, weights):
+    """
+    Rows [sqrt(w_text) * text, sqrt(w_image) * image] of the L2-normalised
+    (N, Dt) / (N, Di) inputs, so that the inner product of two fused vectors
+    is w_text * text similarity + w_image * image similarity. Zero image rows
+    (no photo) contribute no image term.
+    """
+    w_text, w_image = weights
+    text_embs = np.atleast_2d(np.asarray(text_embs, dtype="float32"))
+    image_embs = np.atleast_2d(np.asarray(image_embs, dtype="float32"))
+    return np.ascontiguousarray(np.hstack([np.sqrt(w_text) * text_embs, np.sqrt(w_image) * image_embs]),
+                                dtype="float32")
+
+
+def is_compact(params):
+    """True if the index is the only copy of its vectors (see COMPACT_TYPES)."""
+    return params.get("index_type", "flat") in COMPACT_TYPES
+
+
+def storage_report(index, embs, ids=None, n_queries=200, k=10):
+    """
+    Memory and accuracy of a compact index against the float32 `embs` it was
+    built from (with `ids` as passed to build_index). Memory compares the
+    serialized index with the float32 layout it replaces: a flat index plus
+    the store's copy of the matrix. Score drift is |exact - decoded| cosine
+    x 100 (the engine's score scale) over each sample query's exact top-k,
+    using stored vectors as queries; recall is the overlap of the index's
+    top-k with the exact top-k.
+    """
+    embs = np.ascontiguousarray(embs, dtype="float32")
+    n, dim = embs.shape
+    float_bytes = 2 * n * dim * 4
+    report = {"vectors": n, "float32_bytes": float_bytes,
+              "compact_bytes": int(faiss.serialize_index(index).nbytes)}
+    report["saved_bytes"] = float_bytes - report["compact_bytes"]
+    if n == 0:
+        return report
+
+    rng = np.random.default_rng(0)
+    q_rows = np.sort(rng.choice(n, min(n_queries, n), replace=False))
+    queries, k = embs[q_rows], min(k, n)
+    exact = queries @ embs.T
+    top = np.argpartition(-exact, k - 1, axis=1)[:, :k]
+    keys = np.arange(n, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+    decoded = index.reconstruct_batch(keys[top.ravel()]).reshape(len(q_rows), k, dim)
+    drift = np.abs(np.take_along_axis(exact, top, axis=1) - np.einsum("qd,qkd->qk", queries, decoded)) * 100.0
+    _, found = index.search(queries, k)
+    recall = np.mean([len(set(f) & set(keys[t])) / k for f, t in zip(found, top)])
+    report.update({"score_drift_mean": round(float(drift.mean()), 4), "score_drift_max": round(float(drift.max()), 4),
+                   "k": k, "recall": round(float(recall), 4)})
+    return report
+
+
+def supports_remove(params):
+    """HNSW graphs cannot drop vectors; their deletions rely on store tombstones until compaction."""
+    return params.get("index_type", "flat") != "hnsw"
+
+
+def rebuild_params(params):
+    """Build arguments to rebuild an index with the same settings as `params`."""
+    return params.get("index_type", "flat"), {k: v for k, v in params.items() if k != "index_type"}
+
+
+def apply_search_params(index, params):
+    """Apply the persisted search-time settings (nprobe, efSearch) to a loaded index."""
+    ps = faiss.ParameterSpace()
+    for key in SEARCH_PARAMS:
+        if params.get(key) is not None:
+            ps.set_index_parameter(index, key, params[key])
+
+
+def id_selector(ids):
+    """IDSelector over a set of int64 ids (stable rental ids)."""
+    return faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype=np.int64))
+
+
+def bitmap_selector(mask):
+    """IDSelector over the ids 0..len(mask)-1 where the boolean `mask` is set."""
+    return faiss.IDSelectorBitmap(np.packbits(np.asarray(mask, dtype=bool), bitorder="little"))
+
+
+def search_params(index, selector, k, fraction=1.0):
+    """
+    faiss SearchParameters restricting a search of `index` to `selector`. An
+    explicit parameters object replaces the index's own nprobe / efSearch, so
+    those are carried over (efSearch at least k, so filtered graph searches
+    still fill k slots). When the selector passes only `fraction` of the
+    vectors, nprobe / efSearch grow by 1/fraction so that about as many
+    passing vectors are visited as in an unfiltered search.
+    """
+    scale = 1.0 / max(fraction, 1e-6)
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=min(inner.nlist, int(np.ceil(inner.nprobe * scale))))
+    if isinstance(inner, faiss.IndexHNSW):
+        ef = int(np.ceil(max(inner.hnsw.efSearch, k) * scale))
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=max(k, min(ef, inner.ntotal)))
+    return faiss.SearchParameters(sel=selector)
+
+
+def save_index(index, path, params):
+    """Write the index and its build/search parameters next to it (<name>.params.json)."""
+    faiss.write_index(index, path)
+    with open(_params_path(path), "w", encoding="utf-8") as f:
+        json.dump(params, f, indent=2)
+
+
+def _mmap_flags():
+    # IO_FLAG_MMAP_IFC also maps flat/IVF code arrays; older faiss only has IO_FLAG_MMAP
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def load_index(path, mmap=False):
+    """
+    Read an index and apply the search-time parameters persisted at build time,
+    if any. With mmap=True the vector data is memory-mapped read-only, so
+    worker processes on one box share the same page-cache pages. Falls back
+    to a normal read if this faiss build cannot map the index.
+    """
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(path, _mmap_flags())
+        except RuntimeError as e:
+            print(f"⚠️ Could not memory-map {path} ({e}); loading into memory")
+    if index is None:
+        index = faiss.read_index(path)
+    params = load_index_params(path)
+    apply_search_params(index, params)
+    return index
+
+
+def process_rss_bytes():
+    """Resident set size of this process (Linux /proc), None where unavailable."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def mapped_rss_bytes(path):
+    """Resident bytes of this process's mappings of `path` (Linux /proc/self/smaps), None where unavailable."""
+    target = os.path.realpath(path)
+    total, in_target = 0, False
+    try:
+        with open("/proc/self/smaps", "r") as f:
+            for line in f:
+                fields = line.split()
+                if not fields[0].endswith(":"):
+                    # mapping header: "start-end perms offset dev inode [path]"
+                    in_target = len(fields) >= 6 and fields[5] == target
+                elif in_target and fields[0] == "Rss:":
+                    total += int(fields[1]) * 1024
+    except OSError:
+        return None
+    return total
+
+
+def load_index_params(path):
+    params_path = _params_path(path)
+    if not os.path.exists(params_path):
+        return {"index_type": "flat"}
+    with open(params_path, "r", encoding="utf-8") as f:
+        return json.load(f)
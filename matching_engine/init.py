@@ -2,7 +2,14 @@
 __all__ = [
     "text_matcher",
     "image_matcher",
+    "image_dedup",
     "structured_matcher",
+    "embedding_cache",
+    "onnx_encoder",
     "engine",
-    "build_indexes"
+    "index_factory",
+    "rental_store",
+    "bundle",
+    "build_indexes",
+    "update_indexes"
 ]
@@ -0,0 +1,309 @@
+# matching_engine/onnx_encoder.py
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+# ONNX Runtime backends for the embedding models on CPU boxes. The network of
+# a sentence-transformers checkpoint (MiniLM transformer, CLIP vision tower)
+# is exported once (this needs torch) into data/onnx/<model>/, optionally
+# with a dynamically quantized int8 copy; serving then only imports
+# onnxruntime (and tokenizers for text). Pre/post-processing is done in
+# numpy/PIL. Selected with MATCHING_TEXT_BACKEND / MATCHING_IMAGE_BACKEND =
+# torch|onnx|onnx-int8.
+ONNX_DIR = os.path.join("data", "onnx")
+CONFIG_FILE = "onnx_config.json"
+OPSET = 14
+
+
+def onnx_threads():
+    """Intra-op threads per ONNX session (MATCHING_ONNX_THREADS, 0 = onnxruntime default)."""
+    return int(os.environ.get("MATCHING_ONNX_THREADS", "0"))
+
+
+def model_dir(model_name, root=None):
+    return os.path.join(root or ONNX_DIR, model_name.replace("/", "_"))
+
+
+def model_file(model_name, quantize=False, root=None):
+    return os.path.join(model_dir(model_name, root), "model-int8.onnx" if quantize else "model.onnx")
+
+
+def _quantize(src, dst, op_types=None):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    tmp = dst + ".tmp.onnx"
+    quantize_dynamic(src, tmp, op_types_to_quantize=op_types, weight_type=QuantType.QInt8)
+    os.replace(tmp, dst)
+    print(f"✅ Quantized {src} -> {dst} (int8, {os.path.getsize(dst) / 1e6:.1f} MB)")
+
+
+def export_text_model(model_name, quantize=False, root=None):
+    """
+    Export the transformer and tokenizer of sentence-transformers model
+    `model_name` to ONNX (no-op if already exported); with quantize=True also
+    write the int8 variant. Returns the path of the requested model file.
+    """
+    out_dir = model_dir(model_name, root)
+    fp32 = model_file(model_name, root=root)
+    if not os.path.exists(fp32):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        print(f"🔄 Exporting {model_name} to ONNX in {out_dir} ...")
+        st = SentenceTransformer(model_name, device="cpu")
+        transformer, tokenizer = st[0].auto_model.eval(), st.tokenizer
+        os.makedirs(out_dir, exist_ok=True)
+        tokenizer.save_pretrained(out_dir)  # tokenizer.json, read by the tokenizers library
+
+        names = [n for n in ("input_ids", "attention_mask", "token_type_ids")
+                 if n in tokenizer.model_input_names]
+        dummy = tokenizer(["a short example", "another example sentence"], padding=True, return_tensors="pt")
+        axes = {n: {0: "batch", 1: "seq"} for n in names + ["last_hidden_state"]}
+        tmp = fp32 + ".tmp"
+        with torch.no_grad():
+            torch.onnx.export(transformer, tuple(dummy[n] for n in names), tmp, input_names=names,
+                              output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=OPSET)
+        os.replace(tmp, fp32)
+        with open(os.path.join(out_dir, CONFIG_FILE), "w") as f:
+            json.dump({"model": model_name, "max_seq_length": st.max_seq_length,
+                       "pad_id": tokenizer.pad_token_id, "pad_token": tokenizer.pad_token}, f)
+        print(f"✅ Exported {fp32} ({os.path.getsize(fp32) / 1e6:.1f} MB)")
+
+    if quantize and not os.path.exists(model_file(model_name, True, root)):
+        _quantize(fp32, model_file(model_name, True, root))
+    return model_file(model_name, quantize, root)
+
+
+def _mean_pool(hidden, mask):
+    """Masked mean over the token axis, as the sentence-transformers Pooling layer does."""
+    mask = mask[..., None].astype(np.float32)
+    return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+
+def _l2_normalize(embs):
+    embs = embs.astype("float32")
+    embs /= (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-10)
+    return embs
+
+
+def _new_session(path, threads=None):
+    import onnxruntime as ort
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    threads = onnx_threads() if threads is None else threads
+    if threads:
+        opts.intra_op_num_threads = threads
+    return ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+
+
+class _OnnxModel:
+    """
+    An exported model file with its config. The session is created per
+    process (like the SQLite connections), so an encoder loaded before a fork
+    gets its own thread pool in each worker.
+    """
+
+    def __init__(self, path, config_dir, threads=None):
+        self.path = path
+        with open(os.path.join(config_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.threads = threads
+        self._sess = None
+        self._sess_pid = None
+        self._session()  # fail at load time, not on the first request
+
+    def _session(self):
+        if self._sess is None or self._sess_pid != os.getpid():
+            self._sess, self._sess_pid = _new_session(self.path, self.threads), os.getpid()
+            self._inputs = {i.name for i in self._sess.get_inputs()}
+        return self._sess
+
+
+class OnnxTextEncoder(_OnnxModel):
+    """Drop-in for SentenceTransformer.encode on an exported text model."""
+
+    def __init__(self, model_name, quantize=False, root=None, threads=None):
+        from tokenizers import Tokenizer
+
+        path = model_file(model_name, quantize, root)
+        if not os.path.exists(path):
+            export_text_model(model_name, quantize, root)
+        super().__init__(path, model_dir(model_name, root), threads)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir(model_name, root), "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_id"], pad_token=self.config["pad_token"])
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        """(N, D) float32 L2-normalised embeddings; SentenceTransformer.encode kwargs are ignored."""
+        if isinstance(texts, str):
+            texts = [texts]
+        sess = self._session()
+        # Longest first, so each padded batch holds texts of similar length
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        chunks = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer.encode_batch([texts[j] for j in order[i:i + batch_size]])
+            feeds = {
+                "input_ids": np.array([e.ids for e in enc], dtype=np.int64),
+                "attention_mask": np.array([e.attention_mask for e in enc], dtype=np.int64),
+                "token_type_ids": np.array([e.type_ids for e in enc], dtype=np.int64),
+            }
+            hidden = sess.run(["last_hidden_state"], {k: v for k, v in feeds.items() if k in self._inputs})[0]
+            chunks.append(_mean_pool(hidden, feeds["attention_mask"]))
+        embs = np.empty((len(texts), chunks[0].shape[1]) if chunks else (0, 0), dtype=np.float32)
+        if chunks:
+            embs[order] = np.vstack(chunks)
+        return _l2_normalize(embs)
+
+
+# ---------------- CLIP vision tower ----------------
+def export_clip_vision(model_name, quantize=False, root=None):
+    """
+    Export the vision tower + projection of sentence-transformers CLIP model
+    `model_name` (pixel_values -> image_embeds) and its preprocessing
+    constants; with quantize=True also write the int8 variant.
+    """
+    out_dir = model_dir(model_name, root)
+    fp32 = model_file(model_name, root=root)
+    if not os.path.exists(fp32):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        print(f"🔄 Exporting the {model_name} vision tower to ONNX in {out_dir} ...")
+        clip = SentenceTransformer(model_name, device="cpu")[0]
+        model, processor = clip.model.eval(), clip.processor.image_processor
+
+        class VisionTower(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.clip = model
+
+            def forward(self, pixel_values):
+                return self.clip.get_image_features(pixel_values=pixel_values)
+
+        size = processor.size.get("shortest_edge", 224)
+        crop = processor.crop_size["height"]
+        os.makedirs(out_dir, exist_ok=True)
+        tmp = fp32 + ".tmp"
+        with torch.no_grad():
+            torch.onnx.export(VisionTower().eval(), (torch.zeros(2, 3, crop, crop),), tmp,
+                              input_names=["pixel_values"], output_names=["image_embeds"],
+                              dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+                              opset_version=OPSET)
+        os.replace(tmp, fp32)
+        with open(os.path.join(out_dir, CONFIG_FILE), "w") as f:
+            json.dump({"model": model_name, "size": size, "crop": crop,
+                       "mean": list(processor.image_mean), "std": list(processor.image_std)}, f)
+        print(f"✅ Exported {fp32} ({os.path.getsize(fp32) / 1e6:.1f} MB)")
+
+    if quantize and not os.path.exists(model_file(model_name, True, root)):
+        # MatMul only: the int8 ConvInteger kernel for the patch embedding is
+        # missing from some onnxruntime CPU builds, and it is a small share of the FLOPs
+        _quantize(fp32, model_file(model_name, True, root), op_types=["MatMul"])
+    return model_file(model_name, quantize, root)
+
+
+def clip_preprocess(images, size=224, crop=224, mean=(0.0, 0.0, 0.0), std=(1.0, 1.0, 1.0)):
+    """
+    PIL images -> (N, 3, crop, crop) float32 pixel values, as CLIPImageProcessor
+    does it: bicubic resize of the short side to `size`, centre crop, scale to
+    [0, 1], normalise per channel.
+    """
+    from PIL import Image
+
+    out = np.empty((len(images), 3, crop, crop), dtype=np.float32)
+    for i, img in enumerate(images):
+        img = img.convert("RGB")
+        w, h = img.size
+        short, long = (w, h) if w <= h else (h, w)
+        new_short, new_long = size, int(size * long / short)
+        img = img.resize((new_short, new_long) if w <= h else (new_long, new_short), Image.Resampling.BICUBIC)
+        w, h = img.size
+        left, top = (w - crop) // 2, (h - crop) // 2
+        px = np.asarray(img.crop((left, top, left + crop, top + crop)), dtype=np.float32) / 255.0
+        out[i] = ((px - mean) / std).transpose(2, 0, 1)
+    return out
+
+
+class OnnxClipVisionEncoder(_OnnxModel):
+    """Drop-in for SentenceTransformer.encode on PIL images with an exported CLIP vision tower."""
+
+    def __init__(self, model_name, quantize=False, root=None, threads=None):
+        path = model_file(model_name, quantize, root)
+        if not os.path.exists(path):
+            export_clip_vision(model_name, quantize, root)
+        super().__init__(path, model_dir(model_name, root), threads)
+        c = self.config
+        self._prep = dict(size=c["size"], crop=c["crop"], mean=np.array(c["mean"], dtype=np.float32),
+                          std=np.array(c["std"], dtype=np.float32))
+
+    def encode(self, images, batch_size=32, **kwargs):
+        """(N, D) float32 L2-normalised embeddings; SentenceTransformer.encode kwargs are ignored."""
+        sess = self._session()
+        chunks = [sess.run(["image_embeds"], {"pixel_values": clip_preprocess(images[i:i + batch_size],
+                                                                              **self._prep)})[0]
+                  for i in range(0, len(images), batch_size)]
+        return _l2_normalize(np.vstack(chunks) if chunks else np.empty((0, 0), dtype=np.float32))
+
+
+# ---------------- Benchmark ----------------
+def _sample_texts(n):
+    rooms = ["studio", "1-bedroom flat", "2-bedroom apartment", "3-bedroom villa", "loft", "penthouse"]
+    places = ["Rome", "Milan", "Florence", "Tuscany countryside", "Lake Como", "Naples seafront"]
+    extras = ["with pool and garden", "near the historic centre", "with sea view terrace",
+              "recently renovated, bright and quiet", "close to metro and shops", "with parking and balcony"]
+    rng = np.random.default_rng(0)
+    return [f"{rooms[rng.integers(6)]} in {places[rng.integers(6)]} {extras[rng.integers(6)]}. "
+            * int(rng.integers(1, 6)) for _ in range(n)]
+
+
+def _sample_images(n):
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)).resize((298, 224), Image.Resampling.BICUBIC)
+            for _ in range(n)]
+
+
+def _throughput(encode, items, batch_size):
+    encode(items[:batch_size], batch_size=batch_size)  # warm-up
+    start = time.perf_counter()
+    embs = encode(items, batch_size=batch_size)
+    return len(items) / (time.perf_counter() - start), _l2_normalize(np.asarray(embs))
+
+
+def benchmark(model_name, kind="text", n_items=512, batch_size=32, threads=1):
+    """Items/s of the torch, onnx and onnx-int8 backends and cosine parity against torch."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    items, encoder, unit = ((_sample_texts(n_items), OnnxTextEncoder, "texts/s") if kind == "text" else
+                            (_sample_images(n_items), OnnxClipVisionEncoder, "images/s"))
+    st = SentenceTransformer(model_name, device="cpu")
+    ref_rate, ref = _throughput(lambda t, batch_size: st.encode(t, batch_size=batch_size, show_progress_bar=False),
+                                items, batch_size)
+    print(f"📊 {model_name}, {n_items} {kind}s, batch {batch_size}, {threads} thread(s)")
+    print(f"   torch      {ref_rate:8.1f} {unit}")
+    for quantize in (False, True):
+        enc = encoder(model_name, quantize=quantize, threads=threads)
+        rate, embs = _throughput(enc.encode, items, batch_size)
+        cos = (embs * ref).sum(axis=1)
+        print(f"   {'onnx-int8' if quantize else 'onnx':10s} {rate:8.1f} {unit}  x{rate / ref_rate:.2f}  "
+              f"cosine vs torch min {cos.min():.4f} mean {cos.mean():.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export / benchmark ONNX Runtime embedding backends")
+    parser.add_argument("command", choices=["export", "bench"])
+    parser.add_argument("--kind", choices=["text", "image"], default="text")
+    parser.add_argument("--model", help="default: all-MiniLM-L6-v2 for text, clip-ViT-B-32 for image")
+    parser.add_argument("--items", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads for the benchmark")
+    args = parser.parse_args()
+    model = args.model or ("all-MiniLM-L6-v2" if args.kind == "text" else "clip-ViT-B-32")
+    if args.command == "export":
+        (export_text_model if args.kind == "text" else export_clip_vision)(model, quantize=True)
+    else:
+        benchmark(model, args.kind, args.items, args.batch_size, args.threads)
@@ -0,0 +1,347 @@
+# matching_engine/rental_store.py
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from matching_engine.index_factory import bitmap_selector, id_selector
+from matching_engine.structured_matcher import build_structured_columns, filter_mask, normalize_filters
+
+# On-disk layout of a rental store directory:
+#   text_emb.npy   (N, Dt) float32, L2-normalised, memory-mapped on load
+#   image_emb.npy  (N, Di) float32, L2-normalised (zero rows: no image)
+#   has_image.npy  (N,) bool, image_emb row is non-zero
+#   columns.npz    structured columns (price, rooms, loc_id, is_coord, coords)
+#   loc_vocab.json normalised location string -> loc_id
+#   records.jsonl  one rental per line (no embeddings)
+#   offsets.npy    (N + 1,) int64 byte offsets of the lines in records.jsonl
+#   ids.npy        (N,) int64 stable rental id of each row (the FAISS ids)
+#   hashes.npz     embed_hash / record_hash per row, for incremental updates
+#   deleted.npy    (N,) bool tombstones; deleted rows are never returned
+# Multi-image stores (one vector per rental photo) additionally have
+#   image_vecs.npy        (M, Di) float32 photo vectors, rows' photos contiguous
+#   image_vec_offsets.npy (N + 1,) int64, photos of row r are image_vecs[off[r]:off[r+1]]
+# and image_emb holds the normalised centroid of each row's photos.
+# Stores written before ids.npy existed use the row number as id.
+# When an index is compact (sq8/fp16, see index_factory.COMPACT_TYPES) it is
+# the only copy of its vectors: text_emb.npy (text), or image_emb.npy /
+# image_vecs.npy (image, single- / multi-image) are not written, and the
+# bundle serves those matrices as IndexVectors decoded from the index.
+STORE_DIR = os.path.join("data", "rentals_store")
+
+_COLUMN_KEYS = ("price", "rooms", "loc_id", "is_coord", "coords")
+
+# Row filters (structured pre-filters and their FAISS selectors) kept per store
+FILTER_CACHE_SIZE = 32
+_EMBEDDING_KEYS = ("text_emb", "image_emb")
+
+
+def _normalize_rows(mat):
+    mat = np.array(mat, dtype="float32")
+    mat /= (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-10)
+    return mat
+
+
+def _write_image_vecs(path, image_vecs, counts, save_vecs=True):
+    if save_vecs:
+        np.save(os.path.join(path, "image_vecs.npy"), _normalize_rows(image_vecs))
+    np.save(os.path.join(path, "image_vec_offsets.npy"),
+            np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+
+
+def write_store(path, rentals, text_embs, image_embs, ids=None, embed_hashes=None, record_hashes=None,
+                deleted=None, image_vecs=None, vectors_in_index=()):
+    """
+    Write a rental store. `rentals` are the rental dicts (embedding keys are
+    dropped), `text_embs` / `image_embs` the matching (N, D) matrices, `ids`
+    the stable rental ids (default: row numbers) and `deleted` the tombstones.
+    `image_vecs` = (vectors, per-row photo counts) writes a multi-image store.
+    `vectors_in_index` names the modalities ("text", "image") whose vectors
+    only live in a compact index and are not written here.
+    """
+    os.makedirs(path, exist_ok=True)
+    n = len(rentals)
+    if image_vecs is not None:
+        _write_image_vecs(path, *image_vecs, save_vecs="image" not in vectors_in_index)
+    np.save(os.path.join(path, "ids.npy"), np.arange(n, dtype=np.int64) if ids is None
+            else np.asarray(ids, dtype=np.int64))
+    np.save(os.path.join(path, "deleted.npy"), np.zeros(n, dtype=bool) if deleted is None
+            else np.asarray(deleted, dtype=bool))
+    np.savez(os.path.join(path, "hashes.npz"),
+             embed_hash=np.array(embed_hashes if embed_hashes is not None else [""] * n, dtype="S32"),
+             record_hash=np.array(record_hashes if record_hashes is not None else [""] * n, dtype="S32"))
+
+    image_embs = _normalize_rows(image_embs)
+    if "text" not in vectors_in_index:
+        np.save(os.path.join(path, "text_emb.npy"), _normalize_rows(text_embs))
+    if "image" not in vectors_in_index or image_vecs is not None:
+        np.save(os.path.join(path, "image_emb.npy"), image_embs)
+    np.save(os.path.join(path, "has_image.npy"), np.any(image_embs != 0, axis=1))
+
+    columns = build_structured_columns(rentals)
+    np.savez(os.path.join(path, "columns.npz"), **{k: columns[k] for k in _COLUMN_KEYS})
+    with open(os.path.join(path, "loc_vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(columns["loc_vocab"], f, ensure_ascii=False)
+
+    offsets = [0]
+    with open(os.path.join(path, "records.jsonl"), "wb") as f:
+        for r in rentals:
+            record = {k: v for k, v in r.items() if k not in _EMBEDDING_KEYS}
+            f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            offsets.append(f.tell())
+    np.save(os.path.join(path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+
+
+def append_store(store, path, rentals, text_embs, image_embs, ids, embed_hashes, record_hashes,
+                 tombstone_rows=(), image_vecs=None):
+    """
+    Write a new store at `path` made of every row of `store` (copied as is,
+    records byte for byte) followed by `rentals`, with `tombstone_rows` of the
+    old store marked deleted. Used by incremental updates; compaction drops
+    the tombstoned rows later. Multi-image stores need `image_vecs` =
+    (vectors, per-row photo counts) for the appended rentals.
+    """
+    os.makedirs(path, exist_ok=True)
+    n_old = len(store)
+    compact = store.vectors_in_index
+    if store.image_vec_offsets is not None:
+        vecs, counts = image_vecs
+        old_counts = np.diff(store.image_vec_offsets)
+        vecs = np.asarray(vecs, dtype="float32").reshape(-1, store.image_vecs.shape[1])
+        old_vecs = vecs[:0] if "image" in compact else store.image_vecs  # not read when compact
+        _write_image_vecs(path, np.concatenate([old_vecs, vecs]),
+                          np.concatenate([old_counts, np.asarray(counts, dtype=np.int64)]),
+                          save_vecs="image" not in compact)
+    if "text" not in compact:
+        np.save(os.path.join(path, "text_emb.npy"), np.concatenate([store.text_embs, _normalize_rows(text_embs)]))
+    image_embs = _normalize_rows(image_embs)
+    if "image" not in compact or store.image_vec_offsets is not None:
+        np.save(os.path.join(path, "image_emb.npy"), np.concatenate([store.image_embs, image_embs]))
+    np.save(os.path.join(path, "has_image.npy"), np.concatenate([store.has_image, np.any(image_embs != 0, axis=1)]))
+
+    new_cols = build_structured_columns(rentals, store.columns["loc_vocab"])
+    np.savez(os.path.join(path, "columns.npz"),
+             **{k: np.concatenate([store.columns[k], new_cols[k]]) for k in _COLUMN_KEYS})
+    with open(os.path.join(path, "loc_vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(new_cols["loc_vocab"], f, ensure_ascii=False)
+
+    offsets = list(store._offsets[1:])
+    with open(os.path.join(path, "records.jsonl"), "wb") as f:
+        f.write(store._records[:store._offsets[-1]])
+        for r in rentals:
+            record = {k: v for k, v in r.items() if k not in _EMBEDDING_KEYS}
+            f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            offsets.append(f.tell())
+    np.save(os.path.join(path, "offsets.npy"), np.array([0] + offsets, dtype=np.int64))
+
+    deleted = np.concatenate([store.deleted, np.zeros(len(rentals), dtype=bool)])
+    deleted[list(tombstone_rows)] = True
+    old_embed, old_record = store.hashes()
+    np.save(os.path.join(path, "ids.npy"), np.concatenate([store.ids, np.asarray(ids, dtype=np.int64)]))
+    np.save(os.path.join(path, "deleted.npy"), deleted)
+    np.savez(os.path.join(path, "hashes.npz"),
+             embed_hash=np.concatenate([old_embed, np.array(embed_hashes, dtype="S32")]),
+             record_hash=np.concatenate([old_record, np.array(record_hashes, dtype="S32")]))
+    return n_old + len(rentals)
+
+
+def convert_legacy_meta(meta_path, path, text_dim, image_dim):
+    """Convert a legacy rentals_meta.json (embeddings as JSON lists) into a store."""
+    with open(meta_path, "r", encoding="utf-8") as f:
+        rentals = json.load(f)
+
+    def stack(key, dim):
+        mat = np.zeros((len(rentals), dim), dtype="float32")
+        for i, r in enumerate(rentals):
+            if r.get(key):
+                mat[i] = np.asarray(r[key], dtype="float32").reshape(-1)
+        return mat
+
+    write_store(path, rentals, stack("text_emb", text_dim), stack("image_emb", image_dim))
+
+
+class IndexVectors:
+    """
+    Read-only (N, D) float32 matrix view of vectors held in a FAISS index,
+    decoded on access (store[rows] -> index.reconstruct_batch). Row r is
+    index id `ids[r]`, or r itself without `ids`. Only rows still in the
+    index (live rows) can be read.
+    """
+
+    def __init__(self, index, ids=None, n=None):
+        self.index = index
+        self.ids = ids
+        self.shape = (len(ids) if ids is not None else (index.ntotal if n is None else n), index.d)
+        self.dtype = np.dtype("float32")
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = np.arange(self.shape[0])[rows]
+        keys = np.atleast_1d(rows if self.ids is None else self.ids[rows]).astype(np.int64)
+        out = self.index.reconstruct_batch(keys) if len(keys) else np.zeros((0, self.shape[1]), dtype="float32")
+        return out.reshape(np.shape(rows) + (self.shape[1],))
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+class RowFilter:
+    """
+    Live rows of a store passing one set of structured pre-filters, with the
+    FAISS selectors over them built on first use. `fraction` is their share
+    of the store's live rows (the filter's selectivity).
+    """
+
+    def __init__(self, store, rows):
+        self.rows = rows
+        self.ids = store.ids[rows]
+        self.fraction = len(rows) / max(len(store.live_rows), 1)
+        self._store = store
+        self._selectors = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def selector(self, kind="rental"):
+        """IDSelector over the rows' rental ids, or with kind="photo" over their photo vector ids."""
+        sel = self._selectors.get(kind)
+        if sel is None:
+            if kind == "photo":
+                allowed = np.zeros(len(self._store), dtype=bool)
+                allowed[self.rows] = True
+                sel = bitmap_selector(allowed[self._store.image_vec_rows])
+            else:
+                sel = id_selector(self.ids)
+            self._selectors[kind] = sel
+        return sel
+
+
+class RentalStore:
+    """
+    Read side of a rental store. Embedding matrices are memory-mapped and the
+    structured columns are loaded up front; rental dicts are only decoded from
+    records.jsonl when `record(row)` asks for them.
+    """
+
+    def __init__(self, path=STORE_DIR, mmap_mode="r"):
+        self.path = path
+
+        def load(name):
+            file = os.path.join(path, name)
+            return np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+
+        # None until attach_index() for modalities stored only in a compact index
+        self.text_embs = load("text_emb.npy")
+        self.image_embs = load("image_emb.npy")
+        self.has_image = np.load(os.path.join(path, "has_image.npy"))
+        self.image_vecs, self.image_vec_offsets, self.image_vec_rows = None, None, None
+        if os.path.exists(os.path.join(path, "image_vec_offsets.npy")):
+            self.image_vecs = load("image_vecs.npy")
+            self.image_vec_offsets = np.load(os.path.join(path, "image_vec_offsets.npy"))
+            # row of each photo vector; photo vector ids are positions in image_vecs
+            self.image_vec_rows = np.repeat(np.arange(len(self.image_vec_offsets) - 1, dtype=np.int64),
+                                            np.diff(self.image_vec_offsets))
+
+        with np.load(os.path.join(path, "columns.npz")) as cols:
+            self.columns = {k: cols[k] for k in _COLUMN_KEYS}
+        with open(os.path.join(path, "loc_vocab.json"), "r", encoding="utf-8") as f:
+            self.columns["loc_vocab"] = json.load(f)
+
+        self._offsets = np.load(os.path.join(path, "offsets.npy"))
+        n = len(self._offsets) - 1
+        ids_path = os.path.join(path, "ids.npy")
+        self.ids = np.load(ids_path) if os.path.exists(ids_path) else np.arange(n, dtype=np.int64)
+        deleted_path = os.path.join(path, "deleted.npy")
+        self.deleted = np.load(deleted_path) if os.path.exists(deleted_path) else np.zeros(n, dtype=bool)
+        self.vectors_in_index = tuple(k for k, m in (("text", self.text_embs),
+                                                     ("image", self.image_embs if self.image_vec_offsets is None
+                                                      else self.image_vecs)) if m is None)
+
+        # Sorted ids of live rows, to map FAISS ids back to rows
+        self.live_rows = np.flatnonzero(~self.deleted)
+        order = np.argsort(self.ids[self.live_rows], kind="stable")
+        self._sorted_ids = self.ids[self.live_rows][order]
+        self._sorted_rows = self.live_rows[order]
+        self._filters = OrderedDict()
+        self._filters_lock = threading.Lock()
+        self._records = b""
+        with open(os.path.join(path, "records.jsonl"), "rb") as f:
+            if self._offsets[-1] > 0:
+                # mmap slices are safe to read from concurrent request threads
+                self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def attach_index(self, text_index, image_index):
+        """Serve the matrices kept only in compact indexes (vectors_in_index) from those indexes."""
+        if "text" in self.vectors_in_index:
+            self.text_embs = IndexVectors(text_index, self.ids)
+        if "image" in self.vectors_in_index:
+            if self.image_vec_offsets is None:
+                self.image_embs = IndexVectors(image_index, self.ids)
+            else:
+                self.image_vecs = IndexVectors(image_index, n=int(self.image_vec_offsets[-1]))
+
+    def row_filter(self, filters):
+        """
+        RowFilter of the live rows passing `filters` (see
+        structured_matcher.filter_mask), None when nothing is filtered. The
+        most recently used filters are cached.
+        """
+        key = normalize_filters(filters)
+        if key is None:
+            return None
+        with self._filters_lock:
+            cached = self._filters.get(key)
+            if cached is not None:
+                self._filters.move_to_end(key)
+                return cached
+        row_filter = RowFilter(self, self.live_rows[filter_mask(self.columns, key)[self.live_rows]])
+        with self._filters_lock:
+            self._filters[key] = row_filter
+            while len(self._filters) > FILTER_CACHE_SIZE:
+                self._filters.popitem(last=False)
+        return row_filter
+
+    def record(self, row):
+        """Rental dict (without embeddings) at `row`."""
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return json.loads(self._records[start:end])
+
+    def rows_for_ids(self, ids):
+        """Live row for each rental id, -1 where the id is unknown or deleted."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self._sorted_ids) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        pos = np.clip(np.searchsorted(self._sorted_ids, ids), 0, len(self._sorted_ids) - 1)
+        return np.where(self._sorted_ids[pos] == ids, self._sorted_rows[pos], -1)
+
+    def rows_for_vectors(self, vec_ids):
+        """Live row owning each photo vector id, -1 for padding and deleted rows."""
+        vec_ids = np.asarray(vec_ids, dtype=np.int64)
+        valid = (vec_ids >= 0) & (vec_ids < len(self.image_vec_rows))
+        rows = np.where(valid, self.image_vec_rows[np.where(valid, vec_ids, 0)], -1)
+        return np.where((rows >= 0) & ~self.deleted[np.maximum(rows, 0)], rows, -1)
+
+    def vector_ids_for_rows(self, rows):
+        """Photo vector ids of `rows`, concatenated."""
+        off = self.image_vec_offsets
+        return np.concatenate([np.arange(off[r], off[r + 1]) for r in rows] + [np.zeros(0, np.int64)])
+
+    def hashes(self):
+        """(embed_hash, record_hash) arrays of bytes, empty for stores without hashes."""
+        hashes_path = os.path.join(self.path, "hashes.npz")
+        if not os.path.exists(hashes_path):
+            empty = np.array([b""] * len(self), dtype="S32")
+            return empty, empty
+        with np.load(hashes_path) as h:
+            return h["embed_hash"], h["record_hash"]
+
+    @staticmethod
+    def exists(path=STORE_DIR):
+        return os.path.exists(os.path.join(path, "offsets.npy"))
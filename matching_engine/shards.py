@@ -0,0 +1,219 @@
+# matching_engine/shards.py
+import hashlib
+import json
+import os
+import re
+import shutil
+import numpy as np
+
+from matching_engine.index_factory import (build_index, fuse_vectors, load_index, parse_index_spec, save_index)
+from matching_engine.structured_matcher import haversine_km_batch, location_city, parse_coords
+
+# Optional per-market partitioning of a bundle (build_indexes --shard-index):
+#   <bundle>/shards/shards.json          market -> shard directory, spec, size
+#   <bundle>/shards/<market>/text.index  (+ image.index, fused.index, centroid.npy)
+# A rental's market is the city of its location (see location_city) or, for
+# coordinates, a 1-degree grid cell. Markets with at least `min_rentals` live
+# rentals get their own shard; smaller ones share the "_other" shard. Shard
+# indexes use the same ids as the global ones (rental ids, or photo vector ids
+# in multi-vector bundles) and share the bundle's store; the global indexes
+# are kept for sales outside every market and as the last fan-out step.
+SHARDS_SUBDIR = "shards"
+SHARDS_FILE = "shards.json"
+OTHER_MARKET = "_other"
+SHARD_INDEX_FILES = {"text": "text.index", "image": "image.index", "fused": "fused.index"}
+CENTROID_FILE = "centroid.npy"
+
+
+def _grid_cell(lat, lon):
+    return f"geo:{round(lat)},{round(lon)}" if np.isfinite(lat) and np.isfinite(lon) else None
+
+
+def _cell_position(market):
+    """(lat, lon) of a grid-cell market, NaNs for city markets."""
+    if not market.startswith("geo:"):
+        return float("nan"), float("nan")
+    lat, lon = market[4:].split(",")
+    return float(lat), float(lon)
+
+
+def market_of_location(loc):
+    """Market of a location: its normalised city, or a 1-degree grid cell for (lat, lon); None if missing."""
+    if not loc:
+        return None
+    coords = parse_coords(loc)
+    if coords is not None:
+        return _grid_cell(*coords)
+    return location_city(loc) or None
+
+
+def row_markets(columns):
+    """market_of_location of every row of the structured columns (object array, None where missing)."""
+    city_of = {i: location_city(loc) or None for loc, i in columns["loc_vocab"].items()}
+    markets = np.array([city_of.get(int(i)) for i in columns["loc_id"]], dtype=object)
+    for r in np.flatnonzero(columns["is_coord"]).tolist():
+        markets[r] = _grid_cell(*columns["coords"][r])
+    return markets
+
+
+def _shard_dir_name(market):
+    slug = re.sub(r"[^0-9a-z]+", "_", market.lower()).strip("_")[:40]
+    return f"{slug}-{hashlib.md5(market.encode('utf-8')).hexdigest()[:8]}"
+
+
+def _link_or_copy(src, dst):
+    """Bundle files are never modified once published, so unchanged files are hard-linked."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def write_shards(out_dir, store, spec="flat", min_rentals=200, fused_weights=None, previous=None, specs=None,
+                 rebuild=()):
+    """
+    Build the market shards of `store` (a RentalStore with its vectors
+    attached) under out_dir/shards and return a summary for the manifest.
+    `spec` is the index spec of new shards, `specs` overrides it per market.
+    Shards of the `previous` bundle directory whose members and embeddings
+    are unchanged, keep their spec and are not listed in `rebuild` are
+    hard-linked instead of rebuilt. `fused_weights` adds fused shard indexes.
+    """
+    specs = specs or {}
+    prev_table = {}
+    if previous and os.path.exists(os.path.join(previous, SHARDS_SUBDIR, SHARDS_FILE)):
+        with open(os.path.join(previous, SHARDS_SUBDIR, SHARDS_FILE), "r", encoding="utf-8") as f:
+            prev_table = json.load(f)["markets"]
+
+    live = store.live_rows
+    markets = np.array([m or OTHER_MARKET for m in row_markets(store.columns)[live]], dtype=object)
+    names, counts = np.unique(markets.astype(str), return_counts=True)
+    large = set(names[counts >= min_rentals].tolist()) - {OTHER_MARKET}
+    markets = np.array([m if m in large else OTHER_MARKET for m in markets.tolist()], dtype=object)
+    embed_hashes, _ = store.hashes()
+    multi = store.image_vec_offsets is not None
+
+    table, built = {}, 0
+    shards_dir = os.path.join(out_dir, SHARDS_SUBDIR)
+    os.makedirs(shards_dir, exist_ok=True)
+    for market in sorted(set(markets.tolist())):
+        rows = live[markets == market]
+        ids = store.ids[rows]
+        vec_ids = store.vector_ids_for_rows(rows).astype(np.int64) if multi else None
+        fp = hashlib.md5(ids.tobytes() + embed_hashes[rows].tobytes() +
+                         (vec_ids.tobytes() if multi else b"") + str(fused_weights).encode()).hexdigest()
+        prev = prev_table.get(market)
+        shard_spec = specs.get(market) or (prev["spec"] if prev else spec)
+        entry = {"dir": _shard_dir_name(market), "spec": shard_spec, "rentals": len(rows), "fingerprint": fp}
+        shard_dir = os.path.join(shards_dir, entry["dir"])
+        os.makedirs(shard_dir, exist_ok=True)
+
+        if prev and prev["fingerprint"] == fp and prev["spec"] == shard_spec and market not in rebuild:
+            src = os.path.join(previous, SHARDS_SUBDIR, prev["dir"])
+            for name in os.listdir(src):
+                _link_or_copy(os.path.join(src, name), os.path.join(shard_dir, name))
+            table[market] = {**entry, "params": prev["params"]}
+            continue
+
+        index_type, params = parse_index_spec(shard_spec)
+        text = np.ascontiguousarray(store.text_embs[rows], dtype="float32")
+        vectors = {"text": (text, ids)}
+        if multi:
+            vectors["image"] = (store.image_vecs[vec_ids], vec_ids)
+        else:
+            vectors["image"] = (store.image_embs[rows], ids)
+        if fused_weights is not None:
+            vectors["fused"] = (fuse_vectors(text, store.image_embs[rows], fused_weights), ids)
+        entry["params"] = {}
+        for kind, (embs, index_ids) in vectors.items():
+            index, entry["params"][kind] = build_index(embs, index_type, ids=index_ids, **params)
+            save_index(index, os.path.join(shard_dir, SHARD_INDEX_FILES[kind]), entry["params"][kind])
+        centroid = text.mean(axis=0)
+        np.save(os.path.join(shard_dir, CENTROID_FILE), centroid / (np.linalg.norm(centroid) + 1e-10))
+        table[market] = entry
+        built += 1
+
+    with open(os.path.join(shards_dir, SHARDS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"min_rentals": min_rentals, "markets": table}, f, indent=2, ensure_ascii=False)
+    print(f"🗺️ {len(table)} market shards ({built} built, {len(table) - built} unchanged); "
+          f"largest {max([e['rentals'] for e in table.values()], default=0)} of {len(live)} rentals")
+    return {"spec": spec, "min_rentals": min_rentals, "markets": len(table)}
+
+
+class Shard:
+    """The indexes of one market. Searched like an IndexBundle: it shares the bundle's store and manifest."""
+
+    def __init__(self, market, text_index, image_index, fused_index, store, manifest, centroid):
+        self.market = market
+        self.text_index = text_index
+        self.image_index = image_index
+        self.fused_index = fused_index
+        self.store = store
+        self.manifest = manifest
+        self.centroid = centroid
+
+
+class ShardMap:
+    """The shards of a bundle, with routing of sale locations to markets."""
+
+    def __init__(self, shards):
+        self.shards = {s.market: s for s in shards}
+        self._markets = [s.market for s in shards]
+        self._centroids = np.vstack([s.centroid for s in shards]).astype("float32")
+        self._positions = np.array([_cell_position(m) for m in self._markets], dtype=np.float64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def route(self, location):
+        """
+        Market shard of a sale location, None if it is outside every market.
+        Coordinates map to their grid cell; for strings the comma-separated
+        parts are tried from the last ("Florence, Italy" -> italy, florence).
+        """
+        if not location:
+            return None
+        if parse_coords(location) is not None:
+            market = market_of_location(location)
+        else:
+            parts = [location_city(p) for p in reversed(str(location).split(","))]
+            market = next((p for p in parts if p in self.shards), None)
+        return market if market in self.shards and market != OTHER_MARKET else None
+
+    def neighbours(self, market, text_emb, n, coords=None):
+        """
+        Up to `n` other markets to fan out to. For a sale with `coords`
+        (lat, lon) the grid-cell markets come first, nearest cell first. City
+        markets have no position; they, and all markets of a sale without
+        coordinates, are ranked by similarity of their text centroid to the
+        sale text, i.e. semantically rather than geographically.
+        """
+        order = np.argsort(-(self._centroids @ np.asarray(text_emb, dtype="float32")), kind="stable")
+        if coords is not None and np.all(np.isfinite(coords)):
+            with np.errstate(invalid="ignore"):
+                dist = haversine_km_batch(coords[0], coords[1], self._positions[:, 0], self._positions[:, 1])
+            # NaN distances (city markets) sort last, keeping their centroid order
+            order = order[np.argsort(dist[order], kind="stable")]
+        return [self._markets[i] for i in order.tolist() if self._markets[i] != market][:n]
+
+
+def load_shards(path, bundle, mmap=False):
+    """ShardMap of a bundle directory written with shards, None without."""
+    table_path = os.path.join(path, SHARDS_SUBDIR, SHARDS_FILE)
+    if not os.path.exists(table_path):
+        return None
+    with open(table_path, "r", encoding="utf-8") as f:
+        table = json.load(f)["markets"]
+    if not table:
+        return None
+
+    shards, n_vectors = [], 0
+    for market, entry in table.items():
+        shard_dir = os.path.join(path, SHARDS_SUBDIR, entry["dir"])
+        indexes = {kind: load_index(os.path.join(shard_dir, name), mmap=mmap)
+                   for kind, name in SHARD_INDEX_FILES.items() if os.path.exists(os.path.join(shard_dir, name))}
+        n_vectors += sum(index.ntotal for index in indexes.values())
+        shards.append(Shard(market, indexes["text"], indexes["image"], indexes.get("fused"), bundle.store,
+                            bundle.manifest, np.load(os.path.join(shard_dir, CENTROID_FILE))))
+    print(f"🗺️ {len(shards)} market shards loaded ({n_vectors} vectors)")
+    return ShardMap(shards)
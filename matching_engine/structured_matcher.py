@@ -1,5 +1,6 @@
 # matching_engine/structured_matcher.py
 import math
+import numpy as np
 
 def price_similarity_sale_to_rental(sale_price, rental_price_per_night):
     """
@@ -77,3 +78,194 @@ def location_similarity(loc_sale, loc_rental):
 
     # Case 2: string comparison
     return 100.0 if str(loc_sale).strip().lower() == str(loc_rental).strip().lower() else 40.0
+
+
+# ---------------- Batch (columnar) scoring ----------------
+# Vectorised counterparts of the pairwise functions above. They score one
+# sale against whole NumPy columns of rental attributes built once at index
+# load by `build_structured_columns`, and match the pairwise scores.
+
+def _normalize_location(loc):
+    return str(loc).strip().lower()
+
+
+def parse_coords(loc):
+    """(lat, lon) floats for a list/tuple location, None if it is not one, NaNs if malformed."""
+    if not isinstance(loc, (list, tuple)):
+        return None
+    try:
+        lat, lon = map(float, loc)
+        return lat, lon
+    except Exception:
+        return float("nan"), float("nan")
+
+
+def build_structured_columns(rentals, loc_vocab=None):
+    """
+    Build the columns used by `structured_similarity_batch` from rental dicts.
+    Pass an existing `loc_vocab` to extend it (ids of known locations are kept).
+    - price:     float64, NaN where missing/zero (neutral score)
+    - rooms:     float64 of int(rooms), NaN where missing
+    - loc_id:    int32 id of the normalised location string, -1 where missing
+    - loc_vocab: dict normalised location -> loc_id
+    - is_coord:  bool, location was given as (lat, lon)
+    - coords:    float64 (N, 2), NaN unless is_coord (or if malformed)
+    """
+    n = len(rentals)
+    price = np.full(n, np.nan)
+    rooms = np.full(n, np.nan)
+    loc_id = np.full(n, -1, dtype=np.int32)
+    is_coord = np.zeros(n, dtype=bool)
+    coords = np.full((n, 2), np.nan)
+    loc_vocab = dict(loc_vocab or {})
+
+    for i, r in enumerate(rentals):
+        if r.get("price"):
+            price[i] = float(r["price"])
+        if r.get("rooms") is not None:
+            rooms[i] = int(r["rooms"])
+        loc = r.get("location")
+        if loc:
+            loc_id[i] = loc_vocab.setdefault(_normalize_location(loc), len(loc_vocab))
+            parsed = parse_coords(loc)
+            if parsed is not None:
+                is_coord[i] = True
+                coords[i] = parsed
+
+    return {"price": price, "rooms": rooms, "loc_id": loc_id, "loc_vocab": loc_vocab,
+            "is_coord": is_coord, "coords": coords}
+
+
+def price_similarity_batch(sale_price, rental_prices):
+    """Vectorised `price_similarity_sale_to_rental`; NaN rental prices score 50."""
+    rental_prices = np.asarray(rental_prices, dtype=np.float64)
+    if not sale_price:
+        return np.full(rental_prices.shape, 50.0)
+
+    annual_rental = rental_prices * 0.5 * 365.0
+    target = sale_price * 0.05
+    scores = np.round(np.clip(annual_rental / (target + 1e-9) * 100.0, 0.0, 100.0), 2)
+    return np.where(np.isnan(rental_prices), 50.0, scores)
+
+
+def rooms_similarity_batch(sale_rooms, rental_rooms):
+    """Vectorised `rooms_similarity`; NaN rental rooms score 50."""
+    rental_rooms = np.asarray(rental_rooms, dtype=np.float64)
+    if sale_rooms is None:
+        return np.full(rental_rooms.shape, 50.0)
+
+    diff = np.abs(int(sale_rooms) - rental_rooms)
+    scores = np.select([diff == 0, diff == 1, diff == 2], [100.0, 70.0, 40.0], default=10.0)
+    return np.where(np.isnan(rental_rooms), 50.0, scores)
+
+
+def haversine_km_batch(lat, lon, lats, lons):
+    """Great-circle distance in km from one point to arrays of points."""
+    R = 6371.0
+    phi1, phi2 = np.radians(lat), np.radians(lats)
+    dphi = np.radians(lats - lat)
+    dlambda = np.radians(lons - lon)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def location_similarity_batch(sale_location, columns, rows=None):
+    """Vectorised `location_similarity` against the location columns (optionally a subset of rows)."""
+    loc_id, is_coord, coords = columns["loc_id"], columns["is_coord"], columns["coords"]
+    if rows is not None:
+        loc_id, is_coord, coords = loc_id[rows], is_coord[rows], coords[rows]
+    if not sale_location:
+        return np.full(loc_id.shape, 50.0)
+
+    # String comparison, also the fallback whenever either side is not coordinates
+    sale_id = columns["loc_vocab"].get(_normalize_location(sale_location), -2)
+    scores = np.where(loc_id == sale_id, 100.0, 40.0)
+
+    sale_coords = parse_coords(sale_location)
+    if sale_coords is not None and is_coord.any():
+        with np.errstate(invalid="ignore"):
+            dist = haversine_km_batch(sale_coords[0], sale_coords[1], coords[:, 0], coords[:, 1])
+        geo = np.select([dist <= 5, dist <= 50], [100.0, 60.0], default=20.0)
+        geo = np.where(np.isnan(dist), 50.0, geo)  # bad data -> neutral
+        scores = np.where(is_coord, geo, scores)
+
+    return np.where(loc_id < 0, 50.0, scores)
+
+
+def structured_similarity_batch(sale, columns, rows=None):
+    """
+    Structured score vector (mean of price, rooms and location scores, rounded
+    to 2 decimals) of one sale against all rentals, or the given `rows`.
+    """
+    price, rooms = columns["price"], columns["rooms"]
+    if rows is not None:
+        price, rooms = price[rows], rooms[rows]
+
+    total = (price_similarity_batch(sale.get("price"), price) +
+             rooms_similarity_batch(sale.get("rooms"), rooms) +
+             location_similarity_batch(sale.get("location"), columns, rows))
+    return np.round(total / 3.0, 2)
+
+
+# ---------------- Hard pre-filters ----------------
+# Optional filters applied inside the candidate searches (see engine): only
+# rentals passing all of them become candidates. Rentals missing a filtered
+# attribute are excluded.
+#   city                   name or list of names, compared with the last
+#                          comma-separated part of the location ("Spagna, Rome" -> "rome")
+#   min_rooms / max_rooms  room count range
+#   min_price / max_price  nightly price band
+FILTER_KEYS = ("city", "min_rooms", "max_rooms", "min_price", "max_price")
+
+
+def location_city(loc):
+    """
+    Normalised city of a location string: its last comma-separated part. None
+    for coordinates (anything parse_coords accepts), also in the "[lat, lon]"
+    string form they have as loc_vocab keys.
+    """
+    if parse_coords(loc) is not None:
+        return None
+    loc = _normalize_location(loc)
+    if loc.startswith(("[", "(")) and loc.endswith(("]", ")")):
+        return None
+    return loc.rsplit(",", 1)[-1].strip()
+
+
+def normalize_filters(filters):
+    """
+    Canonical, hashable form of a filters dict (sorted (key, value) tuples),
+    None if it filters nothing. Unknown keys raise ValueError.
+    """
+    if not filters:
+        return None
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown filters {sorted(unknown)}, expected some of {FILTER_KEYS}")
+
+    key = []
+    for name in FILTER_KEYS:
+        value = filters.get(name)
+        if value is None or value == "" or value == []:
+            continue
+        if name == "city":
+            value = tuple(sorted({location_city(c) for c in ([value] if isinstance(value, str) else value)} - {None}))
+        else:
+            value = float(value)
+        key.append((name, value))
+    return tuple(key) or None
+
+
+def filter_mask(columns, filters):
+    """Boolean mask over all rows of `columns` passing `filters` (a dict or normalize_filters key)."""
+    key = filters if isinstance(filters, tuple) else normalize_filters(filters)
+    mask = np.ones(len(columns["loc_id"]), dtype=bool)
+    for name, value in key or ():
+        if name == "city":
+            loc_ids = [i for loc, i in columns["loc_vocab"].items() if location_city(loc) in value]
+            mask &= np.isin(columns["loc_id"], loc_ids)
+        else:
+            col = columns["rooms" if name.endswith("rooms") else "price"]
+            with np.errstate(invalid="ignore"):  # NaN (missing) never passes
+                mask &= (col >= value) if name.startswith("min") else (col <= value)
+    return mask
@@ -1,30 +1,55 @@
 # matching_engine/text_matcher.py
 import os
-import json
 import hashlib
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+from matching_engine.embedding_cache import EmbeddingCache
 
 TEXT_MODEL_NAME = "all-MiniLM-L6-v2"
-_text_model = SentenceTransformer(TEXT_MODEL_NAME)
+# torch (SentenceTransformer), onnx or onnx-int8 (see onnx_encoder)
+TEXT_BACKEND = os.environ.get("MATCHING_TEXT_BACKEND", "torch")
+# Loaded on first use (or by engine.warm_up); sentence_transformers/torch are
+# only imported then, so cache-hit requests never pay for them.
+_text_model = None
+_model_lock = threading.Lock()
 
-CACHE_FILE = os.path.join("data", "text_embedding_cache.json")
+CACHE_FILE = os.path.join("data", "text_embedding_cache.sqlite")
+LEGACY_CACHE_FILE = os.path.join("data", "text_embedding_cache.json")
 
 # ---------------- Cache ----------------
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, "r", encoding="utf-8") as f:
-        _cache = json.load(f)
-else:
-    _cache = {}
+_cache = EmbeddingCache(CACHE_FILE, legacy_json=LEGACY_CACHE_FILE)
+
+def cache_stats():
+    """Hit/miss/eviction counters of the text embedding cache."""
+    return _cache.stats()
+
+def _get_model():
+    """Lazy load the text model; concurrent callers wait for the same load."""
+    global _text_model
+    if _text_model is not None:
+        return _text_model
+    with _model_lock:
+        if _text_model is None:
+            print(f"🔄 Loading text model {TEXT_MODEL_NAME} ({TEXT_BACKEND})...")
+            if TEXT_BACKEND == "torch":
+                from sentence_transformers import SentenceTransformer
+                _text_model = SentenceTransformer(TEXT_MODEL_NAME)
+            elif TEXT_BACKEND in ("onnx", "onnx-int8"):
+                from matching_engine.onnx_encoder import OnnxTextEncoder
+                _text_model = OnnxTextEncoder(TEXT_MODEL_NAME, quantize=TEXT_BACKEND == "onnx-int8")
+            else:
+                raise ValueError(f"Unknown MATCHING_TEXT_BACKEND {TEXT_BACKEND!r} (torch, onnx, onnx-int8)")
+            print("✅ Text model loaded")
+    return _text_model
+
+def model_loaded():
+    return _text_model is not None
 
 def _hash_text(text: str) -> str:
     """Create stable hash key for caching embeddings of text."""
     return hashlib.md5(text.strip().lower().encode()).hexdigest()
 
-def _save_cache():
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(_cache, f)
-
 # ---------------- Embedding ----------------
 def embed_text(texts):
     """
@@ -42,10 +67,11 @@ def embed_text(texts):
     results, to_embed, to_keys = [], [], []
 
     # check cache
+    cached = _cache.get_many([_hash_text(t) for t in texts])
     for t in texts:
         key = _hash_text(t)
-        if key in _cache:
-            results.append(np.array(_cache[key], dtype="float32"))
+        if cached.get(key) is not None:
+            results.append(cached[key])
         else:
             results.append("__PENDING__")
             to_embed.append(t)
@@ -53,20 +79,20 @@ def embed_text(texts):
 
     # embed missing
     if to_embed:
-        embs = _text_model.encode(to_embed, convert_to_numpy=True, show_progress_bar=False)
+        embs = _get_model().encode(to_embed, convert_to_numpy=True, show_progress_bar=False)
         embs = embs.astype("float32")
         embs = embs / (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-10)
 
         for i, (txt, key) in enumerate(to_keys):
             vec = embs[i]
-            _cache[key] = vec.tolist()
+            _cache.put(key, vec)
             # replace "__PENDING__" safely
             for j, r in enumerate(results):
                 if isinstance(r, str) and r == "__PENDING__":
                     results[j] = vec
                     break  # replace only the first pending per iteration
 
-        _save_cache()
+        _cache.flush()
 
     # stack results
     if single:
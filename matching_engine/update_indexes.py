@@ -0,0 +1,212 @@
+# matching_engine/update_indexes.py
+import argparse
+import json
+import os
+import faiss
+import numpy as np
+
+from matching_engine.build_indexes import (build_bundle, embed_rentals, load_rentals, main as build_main,
+                                           publish_bundle, _embed_hash, _record_hash)
+from matching_engine.bundle import (FUSED_INDEX_FILE, IMAGE_INDEX_FILE, MANIFEST_FILE, STORE_SUBDIR, TEXT_INDEX_FILE,
+                                    bundle_path, current_version)
+from matching_engine.index_factory import fuse_vectors, is_compact, load_index_params, supports_remove, trained_copy
+from matching_engine.rental_store import RentalStore, append_store
+
+# Incremental refresh of the current bundle from a new scrape:
+# - rentals are keyed by their stable id (see build_indexes._stable_rental_id)
+# - only new rentals and rentals whose description/images changed are embedded
+# - changed and deleted rentals leave tombstoned rows in the store; flat/IVF
+#   indexes drop their vectors right away, HNSW keeps them as stale vectors
+# - once tombstones or stale vectors exceed `compact_threshold` of the
+#   catalogue, the bundle is compacted: dead rows dropped and the indexes
+#   rebuilt from the stored vectors (no re-embedding); compact (sq8/fp16)
+#   indexes keep their trained quantizer, so their codes do not drift
+# - market shards (build_indexes --shard-index) are rebuilt only where their
+#   members or embeddings changed; the others are hard-linked
+
+
+def diff_rentals(store, rentals, delete_missing=True):
+    """
+    Compare a fresh scrape with the live rows of `store`. Returns a dict of
+    new / changed (embedding inputs differ) / touched (record only) rentals,
+    the store rows they replace, and the rows of rentals missing from the scrape.
+    """
+    live_ids = store.ids[store.live_rows]
+    row_of = dict(zip(live_ids.tolist(), store.live_rows.tolist()))
+    embed_hashes, record_hashes = store.hashes()
+
+    new, changed, touched, replaced_rows = [], [], [], []
+    seen = set()
+    for r in rentals:
+        seen.add(r["id"])
+        row = row_of.get(r["id"])
+        if row is None:
+            new.append(r)
+        elif _embed_hash(r).encode() != embed_hashes[row]:
+            changed.append(r)
+            replaced_rows.append(row)
+        elif _record_hash(r).encode() != record_hashes[row]:
+            touched.append((r, row))
+            replaced_rows.append(row)
+
+    deleted_rows = [row for rid, row in row_of.items() if rid not in seen] if delete_missing else []
+    return {"new": new, "changed": changed, "touched": touched,
+            "replaced_rows": replaced_rows, "deleted_rows": deleted_rows}
+
+
+def _live_rentals(store, rows):
+    return [store.record(r) for r in rows]
+
+
+def main(delete_missing=True, compact_threshold=0.2, force_compact=False, keep_bundles=3):
+    """Apply a new scrape to the current bundle and publish the result as a new bundle."""
+    version = current_version()
+    if version is None:
+        print("⚠️ No published bundle yet, running a full build")
+        return build_main(keep_bundles=keep_bundles)
+
+    path = bundle_path(version)
+    store = RentalStore(os.path.join(path, STORE_SUBDIR))
+    text_path, image_path = os.path.join(path, TEXT_INDEX_FILE), os.path.join(path, IMAGE_INDEX_FILE)
+    text_params, image_params = load_index_params(text_path), load_index_params(image_path)
+    # Copies of the current indexes; the delta is applied to them. Compact
+    # indexes also supply the store's vectors (see RentalStore.attach_index).
+    text_index, image_index = faiss.read_index(text_path), faiss.read_index(image_path)
+    store.attach_index(text_index, image_index)
+    fused_path = os.path.join(path, FUSED_INDEX_FILE)
+    fused_index = faiss.read_index(fused_path) if os.path.exists(fused_path) else None
+    fused_params = load_index_params(fused_path) if fused_index is not None else None
+    with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    shards = None
+    if manifest.get("shards"):
+        shards = {"spec": manifest["shards"]["spec"], "min_rentals": manifest["shards"]["min_rentals"],
+                  "previous": path}
+
+    rentals = load_rentals()
+    diff = diff_rentals(store, rentals, delete_missing)
+    print(f"🔎 {len(diff['new'])} new, {len(diff['changed'])} changed, {len(diff['touched'])} updated records, "
+          f"{len(diff['deleted_rows'])} deleted (bundle {version}, {len(store.live_rows)} live rentals)")
+
+    to_embed = diff["new"] + diff["changed"]
+    touched = [r for r, _ in diff["touched"]]
+    touched_rows = np.array([row for _, row in diff["touched"]], dtype=np.int64)
+    multi = store.image_vecs is not None
+    if to_embed:
+        text_embs, image_embs, photo_vecs = embed_rentals(to_embed, image_vectors=manifest.get("image_vectors", 1))
+    else:
+        text_embs = np.zeros((0, store.text_embs.shape[1]), dtype="float32")
+        image_embs = np.zeros((0, store.image_embs.shape[1]), dtype="float32")
+        photo_vecs = (np.zeros((0, store.image_embs.shape[1]), dtype="float32"), np.zeros(0, dtype=np.int64)) \
+            if multi else None
+
+    appended = to_embed + touched
+    appended_text = np.concatenate([text_embs, store.text_embs[touched_rows]])
+    appended_image = np.concatenate([image_embs, store.image_embs[touched_rows]])
+    appended_photos = None
+    if multi:
+        # Touched rentals keep their photo vectors, copied to the new rows
+        appended_photos = (np.concatenate([photo_vecs[0], store.image_vecs[store.vector_ids_for_rows(touched_rows)]]),
+                           np.concatenate([photo_vecs[1], np.diff(store.image_vec_offsets)[touched_rows]]))
+    tombstones = diff["replaced_rows"] + diff["deleted_rows"]
+
+    # Ids whose old vectors leave the indexes (or stay behind as stale HNSW vectors).
+    # Multi-vector image indexes are keyed by photo position, so every replaced row's photos go.
+    removed_text_ids = np.array([r["id"] for r in diff["changed"]] +
+                                store.ids[diff["deleted_rows"]].tolist(), dtype=np.int64)
+    removed_image_ids = store.vector_ids_for_rows(tombstones).astype(np.int64) if multi else removed_text_ids
+    stale = manifest.get("stale_vectors", 0)
+    if not supports_remove(text_params):
+        stale += len(removed_text_ids)
+    if not supports_remove(image_params):
+        stale += len(removed_image_ids)
+    if fused_index is not None and not supports_remove(fused_params):
+        stale += len(removed_text_ids)
+
+    n_rows = len(store) + len(appended)
+    n_tombstones = int(store.deleted.sum()) + len(tombstones)
+    n_live = n_rows - n_tombstones
+    needs_compaction = force_compact or n_tombstones > compact_threshold * max(n_live, 1) \
+        or stale > compact_threshold * max(n_live, 1)
+
+    if needs_compaction:
+        # Drop dead rows and rebuild both indexes from the stored vectors
+        dead = np.zeros(len(store), dtype=bool)
+        dead[store.deleted] = True
+        dead[tombstones] = True
+        keep_rows = np.flatnonzero(~dead)
+        live_rentals = _live_rentals(store, keep_rows) + appended
+        live_text = np.concatenate([store.text_embs[keep_rows], appended_text])
+        live_image = np.concatenate([store.image_embs[keep_rows], appended_image])
+        live_photos = None
+        if multi:
+            live_photos = (np.concatenate([store.image_vecs[store.vector_ids_for_rows(keep_rows)], appended_photos[0]]),
+                           np.concatenate([np.diff(store.image_vec_offsets)[keep_rows], appended_photos[1]]))
+        # Vectors of compact indexes were decoded from them; retraining on those
+        # would re-quantize on a new grid and add error with every compaction
+        trained = {kind: trained_copy(index) for kind, index, params in (
+            ("text", text_index, text_params), ("image", image_index, image_params),
+            ("fused", fused_index, fused_params)) if index is not None and is_compact(params)}
+        print(f"🧹 Compacting: dropping {int(dead.sum())} tombstoned rows and {stale} stale vectors")
+        bundle_dir = build_bundle(live_rentals, live_text, live_image, text_params, image_params,
+                                  manifest={"base_version": version, "compacted": True,
+                                            "image_vectors": manifest.get("image_vectors", 1)},
+                                  keep_bundles=keep_bundles, photo_vecs=live_photos, fused_index=fused_params,
+                                  shards=shards, trained=trained)
+        print(f"🎉 Compacted bundle -> {bundle_dir}")
+        return bundle_dir
+
+    # Apply the delta to the index copies
+    new_ids = np.array([r["id"] for r in to_embed], dtype=np.int64)
+    if len(removed_text_ids) and supports_remove(text_params):
+        text_index.remove_ids(removed_text_ids)
+    if len(new_ids):
+        text_index.add_with_ids(np.ascontiguousarray(text_embs, dtype="float32"), new_ids)
+    if len(removed_image_ids) and supports_remove(image_params):
+        image_index.remove_ids(removed_image_ids)
+    if multi:
+        new_vecs = appended_photos[0]
+        new_vec_ids = np.arange(len(store.image_vecs), len(store.image_vecs) + len(new_vecs), dtype=np.int64)
+        if len(new_vecs):
+            image_index.add_with_ids(np.ascontiguousarray(new_vecs, dtype="float32"), new_vec_ids)
+    elif len(new_ids):
+        image_index.add_with_ids(np.ascontiguousarray(image_embs, dtype="float32"), new_ids)
+    fused = None
+    if fused_index is not None:
+        if len(removed_text_ids) and supports_remove(fused_params):
+            fused_index.remove_ids(removed_text_ids)
+        if len(new_ids):
+            fused_index.add_with_ids(fuse_vectors(text_embs, image_embs, manifest["fused_weights"]), new_ids)
+        fused = (fused_index, fused_params)
+
+    def write(store_path):
+        append_store(store, store_path, appended, appended_text, appended_image,
+                     ids=[r["id"] for r in appended],
+                     embed_hashes=[_embed_hash(r) for r in appended],
+                     record_hashes=[_record_hash(r) for r in appended],
+                     tombstone_rows=tombstones, image_vecs=appended_photos)
+
+    bundle_dir = publish_bundle(write, text_index, image_index, text_params, image_params, {
+        "n_rentals": n_live,
+        "n_tombstones": n_tombstones,
+        "stale_vectors": stale,
+        "base_version": version,
+        "image_vectors": manifest.get("image_vectors", 1),
+        **({"fused_weights": manifest["fused_weights"]} if fused is not None else {}),
+    }, keep_bundles, fused, shards)
+    print(f"🎉 Updated bundle -> {bundle_dir} ({len(to_embed)} rentals embedded)")
+    return bundle_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally apply a new rental scrape to the current bundle")
+    parser.add_argument("--keep-missing", action="store_true",
+                        help="Do not delete rentals that are missing from the scrape")
+    parser.add_argument("--compact-threshold", type=float, default=0.2,
+                        help="Compact when tombstones or stale vectors exceed this fraction of live rentals")
+    parser.add_argument("--compact", action="store_true", help="Force compaction")
+    parser.add_argument("--keep-bundles", type=int, default=3)
+    args = parser.parse_args()
+    main(delete_missing=not args.keep_missing, compact_threshold=args.compact_threshold,
+         force_compact=args.compact, keep_bundles=args.keep_bundles)
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+
+
+def _unit_vectors(n, dim, seed=0):
+    """(n, dim) float32 rows with unit L2 norm, reproducible per seed."""
+    embs = np.random.default_rng(seed).standard_normal((n, dim)).astype("float32")
+    return embs / np.linalg.norm(embs, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def unit_vectors():
+    """Factory for random L2-normalised embedding matrices: unit_vectors(n, dim, seed=0)."""
+    return _unit_vectors
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    """Point the module-level embedding, failure and perceptual-hash caches at tmp_path instead of data/."""
+    from matching_engine import image_matcher, text_matcher
+    from matching_engine.embedding_cache import EmbeddingCache, NegativeCache
+    from matching_engine.image_dedup import PerceptualHashIndex
+
+    image_cache = str(tmp_path / "image_embedding_cache.sqlite")
+    monkeypatch.setattr(text_matcher, "_cache", EmbeddingCache(str(tmp_path / "text_embedding_cache.sqlite")))
+    monkeypatch.setattr(image_matcher, "_cache", EmbeddingCache(image_cache))
+    monkeypatch.setattr(image_matcher, "_negative", NegativeCache(image_cache))
+    monkeypatch.setattr(image_matcher, "_phash", PerceptualHashIndex(str(tmp_path / "image_phash.sqlite")))
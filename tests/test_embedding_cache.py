@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+
+from matching_engine.embedding_cache import EmbeddingCache, NegativeCache
+
+
+def test_cache_roundtrip_and_shared_file(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    writer = EmbeddingCache(path, flush_every=1000)
+    vec = np.arange(4, dtype="float32")
+    writer.put("a", vec)
+    writer.put("failed", None)
+
+    # Buffered entries are visible to the writer before the flush, to others after
+    reader = EmbeddingCache(path)
+    assert reader.get_many(["a", "failed"]) == {}
+    assert np.array_equal(writer.get("a"), vec)
+    writer.flush()
+
+    found = reader.get_many(["a", "failed", "missing"])
+    assert set(found) == {"a", "failed"}
+    assert found["a"].dtype == np.float32 and np.array_equal(found["a"], vec)
+    assert found["failed"] is None
+    assert reader.get("missing", "nope") == "nope"
+    assert len(reader) == 2
+
+
+def test_legacy_json_migration(tmp_path):
+    legacy = tmp_path / "cache.json"
+    legacy.write_text(json.dumps({"a": [0.5, 0.25], "b": None}))
+
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), legacy_json=str(legacy))
+
+    assert not legacy.exists() and (tmp_path / "cache.json.migrated").exists()
+    assert cache.get("a").tolist() == [0.5, 0.25]
+    assert "b" in cache and cache.get("b") is None
+
+
+def test_memory_tier_is_bounded(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    for k in "abc":
+        cache.put(k, np.full(4, ord(k), dtype="float32"))
+    cache.flush()
+
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1 and stats["bytes"] == 32
+
+    # "a" was evicted but is still on disk; reading it back evicts the LRU entry "b"
+    assert cache.get("a")[0] == ord("a")
+    cache.get("c")
+    cache.get("zzz", None)
+    stats = cache.stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"], stats["evictions"]) == (1, 1, 1, 2)
+    assert list(cache._lru) == ["a", "c"]
+
+    # Returned vectors are copies
+    cache.get("c")[:] = 0
+    assert cache.get("c")[0] == ord("c")
+
+
+def test_negative_cache_ttls_and_backoff(tmp_path):
+    neg = NegativeCache(str(tmp_path / "cache.sqlite"), ttls={"timeout": 100, "not_found": 1000}, max_ttl=300)
+    neg.record("slow", "timeout", now=0)
+    neg.record("dead", "not_found", now=0)
+
+    assert neg.blocked(["slow", "dead", "fine"], now=50) == {"slow": "timeout", "dead": "not_found"}
+    assert neg.blocked(["slow", "dead"], now=150) == {"dead": "not_found"}
+
+    # Repeated failures double the TTL, capped at max_ttl
+    neg.record("slow", "timeout", now=150)
+    assert "slow" in neg.blocked(["slow"], now=340) and not neg.blocked(["slow"], now=360)
+    neg.record("slow", "timeout", now=400)
+    assert "slow" in neg.blocked(["slow"], now=690) and not neg.blocked(["slow"], now=710)
+
+    neg.forget("dead")
+    assert neg.blocked(["dead"], now=50) == {}
+    assert neg.stats() == {"skipped": 5, "recorded": 4}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
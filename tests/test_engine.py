@@ -1,21 +1,28 @@
 import os
+import subprocess
 import sys
+import threading
 
 # Ensure root import
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import numpy as np
+import pytest
+
+from matching_engine import engine, image_matcher, text_matcher
 from matching_engine.build_indexes import main as build_indexes_main
-from matching_engine.engine import match_sale_to_rentals
+from matching_engine.bundle import IndexBundle, MANIFEST_FILE, is_published_version, prune_bundles, publish
+from matching_engine.engine import SaleEmbedding, _aggregate_photo_scores, _candidates_many, match_sale_to_rentals
+from matching_engine.index_factory import build_index, fuse_vectors
+from matching_engine.rental_store import RentalStore, write_store
 
-# Paths for cached indexes
-DATA_META = os.path.join("data", "rentals_meta.json")
-FAISS_TEXT_PATH = os.path.join("data", "faiss_text.index")
-FAISS_IMAGE_PATH = os.path.join("data", "faiss_image.index")
+# Published index bundle pointer
+CURRENT_BUNDLE = os.path.join("data", "bundles", "CURRENT")
 
 
 def test_build_and_match():
     # Step 1: Build indexes only if missing
-    if not (os.path.exists(DATA_META) and os.path.exists(FAISS_TEXT_PATH) and os.path.exists(FAISS_IMAGE_PATH)):
+    if not os.path.exists(CURRENT_BUNDLE):
         print("⚙️ Indexes not found, building them ...")
         build_indexes_main()
     else:
@@ -37,5 +44,176 @@ def test_build_and_match():
     print("🏆 Top result:", results[0])
 
 
+def test_multi_vector_image_aggregation(tmp_path, unit_vectors):
+    rng = np.random.default_rng(0)
+    counts = np.array([2, 0, 3])
+    vecs = unit_vectors(counts.sum(), 8)
+    rentals = [{"id": i, "url": f"https://r/{i}"} for i in range(3)]
+    write_store(str(tmp_path), rentals, rng.standard_normal((3, 4)), rng.standard_normal((3, 8)),
+                image_vecs=(vecs, counts))
+    store = RentalStore(str(tmp_path))
+    sale_vecs = vecs[[0, 4]] + 0.1 * rng.standard_normal((2, 8)).astype("float32")
+
+    rows = np.array([2, 1, 0])
+    pairs = [vecs[2:5] @ sale_vecs.T, None, vecs[0:2] @ sale_vecs.T]
+    best = _aggregate_photo_scores(store, rows, sale_vecs, "max")
+    top2 = _aggregate_photo_scores(store, rows, sale_vecs, "top2")
+    for i, p in enumerate(pairs):
+        expected_max = 0.0 if p is None else p.max()
+        expected_top2 = 0.0 if p is None else np.sort(p.ravel())[-2:].mean()
+        assert np.isclose(best[i], expected_max, atol=1e-5)
+        assert np.isclose(top2[i], expected_top2, atol=1e-5)
+
+
+class _CountingIndex:
+    def __init__(self, index):
+        self.index, self.calls = index, 0
+
+    def search(self, queries, k, params=None):
+        self.calls += 1
+        return self.index.search(queries, k, params=params)
+
+
+def test_fused_index_candidates_and_text_fallback(tmp_path, unit_vectors):
+    text, image = unit_vectors(50, 8), unit_vectors(50, 4, seed=1)
+    ids = np.arange(50, dtype=np.int64) + 100
+    write_store(str(tmp_path), [{"id": int(i)} for i in ids], text, image, ids=ids)
+    indexes = [_CountingIndex(build_index(embs, "flat", ids=ids)[0])
+               for embs in (text, image, fuse_vectors(text, image, (0.45, 0.35)))]
+    bundle = IndexBundle("v1", *indexes[:2], RentalStore(str(tmp_path)), {"fused_weights": [0.45, 0.35]},
+                         fused_index=indexes[2])
+
+    with_image, text_only = SaleEmbedding(text[7], image[3]), SaleEmbedding(text[7], None)
+    fused, fallback = _candidates_many(bundle, [with_image, text_only], 5, 5, 10)
+
+    # One fused search, ordered by the semantic part of the final score
+    expected = np.argsort(-(0.45 * text @ text[7] + 0.35 * image @ image[3]), kind="stable")[:10]
+    assert fused == expected.tolist()
+    # The sale without images only searches the text index
+    assert fallback == np.argsort(-(text @ text[7]), kind="stable")[:5].tolist()
+    assert [i.calls for i in indexes] == [1, 0, 1]
+
+
+def test_prefilters_restrict_candidate_searches(tmp_path, unit_vectors):
+    n = 300
+    text, image = unit_vectors(n, 8, seed=1), unit_vectors(n, 4, seed=2)
+    ids = np.arange(n, dtype=np.int64) * 7 + 11
+    cities = ["Spagna, Rome", "Milan", "Giudecca, Venice"]
+    rentals = [{"id": int(i), "location": cities[j % 3], "rooms": j % 5, "price": 40.0 + j} for j, i in enumerate(ids)]
+    write_store(str(tmp_path), rentals, text, image, ids=ids)
+    store = RentalStore(str(tmp_path))
+    bundle = IndexBundle("v1", build_index(text, "hnsw", ids=ids)[0], build_index(image, "flat", ids=ids)[0], store)
+    sale = SaleEmbedding(text[0], image[0])
+
+    # Searches only return rentals passing the filters (here 50 of 300)
+    row_filter = store.row_filter({"city": "rome", "min_rooms": 2, "max_price": 290})
+    assert len(row_filter) == 50 and store.row_filter({"city": ["Rome"], "max_price": 290, "min_rooms": 2}) is row_filter
+    rows = _candidates_many(bundle, [sale], 10, 10, 20, row_filter)[0]
+    passing = set(row_filter.rows.tolist())
+    assert 10 <= len(rows) <= 20 and set(rows) <= passing
+    assert rows[0] == sorted(passing, key=lambda r: -text[r] @ text[0])[0]
+    assert engine._result_dict(bundle, rows[0], 1.0, 2.0, 3.0, 4.0)["rental_id"] == int(ids[rows[0]])
+
+    # At most final_candidate_limit passing rentals: all of them, without a search
+    assert _candidates_many(bundle, [sale], 10, 10, 60, row_filter)[0] == row_filter.rows.tolist()
+    assert _candidates_many(bundle, [sale], 10, 10, 60, store.row_filter({"city": "Paris"}))[0] == []
+
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "hnsw"])
+def test_selective_prefilters_still_fill_top_k(tmp_path, unit_vectors, index_type):
+    n = 4000
+    text, image = unit_vectors(n, 16, seed=3), unit_vectors(n, 8, seed=4)
+    ids = np.arange(n, dtype=np.int64) + 1
+    rentals = [{"id": int(i), "location": f"Centro, City{j % 50}", "rooms": j % 10} for j, i in enumerate(ids)]
+    write_store(str(tmp_path), rentals, text, image, ids=ids)
+    store = RentalStore(str(tmp_path))
+    bundle = IndexBundle("v1", build_index(text, index_type, ids=ids)[0], build_index(image, index_type, ids=ids)[0],
+                         store)
+    sale = SaleEmbedding(text[0], image[0])
+
+    # 2% pass: the passing rows are scored exactly instead of searched
+    narrow = store.row_filter({"city": "City7"})
+    assert len(narrow) == 80 and narrow.fraction < engine.EXACT_FILTER_FRACTION
+    rows = _candidates_many(bundle, [sale], 20, 20, 30, narrow)[0]
+    passing = narrow.rows
+    by_text = passing[np.argsort(-(text[passing] @ text[0]), kind="stable")][:20].tolist()
+    assert len(rows) == 30 and set(rows) <= set(passing.tolist()) and rows[:20] == by_text
+
+    # 10% pass: searched with nprobe / efSearch scaled up, still top_k hits
+    wide = store.row_filter({"min_rooms": 9})
+    assert len(wide) == 400 and wide.fraction >= engine.EXACT_FILTER_FRACTION
+    for index, query in ((bundle.text_index, text[0]), (bundle.image_index, image[0])):
+        hits = engine._search_topk(index, store, query, 50, wide)
+        assert len(hits) == 50 and {r for r, _ in hits} <= set(wide.rows.tolist())
+
+
+def test_engine_import_defers_model_libraries(tmp_path):
+    code = ("import sys; import matching_engine.engine; "
+            "assert not {'torch', 'sentence_transformers'} & set(sys.modules), sorted(sys.modules)")
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    # Run in a scratch directory: importing the engine opens the caches under ./data
+    subprocess.run([sys.executable, "-c", code], cwd=str(tmp_path), env=env, check=True)
+
+
+def test_background_warm_up_reports_readiness(monkeypatch):
+    release = threading.Event()
+
+    def slow_load():
+        release.wait(5)
+        monkeypatch.setattr(image_matcher, "_image_model", object())
+
+    monkeypatch.setattr(text_matcher, "_get_model", lambda: monkeypatch.setattr(text_matcher, "_text_model", object()))
+    monkeypatch.setattr(image_matcher, "_get_model", slow_load)
+    monkeypatch.setattr(engine, "load_indexes", lambda: None)
+    monkeypatch.setattr(engine, "_bundle", type("Bundle", (), {"version": "v1"})())
+    monkeypatch.setattr(engine, "_warmup", {"thread": None, "started": None, "finished": None, "error": None})
+
+    thread = engine.warm_up()
+    status = engine.readiness()
+    assert not status["ready"] and status["warming_up"] and not status["image_model"]
+
+    release.set()
+    thread.join(5)
+    status = engine.readiness()
+    assert status["ready"] and status["text_model"] and status["image_model"] and "error" not in status
+
+
+def test_set_worker_threads_caps_faiss(monkeypatch):
+    import faiss
+    monkeypatch.setenv("OMP_NUM_THREADS", "")
+    before = faiss.omp_get_max_threads()
+    try:
+        engine.set_worker_threads(2)
+        assert faiss.omp_get_max_threads() == 2
+    finally:
+        faiss.omp_set_num_threads(before)
+
+
+def test_prune_bundles_keeps_newest_same_second_versions(tmp_path):
+    versions = ["20260101T000000Z", "20260101T000000Z-2", "20260101T000000Z-10", "20260101T000000Z-3"]
+    for v in versions:
+        (tmp_path / v).mkdir()
+        (tmp_path / v / MANIFEST_FILE).write_text("{}")
+    publish(versions[0], str(tmp_path))
+
+    prune_bundles(keep=2, bundles_dir=str(tmp_path))
+    remaining = {p.name for p in tmp_path.iterdir() if (p / MANIFEST_FILE).exists()}
+    assert remaining == {"20260101T000000Z", "20260101T000000Z-3", "20260101T000000Z-10"}
+
+
+def test_reload_only_accepts_published_versions(tmp_path, monkeypatch):
+    (tmp_path / "20260101T000000Z").mkdir()
+    (tmp_path / "other").mkdir()
+    assert is_published_version("20260101T000000Z", str(tmp_path))
+    for version in ("20260101T000000Z-2", "other", "../..", "/etc", str(tmp_path / "20260101T000000Z"), ""):
+        assert not is_published_version(version, str(tmp_path))
+
+    monkeypatch.setattr(engine, "BUNDLES_DIR", str(tmp_path))
+    monkeypatch.setattr(engine, "_load_bundle", lambda *a: pytest.fail("must not load"))
+    with pytest.raises(ValueError):
+        engine.reload_indexes("../..")
+
+
 if __name__ == "__main__":
     test_build_and_match()
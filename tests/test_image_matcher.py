@@ -0,0 +1,249 @@
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from matching_engine import image_matcher
+from matching_engine.embedding_cache import NegativeCache
+from matching_engine.image_dedup import BAND_BITS, BANDS, MAX_BUCKET_CANDIDATES, PerceptualHashIndex
+
+
+class _FakeResponse:
+    def __init__(self, body, content_length=True):
+        self.body = body
+        self.headers = {"Content-Length": str(len(body))} if content_length else {}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 1000):
+            yield self.body[i:i + 1000]
+
+
+def test_concurrent_downloads_respect_deadline(monkeypatch):
+    # The six fetches only get past the barrier if they all run at the same time
+    barrier, release = threading.Barrier(6, timeout=5), threading.Event()
+
+    def fake_load(url, *args, **kwargs):
+        if "slow" in url:
+            release.wait(5)
+        elif "broken" not in url:
+            barrier.wait()
+        return None if "broken" in url else url
+
+    monkeypatch.setattr(image_matcher, "load_image_from_url", fake_load)
+    urls = [f"https://img/{i}" for i in range(6)] + ["https://img/broken", "https://img/slow"]
+
+    try:
+        loaded = image_matcher.load_images_concurrently(urls, deadline=1.0)
+    finally:
+        release.set()
+
+    # The downloads overlapped and the one still running at the deadline is dropped
+    assert not barrier.broken
+    assert loaded == {**{u: u for u in urls[:6]}, "https://img/broken": None}
+
+
+def test_read_body_and_size_limit():
+    body = os.urandom(300 * 1024)
+    assert bytes(image_matcher._read_body(_FakeResponse(body))) == body
+    assert bytes(image_matcher._read_body(_FakeResponse(body, content_length=False))) == body
+    with pytest.raises(Exception, match="too large"):
+        image_matcher._read_body(_FakeResponse(body), max_size=1024)
+    with pytest.raises(Exception, match="too large"):
+        image_matcher._read_body(_FakeResponse(body, content_length=False), max_size=1024)
+
+
+def test_decode_image_uses_reduced_jpeg_decode():
+    buf = BytesIO()
+    Image.new("RGB", (2000, 1500), (200, 30, 30)).save(buf, "JPEG")
+    img = image_matcher._decode_image(buf.getvalue())
+    assert img.mode == "RGB" and img.size == (224, 168)
+    assert abs(img.getpixel((100, 80))[0] - 200) < 5
+
+
+def test_pipelined_embedding_batches_and_caches(monkeypatch):
+    batches = []
+
+    def fake_encode(images):
+        batches.append(len(images))
+        return np.array([[float(img.split("/")[-1]), 1.0] for img in images], dtype="float32")
+
+    monkeypatch.setattr(image_matcher, "load_image_from_url", lambda url, **k: None if "broken" in url else url)
+    monkeypatch.setattr(image_matcher, "encode_images", fake_encode)
+    monkeypatch.setattr(image_matcher, "DEDUP", False)
+    urls = [f"https://img/{i}" for i in range(10)] + ["https://img/broken", "https://img/3", None]
+
+    done = []
+    out = image_matcher.embed_images_pipelined(urls, workers=4, batch_size=4, progress=done.append)
+
+    assert sorted(batches) == [2, 4, 4] and sum(done) == 11
+    assert out["https://img/broken"] is None
+    assert [out[f"https://img/{i}"][0] for i in range(10)] == list(range(10))
+
+    # Second run is served from the cache without encoding
+    batches.clear()
+    again = image_matcher.embed_images_pipelined(urls, workers=4, batch_size=4)
+    assert batches == [] and again["https://img/7"][0] == 7.0
+    assert again["https://img/broken"] is None and image_matcher.negative_cache_stats()["skipped"] == 1
+
+
+class _FakeHTTPResponse(_FakeResponse):
+    def __init__(self, status, body=b""):
+        super().__init__(body)
+        self.status_code = status
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise image_matcher.requests.HTTPError(f"{self.status_code} Error", response=self)
+
+
+def test_failed_fetches_are_retried_then_negatively_cached(monkeypatch):
+    calls = []
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        if "flaky" in url:
+            if calls.count(url) < 3:
+                raise image_matcher.requests.Timeout("read timed out")
+            buf = BytesIO()
+            _photo(3).save(buf, "JPEG")
+            return _FakeHTTPResponse(200, buf.getvalue())
+        return _FakeHTTPResponse(404)
+
+    monkeypatch.setattr(image_matcher._session, "get", fake_get)
+    monkeypatch.setattr(image_matcher, "RETRY_BACKOFF", 0.01)
+
+    # Timeouts are retried within the call, a 404 is not
+    assert image_matcher._fetch("https://img/flaky") is not None
+    assert image_matcher._fetch("https://img/gone") is None
+    assert calls.count("https://img/flaky") == 3 and calls.count("https://img/gone") == 1
+
+    key = image_matcher._hash_url("https://img/gone")
+    assert image_matcher._negative.blocked([key]) == {key: "not_found"}
+    assert image_matcher._skip_failed(["https://img/gone", "https://img/flaky"]) == ["https://img/flaky"]
+
+
+def test_fetch_retries_stay_within_the_deadline(monkeypatch):
+    timeouts, sleeps = [], []
+
+    def fake_load(url, *args, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        raise image_matcher.ImageFetchError("timeout")
+
+    monkeypatch.setattr(image_matcher, "load_image_from_url", fake_load)
+    monkeypatch.setattr(image_matcher, "RETRY_BACKOFF", 60.0)
+    monkeypatch.setattr(image_matcher.time, "sleep", sleeps.append)
+
+    # The request timeout is capped at the time left and no backoff outlasts the deadline
+    assert image_matcher._fetch("https://img/slow", deadline_at=time.monotonic() + 1.0) is None
+    assert len(timeouts) == 1 and timeouts[0] <= 1.0 and sleeps == []
+    assert image_matcher._negative.blocked([image_matcher._hash_url("https://img/slow")])
+
+    # Still queued at the deadline: no request and no recorded failure
+    assert image_matcher._fetch("https://img/late", deadline_at=time.monotonic() - 1) is None
+    assert len(timeouts) == 1 and not image_matcher._negative.blocked([image_matcher._hash_url("https://img/late")])
+
+
+def test_successful_fetch_resets_failure_backoff(monkeypatch, tmp_path):
+    statuses = [404, 200, 404]
+
+    def fake_get(url, **kwargs):
+        status = statuses.pop(0)
+        if status != 200:
+            return _FakeHTTPResponse(status)
+        buf = BytesIO()
+        _photo(4).save(buf, "JPEG")
+        return _FakeHTTPResponse(200, buf.getvalue())
+
+    negative = NegativeCache(str(tmp_path / "cache.sqlite"), ttls={"not_found": 100})
+    monkeypatch.setattr(image_matcher._session, "get", fake_get)
+    monkeypatch.setattr(image_matcher, "_negative", negative)
+    url, key = "https://img/moved", image_matcher._hash_url("https://img/moved")
+
+    assert image_matcher._fetch(url) is None
+    assert image_matcher._fetch(url) is not None
+    assert negative._connection().execute("SELECT COUNT(*) FROM failures").fetchone() == (0,)
+
+    # The next failure starts again from the base TTL instead of a doubled one
+    assert image_matcher._fetch(url) is None
+    assert negative._connection().execute("SELECT attempts FROM failures WHERE key = ?", (key,)).fetchone() == (1,)
+    assert negative.blocked([key]) and not negative.blocked([key], now=time.time() + 150)
+
+
+def _photo(seed, size=(640, 480)):
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(blocks).resize(size, Image.Resampling.BICUBIC)
+
+
+def test_near_duplicate_images_reuse_embeddings(monkeypatch):
+    def variant(img, size, quality):
+        buf = BytesIO()
+        img.resize(size, Image.Resampling.LANCZOS).save(buf, "JPEG", quality=quality)
+        return image_matcher._decode_image(buf.getvalue())
+
+    images = {
+        "https://cdn/a.jpg": variant(_photo(1), (640, 480), 90),
+        "https://cdn/a.jpg?w=320": variant(_photo(1), (320, 240), 70),
+        "https://cdn/b.jpg": variant(_photo(2), (640, 480), 90),
+    }
+    encoded = []
+
+    def fake_encode(imgs):
+        encoded.extend(imgs)
+        return np.array([[float(len(encoded) - len(imgs) + i), 1.0] for i in range(len(imgs))], dtype="float32")
+
+    monkeypatch.setattr(image_matcher, "load_image_from_url", lambda url, *a, **k: images[url])
+    monkeypatch.setattr(image_matcher, "encode_images", fake_encode)
+
+    # Within one batch: the resized variant aliases the original
+    first = image_matcher.embed_images_batch(["https://cdn/a.jpg", "https://cdn/a.jpg?w=320"])
+    assert len(encoded) == 1 and np.array_equal(first[0], first[1])
+
+    # Across batches: the index finds the earlier image, a different photo is still embedded
+    image_matcher._cache._lru.clear()
+    image_matcher._cache._conn.execute("DELETE FROM embeddings WHERE key = ?",
+                                       (image_matcher._hash_url("https://cdn/a.jpg?w=320"),))
+    second = image_matcher.embed_images_batch(["https://cdn/a.jpg?w=320", "https://cdn/b.jpg"])
+    assert len(encoded) == 2 and np.array_equal(second[0], first[0])
+    assert image_matcher.dedup_stats()["hits"] == 2
+
+
+def test_phash_lookups_examine_bounded_candidates(tmp_path):
+    rng = np.random.default_rng(0)
+
+    def band():
+        return int(sum(1 << int(b) for b in rng.permutation(BAND_BITS)[:BAND_BITS // 2]))
+
+    def fingerprint(shared, value):
+        bands = [band() for _ in range(BANDS)]
+        bands[shared] = value
+        return sum(b << (BAND_BITS * i) for i, b in enumerate(bands)), 0x808080
+
+    # 3000 photos sharing a flat band (e.g. the sky), then 3000 sharing an ordinary one
+    for shared, value in ((0, 0), (1, 0x5A5A)):
+        index = PerceptualHashIndex(str(tmp_path / f"phash{shared}.sqlite"))
+        fps = [fingerprint(shared, value) for _ in range(3000)]
+        index.add_many([(f"k{j}", fp) for j, fp in enumerate(fps)])
+
+        h, color = fps[1234]
+        assert index.find((h ^ (1 << (BAND_BITS * 2)), color)) == "k1234"
+        assert index.find(fingerprint(shared, value)) is None
+        # Two lookups: the flat bucket is skipped, the crowded one capped
+        assert index.stats()["candidates_examined"] <= 2 * ((MAX_BUCKET_CANDIDATES if shared else 0) + 10)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,103 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import faiss
+import numpy as np
+import pytest
+
+from matching_engine.bundle import IndexBundle
+from matching_engine.index_factory import (build_index, fuse_vectors, load_index, parse_index_spec, save_index,
+                                           storage_report)
+from matching_engine.rental_store import write_store
+
+
+def test_parse_index_spec():
+    assert parse_index_spec("flat") == ("flat", {})
+    assert parse_index_spec("hnsw,M=16,efSearch=128") == ("hnsw", {"M": 16, "efSearch": 128})
+    with pytest.raises(ValueError):
+        parse_index_spec("lsh")
+    with pytest.raises(ValueError):
+        parse_index_spec("hnsw,nprobe=4")
+
+
+@pytest.mark.parametrize("spec", ["flat", "ivf_flat,nlist=32,nprobe=8", "ivf_pq,nlist=16,m=16,nprobe=16",
+                                  "hnsw,M=16,efSearch=64", "sq8", "fp16"])
+def test_build_save_load_roundtrip(tmp_path, spec, unit_vectors):
+    embs = unit_vectors(2000, 64)
+    index_type, params = parse_index_spec(spec)
+    index, params = build_index(embs, index_type, **params)
+    assert index.ntotal == len(embs)
+
+    path = str(tmp_path / "test.index")
+    save_index(index, path, params)
+    loaded = load_index(path)
+
+    if "nprobe" in params:
+        assert faiss.extract_index_ivf(loaded).nprobe == params["nprobe"]
+    if "efSearch" in params:
+        assert loaded.hnsw.efSearch == params["efSearch"]
+
+    # Approximate indexes should still find each vector as its own nearest neighbour
+    _, I = loaded.search(embs[:50], 1)
+    recall = float(np.mean(I[:, 0] == np.arange(50)))
+    assert recall >= (1.0 if index_type == "flat" else 0.8)
+
+
+@pytest.mark.parametrize("index_type, max_drift", [("sq8", 1.0), ("fp16", 0.05)])
+def test_compact_index_storage_report(index_type, max_drift, unit_vectors):
+    embs = unit_vectors(2000, 64)
+    ids = np.arange(len(embs), dtype=np.int64) * 3 + 5
+    index, _ = build_index(embs, index_type, ids=ids)
+
+    report = storage_report(index, embs, ids)
+    assert report["compact_bytes"] < embs.nbytes * (0.3 if index_type == "sq8" else 0.6)
+    assert report["saved_bytes"] == report["float32_bytes"] - report["compact_bytes"]
+    assert report["score_drift_max"] < max_drift and report["recall"] >= 0.9
+    assert np.allclose(index.reconstruct_batch(ids[:10]), embs[:10], atol=0.02)
+
+
+def test_fused_vectors_score_weighted_sum(unit_vectors):
+    text, image = unit_vectors(100, 32, seed=1), unit_vectors(100, 16, seed=2)
+    image[:10] = 0.0  # rentals without a photo
+    fused = fuse_vectors(text, image, (0.45, 0.35))
+    query = fuse_vectors(text[50], image[50], (0.45, 0.35))
+
+    expected = 0.45 * (text @ text[50]) + 0.35 * (image @ image[50])
+    assert fused.shape == (100, 48) and np.allclose(fused @ query[0], expected, atol=1e-5)
+
+    index, _ = build_index(fused, "flat", ids=np.arange(100, dtype=np.int64))
+    _, I = index.search(query, 10)
+    assert I[0].tolist() == np.argsort(-expected, kind="stable")[:10].tolist()
+
+
+def test_mmap_loaded_bundle_matches_heap_copy(tmp_path, unit_vectors):
+    n = 1000
+    text, image = unit_vectors(n, 32, seed=1), unit_vectors(n, 16, seed=2)
+    ids = np.arange(n, dtype=np.int64) * 2 + 1
+    write_store(str(tmp_path / "store"), [{"id": int(i)} for i in ids], text, image, ids=ids)
+    paths = {}
+    for name, embs, spec in (("text", text, "flat"), ("image", image, "ivf_flat,nlist=16,nprobe=4")):
+        index_type, params = parse_index_spec(spec)
+        index, params = build_index(embs, index_type, ids=ids, **params)
+        paths[name] = str(tmp_path / f"{name}.index")
+        save_index(index, paths[name], params)
+
+    heap, mapped = (IndexBundle.from_files("v1", paths["text"], paths["image"], str(tmp_path / "store"), mmap)
+                    for mmap in (False, True))
+    for index_name, queries in (("text_index", text[:20]), ("image_index", image[:20])):
+        D_heap, I_heap = getattr(heap, index_name).search(queries, 10)
+        D_mapped, I_mapped = getattr(mapped, index_name).search(queries, 10)
+        assert np.array_equal(I_heap, I_mapped) and np.allclose(D_heap, D_mapped)
+    assert faiss.extract_index_ivf(mapped.image_index).nprobe == 4
+
+    for name in ("text", "image"):
+        memory = mapped.index_memory[name]
+        assert memory["mmap"] is True and memory["ntotal"] == n
+        assert memory["file_bytes"] == os.path.getsize(paths[name])
+        assert memory["resident_bytes"] is None or isinstance(memory["resident_bytes"], int)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
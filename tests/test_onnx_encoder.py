@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from matching_engine.onnx_encoder import _mean_pool, _sample_images, _sample_texts, clip_preprocess
+
+
+def test_mean_pool_ignores_padding():
+    hidden = np.array([[[1.0, 2.0], [3.0, 4.0], [100.0, 100.0]],
+                       [[5.0, 6.0], [100.0, 100.0], [100.0, 100.0]]], dtype="float32")
+    mask = np.array([[1, 1, 0], [1, 0, 0]])
+    assert np.allclose(_mean_pool(hidden, mask), [[2.0, 3.0], [5.0, 6.0]])
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_onnx_text_backend_matches_torch(tmp_path, quantize):
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("tokenizers")
+    st_module = pytest.importorskip("sentence_transformers")
+    from matching_engine.onnx_encoder import OnnxTextEncoder
+    from matching_engine.text_matcher import TEXT_MODEL_NAME
+
+    texts = _sample_texts(40) + ["", "Attico a Roma con terrazza panoramica"]
+    ref = st_module.SentenceTransformer(TEXT_MODEL_NAME, device="cpu").encode(
+        texts, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    embs = OnnxTextEncoder(TEXT_MODEL_NAME, quantize=quantize, root=str(tmp_path)).encode(texts, batch_size=8)
+
+    assert embs.shape == ref.shape and embs.dtype == np.float32
+    assert (embs * ref).sum(axis=1).min() >= 0.99
+
+
+def test_clip_preprocess_resizes_short_side_and_centre_crops():
+    # 400x200: black | white (middle 200px) | black; after resizing to 448x224
+    # the centre 224x224 crop is exactly the white band
+    img = Image.new("RGB", (400, 200))
+    img.paste((255, 255, 255), (100, 0, 300, 200))
+    px = clip_preprocess([img, img.rotate(90, expand=True)], size=224, crop=224,
+                         mean=np.array([0.5, 0.5, 0.5]), std=np.array([0.5, 0.5, 0.5]))
+
+    assert px.shape == (2, 3, 224, 224) and px.dtype == np.float32
+    assert np.allclose(px[:, :, 4:-4, 4:-4], 1.0, atol=1e-2)
+
+
+@pytest.mark.parametrize("quantize, min_cosine", [(False, 0.99), (True, 0.98)])
+def test_onnx_clip_backend_matches_torch(tmp_path, quantize, min_cosine):
+    pytest.importorskip("onnxruntime")
+    st_module = pytest.importorskip("sentence_transformers")
+    from matching_engine.image_matcher import IMAGE_MODEL_NAME
+    from matching_engine.onnx_encoder import OnnxClipVisionEncoder
+
+    images = _sample_images(16) + [Image.new("RGB", (224, 400), (30, 120, 200))]
+    ref = st_module.SentenceTransformer(IMAGE_MODEL_NAME, device="cpu").encode(
+        images, convert_to_numpy=True, show_progress_bar=False)
+    ref /= np.linalg.norm(ref, axis=1, keepdims=True)
+    embs = OnnxClipVisionEncoder(IMAGE_MODEL_NAME, quantize=quantize, root=str(tmp_path)).encode(images, batch_size=8)
+
+    assert embs.shape == ref.shape and embs.dtype == np.float32
+    assert (embs * ref).sum(axis=1).min() >= min_cosine
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,103 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+
+from matching_engine.index_factory import build_index
+from matching_engine.rental_store import IndexVectors, RentalStore, append_store, write_store
+
+RENTALS = [
+    {"id": 1, "url": "https://r/1", "title": "Flat in Rome", "price": 120.0, "rooms": 2, "location": "Spagna, Rome",
+     "images": ["https://img/1"]},
+    {"id": 2, "url": "https://r/2", "title": "Casa è bella", "price": 0.0, "rooms": None, "location": "Florence",
+     "images": []},
+    {"id": 3, "url": "https://r/3", "title": "Loft", "price": 80.0, "rooms": 1, "location": [45.46, 9.19],
+     "images": ["https://img/3"]},
+]
+
+
+def test_store_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    text_embs = rng.standard_normal((3, 8)).astype("float32")
+    image_embs = rng.standard_normal((3, 4)).astype("float32")
+    image_embs[1] = 0.0
+
+    write_store(str(tmp_path), RENTALS, text_embs, image_embs)
+    store = RentalStore(str(tmp_path))
+
+    assert len(store) == 3
+    assert isinstance(store.text_embs, np.memmap)
+    assert np.allclose(np.linalg.norm(store.text_embs, axis=1), 1.0, atol=1e-5)
+    assert store.has_image.tolist() == [True, False, True]
+    assert store.columns["loc_id"].tolist() == [0, 1, 2]
+    assert store.columns["is_coord"].tolist() == [False, False, True]
+    for row in (2, 0, 1):
+        assert store.record(row) == RENTALS[row]
+
+
+def test_append_store_tombstones(tmp_path):
+    rng = np.random.default_rng(1)
+    write_store(str(tmp_path / "a"), RENTALS, rng.standard_normal((3, 8)), rng.standard_normal((3, 4)),
+                ids=[10, 20, 30], embed_hashes=["a", "b", "c"], record_hashes=["a", "b", "c"])
+    store = RentalStore(str(tmp_path / "a"))
+
+    changed = {**RENTALS[1], "price": 95.0, "location": "Naples"}
+    append_store(store, str(tmp_path / "b"), [changed], rng.standard_normal((1, 8)), rng.standard_normal((1, 4)),
+                 ids=[20], embed_hashes=["b"], record_hashes=["d"], tombstone_rows=[1])
+    store = RentalStore(str(tmp_path / "b"))
+
+    assert len(store) == 4
+    assert store.live_rows.tolist() == [0, 2, 3]
+    assert store.rows_for_ids([30, 20, 99]).tolist() == [2, 3, -1]
+    assert store.record(3) == changed
+    assert store.columns["loc_id"].tolist() == [0, 1, 2, 3]
+    assert store.hashes()[1].tolist() == [b"a", b"b", b"c", b"d"]
+
+
+def test_multi_image_store_vector_mapping(tmp_path):
+    rng = np.random.default_rng(2)
+    vecs = rng.standard_normal((4, 4)).astype("float32")
+    write_store(str(tmp_path / "a"), RENTALS, rng.standard_normal((3, 8)), rng.standard_normal((3, 4)),
+                ids=[10, 20, 30], embed_hashes=["a"] * 3, record_hashes=["a"] * 3, image_vecs=(vecs, [1, 0, 3]))
+    store = RentalStore(str(tmp_path / "a"))
+    assert store.image_vec_rows.tolist() == [0, 2, 2, 2]
+    assert store.vector_ids_for_rows([2, 1]).tolist() == [1, 2, 3]
+
+    append_store(store, str(tmp_path / "b"), [RENTALS[0]], rng.standard_normal((1, 8)), rng.standard_normal((1, 4)),
+                 ids=[10], embed_hashes=["b"], record_hashes=["b"], tombstone_rows=[0],
+                 image_vecs=(rng.standard_normal((2, 4)), [2]))
+    store = RentalStore(str(tmp_path / "b"))
+    assert store.image_vec_offsets.tolist() == [0, 1, 1, 4, 6]
+    assert store.rows_for_vectors([[0, 3, 5, -1]]).tolist() == [[-1, 2, 3, -1]]
+    assert np.allclose(np.linalg.norm(store.image_vecs, axis=1), 1.0, atol=1e-5)
+
+
+def test_compact_store_reads_vectors_from_index(tmp_path, unit_vectors):
+    rng = np.random.default_rng(3)
+    text_embs = unit_vectors(3, 8, seed=3)
+    image_embs = rng.standard_normal((3, 4)).astype("float32")
+    ids = np.array([10, 20, 30])
+    write_store(str(tmp_path / "a"), RENTALS, text_embs, image_embs, ids=ids, embed_hashes=["a"] * 3,
+                record_hashes=["a"] * 3, vectors_in_index=["text"])
+    assert not (tmp_path / "a" / "text_emb.npy").exists()
+
+    text_index, _ = build_index(text_embs, "fp16", ids=ids)
+    store = RentalStore(str(tmp_path / "a"))
+    assert store.vectors_in_index == ("text",) and store.text_embs is None
+    store.attach_index(text_index, None)
+    assert isinstance(store.text_embs, IndexVectors) and store.text_embs.shape == (3, 8)
+    assert np.allclose(store.text_embs[[2, 0]], text_embs[[2, 0]], atol=1e-3)
+    assert np.allclose(store.text_embs[1], text_embs[1], atol=1e-3)
+
+    # Appending keeps the layout: new text vectors go to the index, not the store
+    append_store(store, str(tmp_path / "b"), [RENTALS[0]], rng.standard_normal((1, 8)), rng.standard_normal((1, 4)),
+                 ids=[40], embed_hashes=["b"], record_hashes=["b"], tombstone_rows=[0])
+    store = RentalStore(str(tmp_path / "b"))
+    assert store.vectors_in_index == ("text",) and store.image_embs.shape == (4, 4)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
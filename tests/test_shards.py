@@ -0,0 +1,104 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+
+from matching_engine import engine
+from matching_engine.bundle import IndexBundle
+from matching_engine.engine import SaleEmbedding, _candidates_many
+from matching_engine.index_factory import build_index
+from matching_engine.rental_store import RentalStore, write_store
+from matching_engine.shards import OTHER_MARKET, Shard, ShardMap, load_shards, row_markets, write_shards
+
+LOCATIONS = ["Spagna, Rome", "Rione Monti, Rome", "Milan", "Giudecca, Venice", [45.44, 12.33], "Otranto", None]
+
+
+def _sharded_bundle(path, unit_vectors, n=140, min_rentals=20, previous=None, rebuild=(), seed=0):
+    text, image = unit_vectors(n, 8, seed), unit_vectors(n, 4, seed + 100)
+    ids = np.arange(n, dtype=np.int64) * 3 + 1
+    rentals = [{"id": int(i), "location": LOCATIONS[j % len(LOCATIONS)]} for j, i in enumerate(ids)]
+    write_store(os.path.join(path, "store"), rentals, text, image, ids=ids,
+                embed_hashes=[f"{seed}-{i}" for i in ids], record_hashes=[""] * n)
+    store = RentalStore(os.path.join(path, "store"))
+    summary = write_shards(path, store, min_rentals=min_rentals, previous=previous, rebuild=rebuild)
+    bundle = IndexBundle("v1", build_index(text, "flat", ids=ids)[0], build_index(image, "flat", ids=ids)[0], store)
+    bundle.shards = load_shards(path, bundle)
+    return bundle, summary, text
+
+
+def test_markets_and_routing(tmp_path, unit_vectors):
+    bundle, summary, _ = _sharded_bundle(str(tmp_path), unit_vectors)
+    markets = row_markets(bundle.store.columns)
+    assert markets[:7].tolist() == ["rome", "rome", "milan", "venice", "geo:45,12", "otranto", None]
+
+    # 140 rentals: rome has 40, the other markets 20 each; missing locations go to "_other"
+    shards = bundle.shards
+    assert summary["markets"] == len(shards) == 6 and OTHER_MARKET in shards.shards
+    assert shards.shards["rome"].text_index.ntotal == 40 and shards.shards[OTHER_MARKET].text_index.ntotal == 20
+    assert shards.route("Florence, Italy") is None and shards.route("Venice, Italy") == "venice"
+    assert shards.route(" ROME ") == "rome" and shards.route([45.4, 12.2]) == "geo:45,12"
+    assert shards.route([41.9, 12.5]) is None and shards.route(None) is None
+
+    # Markets below min_rentals share "_other"; routing never picks it
+    bundle, summary, _ = _sharded_bundle(str(tmp_path / "big"), unit_vectors, min_rentals=30)
+    assert summary["markets"] == 2 and bundle.shards.shards[OTHER_MARKET].text_index.ntotal == 100
+    assert bundle.shards.route("Milan") is None
+    assert len(shards.neighbours("rome", np.ones(8), 2)) == 2 and "rome" not in shards.neighbours("rome", np.ones(8), 9)
+
+
+def test_neighbours_by_grid_distance_with_coordinates(unit_vectors):
+    markets = ["rome", "geo:52,13", "geo:41,12", "geo:45,12"]
+    centroids = unit_vectors(len(markets), 8)
+    shards = ShardMap([Shard(m, None, None, None, None, None, c) for m, c in zip(markets, centroids)])
+    sale_text = centroids[0]
+
+    # Grid cells nearest first, then the city market; without coordinates by centroid similarity
+    assert shards.route([41.2, 12.4]) == "geo:41,12"
+    assert shards.neighbours("geo:41,12", sale_text, 3, (41.2, 12.4)) == ["geo:45,12", "geo:52,13", "rome"]
+    assert shards.neighbours("geo:41,12", sale_text, 1)[0] == "rome"
+
+
+def test_routed_candidates_fan_out(tmp_path, monkeypatch, unit_vectors):
+    bundle, _, text = _sharded_bundle(str(tmp_path), unit_vectors)
+    rome_rows = set(np.flatnonzero(row_markets(bundle.store.columns) == "rome").tolist())
+    sale = SaleEmbedding(text[0], None)
+    monkeypatch.setattr(engine, "SHARD_FANOUT", 2)
+
+    # Enough candidates in the market's shard: only Rome rentals
+    monkeypatch.setattr(engine, "SHARD_MIN_CANDIDATES", 10)
+    rows = _candidates_many(bundle, [sale], 10, 10, 30, sales=[{"location": "Rome"}])[0]
+    assert len(rows) == 10 and set(rows) <= rome_rows
+
+    # Short of candidates: widens to neighbour shards, then to the global index
+    monkeypatch.setattr(engine, "SHARD_MIN_CANDIDATES", 60)
+    rows = _candidates_many(bundle, [sale], 40, 40, 100, sales=[{"location": "Rome"}])[0]
+    assert set(rows) & rome_rows == rome_rows and len(rows) >= 60
+
+    # Sales outside every market search the global indexes
+    rows = _candidates_many(bundle, [sale], 10, 10, 30, sales=[{"location": "Paris"}])[0]
+    assert rows == _candidates_many(bundle, [sale], 10, 10, 30)[0]
+
+
+def test_unchanged_shards_are_linked(tmp_path, unit_vectors):
+    first = str(tmp_path / "v1")
+    _sharded_bundle(first, unit_vectors)
+    _, summary, _ = _sharded_bundle(str(tmp_path / "v2"), unit_vectors, previous=first, rebuild=["milan"])
+    text_file = os.path.join("shards", "{}", "text.index")
+
+    import json
+    with open(os.path.join(first, "shards", "shards.json")) as f:
+        dirs = {m: e["dir"] for m, e in json.load(f)["markets"].items()}
+    linked = os.stat(os.path.join(first, text_file.format(dirs["rome"]))).st_nlink
+    rebuilt = os.stat(os.path.join(first, text_file.format(dirs["milan"]))).st_nlink
+    assert linked == 2 and rebuilt == 1 and summary["markets"] == 6
+
+    # Changed embeddings rebuild every shard they touch
+    _sharded_bundle(str(tmp_path / "v3"), unit_vectors, previous=first, seed=1)
+    assert os.stat(os.path.join(first, text_file.format(dirs["rome"]))).st_nlink == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
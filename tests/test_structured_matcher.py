@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from matching_engine.structured_matcher import (
+    price_similarity_sale_to_rental, rooms_similarity, location_similarity,
+    build_structured_columns, structured_similarity_batch, filter_mask, normalize_filters, location_city,
+)
+import pytest
+
+RENTALS = [
+    {"price": 120.0, "rooms": 2, "location": "Spagna, Rome"},
+    {"price": 0.0, "rooms": None, "location": "rome "},
+    {"price": 80.0, "rooms": 5, "location": [41.90, 12.49]},
+    {"price": 300.0, "rooms": 0, "location": [43.77, 11.25]},
+    {"price": None, "rooms": 3, "location": ["bad", "data"]},
+    {"price": 45.5, "rooms": 1, "location": None},
+]
+
+SALES = [
+    {"price": 300000, "rooms": 2, "location": "Rome"},
+    {"price": None, "rooms": None, "location": [41.91, 12.50]},
+    {"price": 1e6, "rooms": 3, "location": "spagna, rome"},
+    {"price": 50000, "rooms": 0, "location": ""},
+    {"price": 250000, "rooms": 4, "location": ["x", 1]},
+]
+
+
+def test_batch_matches_pairwise_scores():
+    columns = build_structured_columns(RENTALS)
+    for sale in SALES:
+        batch = structured_similarity_batch(sale, columns)
+        for r, got in zip(RENTALS, batch.tolist()):
+            expected = round(
+                (price_similarity_sale_to_rental(sale["price"], r["price"]) +
+                 rooms_similarity(sale["rooms"], r["rooms"]) +
+                 location_similarity(sale["location"], r["location"])) / 3.0, 2
+            )
+            assert got == expected, (sale, r, got, expected)
+
+        rows = [4, 0, 2]
+        subset = structured_similarity_batch(sale, columns, rows)
+        assert subset.tolist() == [batch[i] for i in rows]
+
+
+def test_filter_mask():
+    columns = build_structured_columns(RENTALS)
+    assert filter_mask(columns, {"city": "Rome"}).tolist() == [True, True, False, False, False, False]
+    assert filter_mask(columns, {"min_rooms": 1, "max_rooms": 3}).tolist() == [True, False, False, False, True, True]
+    # Missing (or zero) prices never pass a price band
+    assert filter_mask(columns, {"min_price": 50, "max_price": 200}).tolist() == [True, False, True, False, False, False]
+    assert filter_mask(columns, {"city": ["rome", "Milan"], "min_rooms": 2}).tolist() == [True] + [False] * 5
+    # Coordinate locations have no city, so their pieces never become one
+    for loc in ([41.90, 12.49], ("bad", "data"), "[41.9, 12.49]", "['bad', 'data']"):
+        assert location_city(loc) is None
+    assert not filter_mask(columns, {"city": ["12.49]", "'data']"]}).any()
+
+    assert normalize_filters({"city": " ROME", "max_price": None}) == normalize_filters({"city": ["rome"]})
+    assert normalize_filters({"city": ""}) is None and normalize_filters(None) is None
+    with pytest.raises(ValueError):
+        normalize_filters({"bedrooms": 2})
+
+
+if __name__ == "__main__":
+    test_batch_matches_pairwise_scores()
+    test_filter_mask()
@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+
+from matching_engine import update_indexes
+from matching_engine.build_indexes import build_bundle
+from matching_engine.bundle import IMAGE_INDEX_FILE, STORE_SUBDIR, TEXT_INDEX_FILE, bundle_path, current_version
+from matching_engine.index_factory import load_index
+from matching_engine.rental_store import RentalStore
+
+
+def _current_vectors():
+    path = bundle_path(current_version())
+    store = RentalStore(os.path.join(path, STORE_SUBDIR))
+    store.attach_index(load_index(os.path.join(path, TEXT_INDEX_FILE)),
+                       load_index(os.path.join(path, IMAGE_INDEX_FILE)))
+    rows = store.live_rows
+    return store.ids[rows], np.asarray(store.text_embs[rows]), np.asarray(store.image_embs[rows])
+
+
+@pytest.mark.parametrize("spec", ["sq8", "fp16"])
+def test_repeated_compaction_keeps_compact_vectors(tmp_path, monkeypatch, unit_vectors, spec):
+    # Bundles are written under ./data/bundles
+    monkeypatch.chdir(tmp_path)
+    n = 300
+    rentals = [{"id": i + 1, "url": f"https://r/{i}", "desc": f"rental {i}", "images": []} for i in range(n)]
+    build_bundle(rentals, unit_vectors(n, 16), unit_vectors(n, 8, seed=1), spec, spec)
+    monkeypatch.setattr(update_indexes, "load_rentals", lambda: rentals)
+
+    built = _current_vectors()
+    update_indexes.main(force_compact=True)
+    once = _current_vectors()
+    update_indexes.main(force_compact=True)
+    twice = _current_vectors()
+
+    # Re-encoding decoded vectors with the original quantizer gives back the same codes
+    for before, after in zip(built, once):
+        assert np.array_equal(before, after)
+    for before, after in zip(once, twice):
+        assert np.array_equal(before, after)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])